@@ -1,6 +1,7 @@
 import numpy as np
 from config import *
 import gas_temperature as gas_temp
+from derived_fields import *
 
 # Theoretical dust yields for all sources of creation
 
@@ -635,7 +636,7 @@ def calc_elem_acc_timescale(G, t_ref_factor=1.):
 	t_ref = 0.2E9*t_ref_factor 	# yr
 	T_ref = 20					# K
 	dens_ref = H_MASS		   	# g cm^-3
-	T = gas_temp.gas_temperature(G)
+	T = calc_temperature(G)
 	dens = G['rho']*UnitDensity_in_cgs
 	growth_time = t_ref * (dens_ref/dens) * np.power(T_ref/T,0.5)
 
@@ -675,7 +676,7 @@ def calc_spec_acc_timescale(G, depletion=False, CNM_thresh=0.95, nano_iron=False
 	T_cut = 300 		# K cutoff temperature for step func. sticking efficiency
 	iron_incl = 0.7		# when using nan_iron, fraction of iron hidden in silicate dust and not available for acc.
 
-	T = gas_temp.gas_temperature(G)
+	T = calc_temperature(G)
 	fH2 = calc_fH2(G)
 
 	timescales = dict.fromkeys(['Silicates', 'Carbon', 'Iron'], None) 
@@ -752,29 +753,33 @@ def calc_spec_acc_timescale(G, depletion=False, CNM_thresh=0.95, nano_iron=False
 
 def calc_fH2(G):
 	# Analytic calculation of molecular hydrogen from Krumholz et al. (2018)
-	Z = G['z'][:,0] #metal mass (everything not H, He)
-	# dust mean mass per H nucleus
-	mu_H = 2.3E-24# grams
-	# standard effective number of particle kernel neighbors defined in parameters file
-	N_ngb = 32.
-	# Gas softening length
-	hsml = G['h']*UnitLength_in_cm
-	density = G['rho']*UnitDensity_in_cgs
+	# This is only calculated once for each snapshot and shared by everything that needs it
+	def calc():
+		Z = G['z'][:,0] #metal mass (everything not H, He)
+		# dust mean mass per H nucleus
+		mu_H = 2.3E-24# grams
+		# standard effective number of particle kernel neighbors defined in parameters file
+		N_ngb = 32.
+		# Gas softening length
+		hsml = G['h']*UnitLength_in_cm
+		density = G['rho']*UnitDensity_in_cgs
 
-	sobColDens = np.multiply(hsml,density) / np.power(N_ngb,1./3.) # Cheesy approximation of column density
+		sobColDens = np.multiply(hsml,density) / np.power(N_ngb,1./3.) # Cheesy approximation of column density
 
-	#  dust optical depth 
-	tau = np.multiply(sobColDens,Z*1E-21/SOLAR_Z)/mu_H
-	tau[tau==0]=EPSILON #avoid divide by 0
+		#  dust optical depth 
+		tau = np.multiply(sobColDens,Z*1E-21/SOLAR_Z)/mu_H
+		tau[tau==0]=EPSILON #avoid divide by 0
 
-	chi = 3.1 * (1+3.1*np.power(Z/SOLAR_Z,0.365)) / 4.1 # Approximation
+		chi = 3.1 * (1+3.1*np.power(Z/SOLAR_Z,0.365)) / 4.1 # Approximation
 
-	s = np.divide( np.log(1+0.6*chi+0.01*np.power(chi,2)) , (0.6 *tau) )
-	s[s==-4.] = -4.+EPSILON # Avoid divide by zero
-	fH2 = np.divide((1 - 0.5*s) , (1+0.25*s)) # Fraction of Molecular Hydrogen from Krumholz & Knedin
-	fH2[fH2<0] = 0 #Nonphysical negative molecular fractions set to 0
+		s = np.divide( np.log(1+0.6*chi+0.01*np.power(chi,2)) , (0.6 *tau) )
+		s[s==-4.] = -4.+EPSILON # Avoid divide by zero
+		fH2 = np.divide((1 - 0.5*s) , (1+0.25*s)) # Fraction of Molecular Hydrogen from Krumholz & Knedin
+		fH2[fH2<0] = 0 #Nonphysical negative molecular fractions set to 0
 
-	return fH2
+		return fH2
+
+	return derived_field(G, 'fH2', ['z','h','rho'], calc)
 
 
 
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+def grouped_weighted_percentile(a, groups, num_groups, percentiles=np.array([50, 16, 84]), weights=None, interpolation='weighted', order=None):
+	"""
+	Calculates percentiles associated with a (possibly weighted) array for every group of elements at
+	once. The array is sorted a single time by group and value, instead of masking and sorting it again for
+	each group, so this scales with the number of elements instead of elements times groups.
+
+	Parameters
+	----------
+	a : array-like
+	    The input array from which to calculate percents
+	groups : array-like
+		Group number of each value of a, values with a group outside of 0 to num_groups-1 are ignored
+	num_groups : int
+		Number of groups
+	percentiles : array-like
+	    The percentiles to calculate (0.0 - 100.0)
+	weights : array-like, optional
+	    The weights to assign to values of a.  Equal weighting if None
+	    is specified
+	interpolation : string
+		'weighted' - percentiles from the cumulative weights, the same as weighted_percentile
+		'linear' - percentiles from the ranks of the values, the same as np.percentile
+	order : array, optional
+		Indices that sort a, e.g. from np.argsort(a). Giving these lets one sort of a be reused for
+		percentiles over several different groupings.
+
+	Returns
+	-------
+	values : np.array
+	    The values associated with the specified percentiles for each group, with shape
+	    (num_groups, len(percentiles)). Groups with no values are NaN.
+	"""
+
+	a = np.asarray(a); groups = np.asarray(groups)
+	percentiles = np.asarray(percentiles, dtype=np.float64)
+	values = np.full([num_groups, len(percentiles)], np.nan)
+
+	in_groups = np.logical_and(groups >= 0, groups < num_groups)
+	if order is not None:
+		# Keep the sorted order of the values that are in a group, as positions in the reduced array
+		order = np.asarray(order)
+		order = (np.cumsum(in_groups) - 1)[order[in_groups[order]]]
+	a = a[in_groups]; groups = groups[in_groups].astype(np.intp)
+	if weights is not None:
+		weights = np.asarray(weights)[in_groups]
+	# First deal with empty array
+	if len(a)==0:
+		return values
+
+	# Sort once by value and then by group, a stable sort on small integers is a fast radix sort
+	idx = np.argsort(a) if order is None else order
+	if num_groups <= np.iinfo(np.int16).max:
+		idx = idx[np.argsort(groups[idx].astype(np.int16), kind='stable')]
+	else:
+		idx = idx[np.argsort(groups[idx], kind='stable')]
+	a_sort = a[idx]
+	g_sort = groups[idx]
+	counts = np.bincount(g_sort, minlength=num_groups)
+	starts = np.cumsum(counts) - counts
+	filled = np.where(counts > 0)[0]
+
+	# Get the percentiles for each data point in its group
+	if interpolation == 'linear':
+		rank = np.arange(len(a_sort)) - starts[g_sort]
+		p = 100. * rank / np.maximum(counts[g_sort] - 1, 1)
+	else:
+		if weights is None:
+			w_sort = np.ones(len(a_sort))
+		else:
+			w_sort = weights[idx].astype(np.float64)
+		# Accumulate in double precision since single precision weights lose accuracy over many particles
+		cum_w = np.cumsum(w_sort, dtype=np.float64)
+		# Cumulative weights restarted at the start of each group
+		offset = np.zeros(num_groups)
+		offset[filled] = cum_w[starts[filled]] - w_sort[starts[filled]]
+		cum_w -= offset[g_sort]
+		total_w = np.zeros(num_groups)
+		total_w[filled] = np.add.reduceat(w_sort, starts[filled])
+		p = cum_w / total_w[g_sort] * 100
+
+	# Interpolate the value of a at the given percentiles in each group, matching np.interp
+	start = starts[filled]; end = start + counts[filled] - 1
+	for k,percent in enumerate(percentiles):
+		# Number of points in each group at or below this percentile
+		below = np.bincount(g_sort[p <= percent], minlength=num_groups)[filled]
+		lo = np.clip(start + below - 1, start, end)
+		hi = np.minimum(lo + 1, end)
+		interior = np.logical_and(below > 0, below < counts[filled])
+		vals = a_sort[lo].astype(np.float64)
+		slope = (a_sort[hi[interior]] - a_sort[lo[interior]]) / (p[hi[interior]] - p[lo[interior]])
+		vals[interior] += slope * (percent - p[lo[interior]])
+		vals[below == 0] = a_sort[start[below == 0]]
+		values[filled,k] = vals
+
+	return values
+
+
+def binned_percentiles(a, bin_data, bins, percentiles=np.array([50, 16, 84]), weights=None, interpolation='weighted', right=False):
+	"""
+	Percentiles of a (possibly weighted) array in each bin of another quantity, such as D/Z in bins of density
+
+	Parameters
+	----------
+	a : array-like
+	    The input array from which to calculate percents
+	bin_data : array-like
+		Values binned for each element of a
+	bins : array
+		Bin edges, values outside of them are ignored
+	percentiles : array-like
+	    The percentiles to calculate (0.0 - 100.0)
+	weights : array-like, optional
+	    The weights to assign to values of a.  Equal weighting if None
+	    is specified
+	interpolation : string
+		How to interpolate percentiles, see grouped_weighted_percentile
+	right : bool
+		Bins include their right edge instead of their left edge, as in np.digitize
+
+	Returns
+	-------
+	values : np.array
+	    The values associated with the specified percentiles for each of the len(bins)-1 bins. Empty bins are NaN.
+	"""
+
+	digitized = np.digitize(bin_data, bins, right=right)
+	return grouped_weighted_percentile(a, digitized-1, len(bins)-1, percentiles=percentiles, weights=weights, interpolation=interpolation)
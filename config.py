@@ -37,6 +37,8 @@ SMALL_FONT					= 20
 LARGE_FONT					= 26
 
 ELEMENTS					= ['Z','He','C','N','O','Ne','Mg','Si','S','Ca','Fe']
+# Dust species in the order they are stored in a snapshot
+SPECIES_NAMES				= ['Silicates','Carbon','SiC','Iron','O Reservoir']
 
 # Houses labels, limits, and if they should be plotted in log space for possible parameters
 PARAM_INFO  				= {'fH2': [r'$f_{H2}$', 									[0,1.], 		False],
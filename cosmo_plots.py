@@ -1,4 +1,5 @@
-from readsnap import readsnap
+from readsnap import readsnap, prefetch_snapshots, build_header_catalog, catalog_header
+from halo_tracks import load_halo_track, halo_properties
 from dust_plots import *
 from astropy.table import Table
 import os
@@ -36,20 +37,25 @@ for i,snap_dir in enumerate(snap_dirs):
 	name = names[i]
 	print(name)
 
-	# Load in halohistory data for main halo. All values should be in code units
-	halo_data = Table.read(halo_dir + halo_name,format='ascii')
+	# Headers for the whole run are read once and looked up for each snapshot
+	headers = build_header_catalog(snap_dir)
 
-	for num in range(startnum,endnum+1):
+	# Load in halohistory data for main halo, matched to the snapshots of the run
+	halo_track = load_halo_track(halo_dir + halo_name, snap_dir=snap_dir)
+
+	# The next snapshots are read in the background while the plots for this one are made
+	for num, snap in prefetch_snapshots(snap_dir, range(startnum,endnum+1), ptypes=[0], header=False, cosmological=cosmological):
 		print(num)
 
-		H = readsnap(snap_dir, num, 0, header_only=1, cosmological=cosmological)
-		G = readsnap(snap_dir, num, 0, cosmological=cosmological)
+		H = catalog_header(headers, num, cosmological=cosmological)
+		G = snap[0]
 
-		xpos =  halo_data['col7'][num-1]*H['time']/H['hubble']
-		ypos =  halo_data['col8'][num-1]*H['time']/H['hubble']
-		zpos =  halo_data['col9'][num-1]*H['time']/H['hubble']
-		rvir = halo_data['col13'][num-1]*H['time']/H['hubble']
-		center = np.array([xpos,ypos,zpos])
+		halo = halo_properties(halo_track, num, H)
+		if halo['k']==-1:
+			print("Halo not found in snapshot", num)
+			continue
+		center = halo['center']
+		rvir = halo['Rvir']
 
 		DZ_vs_r([G], [H], [center], [rvir], bin_nums=50, time=True, foutname=image_dir+sub_dir+name+'_DZ_vs_r_%03d.png' % num)
 
@@ -24,9 +24,6 @@ try:
 except:
     print "Directory " + image_dir +  " already exists"
 
-# Load in halohistory data for main halo. All values should be in code units
-halo_data = Table.read(halo_dir + halo_name,format='ascii')
-
 # First and last snapshot numbers
 startnum = 10
 endnum = 598
@@ -34,6 +31,9 @@ endnum = 598
 # Maximum radius used for getting data
 r_max = 5 # kpc
 
+# Number of processes the snapshots are compiled over, should match the cores requested in precompile.pbs
+workers = 16
+
 data_names = []
 
 for i,snap_dir in enumerate(snap_dirs):
@@ -42,12 +42,9 @@ for i,snap_dir in enumerate(snap_dirs):
 	print(name)
 	halo_dir = halo_dirs[i]
 
-	# Load in halohistory data for main halo. All values should be in code units
-	halo_data = Table.read(halo_dir + halo_name,format='ascii')
-
-	dataname = implementation+'_'+name+'_data_'+str(r_max)+'_kpc.pickle'
+	dataname = implementation+'_'+name+'_data_'+str(r_max)+'_kpc.hdf5'
 	data_names += [dataname]
-	compile_dust_data(snap_dir, foutname=dataname, mask=True, overwrite=True, halo_dir=halo_dir+halo_name, cosmological=cosmological, r_max=r_max, startnum=startnum, endnum=endnum, implementation=implementation)
+	compile_dust_data(snap_dir, foutname=dataname, mask=True, overwrite=True, halo_dir=halo_dir+halo_name, cosmological=cosmological, r_max=r_max, startnum=startnum, endnum=endnum, implementation=implementation, workers=workers, resume=True)
 
 	# Plot precompiled data
 	DZ_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_DZ_vs_time.png')
@@ -0,0 +1,79 @@
+import numpy as np
+import weakref
+from config import *
+import gas_temperature as gas_temp
+from galaxy_selection import array_fingerprint
+
+# Derived gas fields already computed, by field name and the snapshot arrays they were computed from.
+# Entries hold weak references to and fingerprints of those arrays, so a field is recomputed once its
+# source arrays are replaced (e.g. masked) or marked as edited in place with array_changed, and never reused
+# for another snapshot. Checking an entry only compares ids and fingerprints, it never reads the arrays.
+DERIVED_CACHE = {}
+# Number of derived fields to keep before the oldest are dropped
+DERIVED_CACHE_SIZE = 64
+
+
+def derived_field(G, name, keys, calc):
+	"""
+	Returns calc(), computing it only the first time it is asked for with the same snapshot arrays.
+	The result is shared between callers so it is made read-only.
+
+	Parameters
+	----------
+	G : dict
+	    Snapshot gas data structure
+	name : string
+		Name of the derived field
+	keys : list
+		Fields of G the derived field is calculated from
+	calc : function
+		Calculates the derived field
+
+	Returns
+	-------
+	field : array or tuple of arrays
+		The derived field
+	"""
+
+	sources = [G[key] for key in keys]
+	cache_key = (name,) + tuple([id(source) for source in sources])
+	if cache_key in DERIVED_CACHE:
+		refs, fingerprints, field = DERIVED_CACHE[cache_key]
+		if all([ref() is source for ref,source in zip(refs,sources)]) and \
+		   fingerprints == [array_fingerprint(source) for source in sources]:
+			return field
+
+	field = calc()
+	for array in (field if isinstance(field, tuple) else (field,)):
+		array.flags.writeable = False
+
+	# Drop fields whose snapshot arrays no longer exist before adding more
+	for old_key in list(DERIVED_CACHE.keys()):
+		if any([ref() is None for ref in DERIVED_CACHE[old_key][0]]):
+			del DERIVED_CACHE[old_key]
+	while len(DERIVED_CACHE) >= DERIVED_CACHE_SIZE:
+		del DERIVED_CACHE[next(iter(DERIVED_CACHE))]
+	DERIVED_CACHE[cache_key] = ([weakref.ref(source) for source in sources], \
+	                            [array_fingerprint(source) for source in sources], field)
+	return field
+
+
+def calc_temperature(G):
+	"""
+	Gas temperature in Kelvin
+	"""
+
+	return derived_field(G, 'T', ['u','ne','z'], lambda: gas_temp.gas_temperature(G))
+
+
+def calc_nH(G, depletion=False):
+	"""
+	Number density of Hydrogen in cm^-3. With depletion the dust is not included in the gas
+	metallicity, so it is removed from the Hydrogen mass fraction as well.
+	"""
+
+	if depletion:
+		return derived_field(G, 'nH_depl', ['rho','z','dz'], lambda: \
+			G['rho']*UnitDensity_in_cgs * ( 1. - (G['z'][:,0]+G['z'][:,1]+G['dz'][:,0])) / H_MASS)
+	return derived_field(G, 'nH', ['rho','z'], lambda: \
+		G['rho']*UnitDensity_in_cgs * ( 1. - (G['z'][:,0]+G['z'][:,1])) / H_MASS)
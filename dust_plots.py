@@ -7,9 +7,16 @@ from scipy.stats import binned_statistic_2d
 from scipy.optimize import curve_fit
 import pickle
 import os
-from readsnap import readsnap
-from astropy.table import Table
-import gas_temperature as gas_temp
+import shutil
+import multiprocessing
+from readsnap import readsnap, load_snapshot, prefetch_snapshots, build_header_catalog, catalog_header
+from galaxy_selection import *
+from binned_stats import *
+from projection import *
+from derived_fields import *
+from time_series import *
+from shards import *
+from halo_tracks import *
 from tasz import *
 from observations import *
 from analytic_dust_yields import *
@@ -18,20 +25,6 @@ import plot_setup as plt_set
 from config import *
 
 
-def calc_rotate_matrix(vec1, vec2):
-	""""
-	Gives the rotation matrix between two unit vectors
-	"""
-	a, b = (vec1 / np.linalg.norm(vec1)).reshape(3), (vec2 / np.linalg.norm(vec2)).reshape(3)
-	v = np.cross(a, b)
-	c = np.dot(a, b)
-	s = np.linalg.norm(v)
-	kmat = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
-	rotation_matrix = np.eye(3) + kmat + kmat.dot(kmat) * ((1 - c) / (s ** 2))
-	return rotation_matrix
-
-
-
 def weighted_percentile(a, percentiles=np.array([50, 16, 84]), weights=None):
 	"""
 	Calculates percentiles associated with a (possibly weighted) array
@@ -65,7 +58,8 @@ def weighted_percentile(a, percentiles=np.array([50, 16, 84]), weights=None):
 	w_sort = weights[idx]
 
 	# Get the percentiles for each data point in array
-	p=1.*w_sort.cumsum()/w_sort.sum()*100
+	# Accumulate in double precision since single precision weights lose accuracy over many particles
+	p=1.*w_sort.cumsum(dtype=np.float64)/w_sort.sum(dtype=np.float64)*100
 	# Get the value of a at the given percentiles
 	values=np.interp(percentiles, p, a_sort)
 	return values
@@ -213,6 +207,16 @@ def DZ_vs_params(params, param_lims, gas, header, center_list, r_max_list, Lz_li
 	# Set up subplots based on number of parameters given
 	fig,axes = plt_set.setup_figure(len(params))
 
+	# Get D/Z vs all parameters for each snapshot at once
+	profiles = []
+	for j in range(len(gas)):
+		G = gas[j]; center = center_list[j]; r_max = r_max_list[j]; 
+		if Lz_list != None:
+			Lz_hat = Lz_list[j]; disk_height = height_list[j];
+		else:
+			Lz_hat = None; disk_height = None;
+		profiles += [calc_binned_profiles(params, param_lims, ['DZ'], G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, depletion=depletion)]
+
 	for i, x_param in enumerate(params):
 		# Set up for each plot
 		axis = axes[i]
@@ -226,13 +230,8 @@ def DZ_vs_params(params, param_lims, gas, header, center_list, r_max_list, Lz_li
 			plot_observational_data(axis, x_param, log=log, CO_opt=CO_opt, goodSNR=True)
 
 		for j in range(len(gas)):
-			G = gas[j]; H = header[j]; center = center_list[j]; r_max = r_max_list[j]; 
-			if Lz_list != None:
-				Lz_hat = Lz_list[j]; disk_height = height_list[j];
-			else:
-				Lz_hat = None; disk_height = None;
-
-			mean_DZ,std_DZ,param_vals = calc_DZ_vs_param(x_param, x_lim, G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, depletion=depletion)
+			H = header[j]
+			mean_DZ,std_DZ,param_vals = profiles[j][(x_param,y_param)]
 			# Replace zeros with small values since we are taking the log of the values
 			if log:
 				std_DZ[std_DZ == 0] = EPSILON
@@ -265,14 +264,24 @@ def DZ_vs_params(params, param_lims, gas, header, center_list, r_max_list, Lz_li
 	plt.close()	
 
 
-def calc_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_height=5, bin_nums=50, depletion=False):
+def calc_binned_profiles(x_params, x_lims, y_params, G, center, r_max, Lz_hat=None, disk_height=5, bin_nums=50, depletion=False, \
+	                 linear_bins=None):
 	"""
-	Calculate the average dust-to-metals ratio (D/Z) vs radius, density, and Z given code values of center and virial radius for multiple simulations/snapshots
+	Calculate the median and 16th and 84th percentiles of multiple quantities binned in multiple parameters at once.
+	The galaxy is selected, derived fields are calculated, and the bins of each parameter are found only once,
+	and the values of each quantity are only sorted once no matter how many parameters they are binned in.
 
 	Parameters
 	----------
-	param: string
-		Name of parameter to get D/Z values for
+	x_params: array
+		Names of parameters to bin values in (nH, T, r, r25, Z, fH2)
+	x_lims: array
+		Limits of the bins for each parameter in x_params
+	y_params: array
+		Names of quantities to get the binned values of
+		'DZ' - total dust-to-metals ratio
+		element name (e.g. 'C', 'Si') - dust-to-metals ratio of the element, one minus its depletion
+		species name (e.g. 'Silicates', 'Carbon') - fraction of the dust mass in the species
 	G : dict
 	    Snapshot gas data structure
 	center : array
@@ -287,173 +296,148 @@ def calc_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_heig
 		Number of bins to use
 	depletion : bool, optional
 		Was the simulation run with the DEPLETION option
+	linear_bins : array, optional
+		Parameters in x_params to bin linearly instead of logarithmically (e.g. fH2)
 	Returns
 	-------
-	mean_DZ : array
-		Array of mean D/Z values vs parameter given
-	std_DZ : array
-		Array of 16th and 84th percentiles D/Z values
-	param_vals : array
-		Parameter values D/Z values are taken over
-	"""	
-
-	param_min = param_lims[0]; param_max = param_lims[1]; 
+	profiles : dict
+		For each (x_param, y_param) pair the median values, 16th and 84th percentiles, and parameter values
+		they are taken over
+	"""
 
-	coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-	coords -= center
 	# Get only data of particles in sphere/disk since those are the ones we care about
 	# Also gives a nice speed-up
-	# Get paticles in disk
-	if Lz_hat != None:
-		zmag = np.dot(coords,Lz_hat)
-		r_z = np.zeros(np.shape(coords))
-		r_z[:,0] = zmag*Lz_hat[0]
-		r_z[:,1] = zmag*Lz_hat[1]
-		r_z[:,2] = zmag*Lz_hat[2]
-		r_s = np.subtract(coords,r_z)
-		smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-		in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-	# Get particles in sphere otherwise
-	else:
-		in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+	in_galaxy = select_galaxy(G['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 	M = G['m'][in_galaxy]*1E10
-	coords = coords[in_galaxy]
-	if depletion:
-		DZ = (G['dz'][:,0]/(G['z'][:,0]+G['dz'][:,0]))[in_galaxy]
-	else:
-		DZ = (G['dz'][:,0]/G['z'][:,0])[in_galaxy]
-
-	mean_DZ = np.zeros(bin_nums - 1)
-	# 16th and 84th percentiles
-	std_DZ = np.zeros([bin_nums - 1,2])
-
-	# Get D/Z values over number density of Hydrogen (nH)
-	if param == 'nH':
-		if depletion:
-			nH = G['rho'][in_galaxy]*UnitDensity_in_cgs * ( 1. - (G['z'][:,0][in_galaxy]+G['z'][:,1]+G['dz'][:,0][in_galaxy])) / H_MASS
-		else:
-			nH = G['rho'][in_galaxy]*UnitDensity_in_cgs * ( 1. - (G['z'][:,0][in_galaxy]+G['z'][:,1][in_galaxy])) / H_MASS
-
-		# Make bins for nH 
-		nH_bins = np.logspace(np.log10(param_min),np.log10(param_max),bin_nums)
-		param_vals = (nH_bins[1:] + nH_bins[:-1]) / 2.
-		digitized = np.digitize(nH,nH_bins)
-
-		for j in range(1,len(nH_bins)):
-			if len(nH[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				weights = M[digitized == j]
-				values = DZ[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=weights)
-
-	# Get D/Z values over gas temperature
-	elif param == 'T':
-		T = gas_temp.gas_temperature(G)
-		T = T[in_galaxy]
 
-		# Make bins for T
-		T_bins = np.logspace(np.log10(param_min),np.log10(param_max),bin_nums)
-		param_vals = (T_bins[1:] + T_bins[:-1]) / 2.
-		digitized = np.digitize(T,T_bins)
-
-		for j in range(1,len(T_bins)):
-			if len(T[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
+	# Bin of each particle for each parameter
+	x_bins = {}
+	for x_param, x_lim in zip(x_params, x_lims):
+		param_min = x_lim[0]; param_max = x_lim[1];
+
+		# Number density of Hydrogen (nH)
+		if x_param == 'nH':
+			param_data = calc_nH(G, depletion=depletion)[in_galaxy]
+		# Gas temperature
+		elif x_param == 'T':
+			param_data = calc_temperature(G)[in_galaxy]
+		# Radius of galaxy from the center, binned below from the particle radii
+		elif x_param == 'r' or x_param == 'r25':
+			param_data = None
+		# Total metallicty of gas
+		elif x_param == 'Z':
+			solar_Z = 0.02
+			if depletion:
+				param_data = (G['z'][:,0]+G['dz'][:,0])[in_galaxy]/solar_Z
 			else:
-				weights = M[digitized == j]
-				values = DZ[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=weights)
+				param_data = G['z'][:,0][in_galaxy]/solar_Z
+		# H2 mass fraction of gas
+		elif x_param == 'fH2':
+			NH1,NHion,NH2 = calc_H_fracs(G)
+			param_data = 2*NH2[in_galaxy]/(NH1[in_galaxy]+2*NH2[in_galaxy])
+		else:
+			print("Parameter given to calc_binned_profiles is not supported:",x_param)
+			continue
 
-	# Get D/Z valus over radius of galaxy from the center
-	elif param == 'r' or param == 'r25':
-		r_bins = np.linspace(0, r_max, num=bin_nums)
-		param_vals = (r_bins[1:] + r_bins[:-1]) / 2.
+		if x_param == 'r' or x_param == 'r25':
+			param_bins = np.linspace(0, r_max, num=bin_nums)
+		elif linear_bins is not None and x_param in linear_bins:
+			param_bins = np.linspace(param_min,param_max,bin_nums)
+		else:
+			param_bins = np.logspace(np.log10(param_min),np.log10(param_max),bin_nums)
+
+		param_vals = (param_bins[1:] + param_bins[:-1]) / 2.
+		if x_param == 'r' or x_param == 'r25':
+			# Particles in each annulus if disk or shell if sphere, from one sort of their radii
+			shells = radial_shells(G['p'], center, param_bins, Lz_hat=Lz_hat, disk_height=disk_height, subset=in_galaxy)
+			bin_num = np.full(len(M), -1)
+			for j in range(bin_nums-1):
+				bin_num[shells[j]] = j
+		else:
+			bin_num = np.digitize(param_data,param_bins) - 1
+		x_bins[x_param] = (bin_num, param_vals)
 
-		for j in range(bin_nums-1):
-			# find all coordinates within shell
-			r_min = r_bins[j]; r_max = r_bins[j+1];
-
-			# If disk get particles in annulus
-			if Lz_hat!=None:
-				zmag = np.dot(coords,Lz_hat)
-				r_z = np.zeros(np.shape(coords))
-				r_z[:,0] = zmag*Lz_hat[0]
-				r_z[:,1] = zmag*Lz_hat[1]
-				r_z[:,2] = zmag*Lz_hat[2]
-				r_s = np.subtract(coords,r_z)
-				smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-				in_shell = np.where((np.abs(zmag) <= disk_height) & (smag <= r_max) & (smag > r_min))
-			# Else get particles in shell
+	profiles = {}
+	for y_param in y_params:
+		values_only = None
+		if y_param == 'DZ':
+			if depletion:
+				values = (G['dz'][:,0]/(G['z'][:,0]+G['dz'][:,0]))[in_galaxy]
 			else:
-				in_shell = np.logical_and(np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.), np.sum(np.power(coords,2),axis=1) > np.power(r_min,2.))
-			weights = M[in_shell]
-			values = DZ[in_shell]
-			if len(values) > 0:
-				mean_DZ[j],std_DZ[j,0],std_DZ[j,1] = weighted_percentile(values, weights=weights)
+				values = (G['dz'][:,0]/G['z'][:,0])[in_galaxy]
+		elif y_param in ELEMENTS:
+			elem_indx = ELEMENTS.index(y_param)
+			if depletion:
+				values = (G['dz'][:,elem_indx]/(G['z'][:,elem_indx]+G['dz'][:,elem_indx]))[in_galaxy]
 			else:
-				mean_DZ[j] = np.nan
-				std_DZ[j,0] = np.nan; std_DZ[j,1] = np.nan;
-
-	# Get D/Z values vs total metallicty of gas
-	elif param == 'Z':
-		solar_Z = 0.02
-		if depletion:
-			Z = (G['z'][:,0]+G['dz'][:,0])[in_galaxy]/solar_Z
+				values = (G['dz'][:,elem_indx]/G['z'][:,elem_indx])[in_galaxy]
+			# Deal with DZ>1 values
+			values[values>1] = 1.
+		elif y_param in SPECIES_NAMES:
+			values = (G['spec'][:,SPECIES_NAMES.index(y_param)]/G['dz'][:,0])[in_galaxy]
+			# Need to leave out nan and inf values for percentiles to work
+			values_only = np.isfinite(values)
 		else:
-			Z = G['z'][:,0][in_galaxy]/solar_Z
+			print("Quantity given to calc_binned_profiles is not supported:",y_param)
+			continue
 
-		Z_bins = np.logspace(np.log10(param_min),np.log10(param_max),bin_nums)
-		param_vals = (Z_bins[1:] + Z_bins[:-1]) / 2.
-		digitized = np.digitize(Z,Z_bins)
+		# Sort values once for all parameters
+		order = np.argsort(values)
+		for x_param in x_bins:
+			bin_num, param_vals = x_bins[x_param]
+			if values_only is not None:
+				bin_num = np.where(values_only, bin_num, -1)
+			percentiles = grouped_weighted_percentile(values, bin_num, len(param_vals), weights=M, order=order)
+			profiles[(x_param, y_param)] = (percentiles[:,0], percentiles[:,1:], param_vals)
 
-		for j in range(1,len(Z_bins)):
-			if len(Z[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				weights = M[digitized == j]
-				values = DZ[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=weights)
-	# Get D/Z values vs H2 mass fraction of gas
-	elif param == 'fH2':
-		NH1,NHion,NH2 = calc_H_fracs(G)
-		fH2 = 2*NH2[in_galaxy]/(NH1[in_galaxy]+2*NH2[in_galaxy])
-		fH2_bins = np.logspace(np.log10(param_min),np.log10(param_max),bin_nums)
-		param_vals = (fH2_bins[1:] + fH2_bins[:-1]) / 2.
-		digitized = np.digitize(fH2,fH2_bins)
+	return profiles
 
-		if depletion:
-			nH = G['rho'][in_galaxy]*UnitDensity_in_cgs * ( 1. - (G['z'][:,0][in_galaxy]+G['z'][:,1]+G['dz'][:,0][in_galaxy])) / H_MASS
-		else:
-			nH = G['rho'][in_galaxy]*UnitDensity_in_cgs * ( 1. - (G['z'][:,0][in_galaxy]+G['z'][:,1][in_galaxy])) / H_MASS
 
+def calc_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_height=5, bin_nums=50, depletion=False):
+	"""
+	Calculate the average dust-to-metals ratio (D/Z) vs radius, density, and Z given code values of center and virial radius for multiple simulations/snapshots
 
-		for j in range(1,len(fH2_bins)):
-			if len(fH2[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				weights = M[digitized == j]
-				values = DZ[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=weights)
-	else:
-		print("Parameter given to calc_DZ_vs_param is not supported:",param)
+	Parameters
+	----------
+	param: string
+		Name of parameter to get D/Z values for
+	G : dict
+	    Snapshot gas data structure
+	center : array
+		3-D coordinate of center of circle
+	r_max : double
+		maximum radii of gas particles to use
+	Lz_hat: array
+		Unit vector of Lz to be used to mask only 
+	disk_height: double
+		Height of disk to mask if Lz_hat is given, default is 5 kpc
+	bin_nums : int
+		Number of bins to use
+	depletion : bool, optional
+		Was the simulation run with the DEPLETION option
+	Returns
+	-------
+	mean_DZ : array
+		Array of mean D/Z values vs parameter given
+	std_DZ : array
+		Array of 16th and 84th percentiles D/Z values
+	param_vals : array
+		Parameter values D/Z values are taken over
+	"""	
+
+	profiles = calc_binned_profiles([param], [param_lims], ['DZ'], G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, \
+	                                bin_nums=bin_nums, depletion=depletion)
+	if (param,'DZ') not in profiles:
 		return None,None,None
 
-	return mean_DZ, std_DZ, param_vals
+	return profiles[(param,'DZ')]
 
 
 def observed_DZ_vs_param(params, param_lims, gas, header, center_list, r_max_list, Lz_list=None, \
 			height_list=None, bin_nums=50, time=False, depletion=False, cosmological=True, labels=None, \
-			foutname='obs_DZ_vs_param.png', std_bars=True, style='color', log=True, include_obs=True, CO_opt='S12'):
+			foutname='obs_DZ_vs_param.png', std_bars=True, style='color', log=True, include_obs=True, CO_opt='S12', smooth=False, nproc=1, \
+			inclination=0., position_angle=0.):
 	"""
 	Plots mock observations of dust-to-metals vs various parameters for multiple simulations 
 
@@ -489,6 +473,14 @@ def observed_DZ_vs_param(params, param_lims, gas, header, center_list, r_max_lis
 		Plot log of D/Z
 	include_obs : boolean
 		Overplot observed data if available
+	smooth : boolean
+		Spread particles over pixels with their SPH kernels instead of binning them as points
+	nproc : int
+		Number of processes used to make the smoothed maps
+	inclination : double
+		Inclination of the line of sight in degrees, 0 is face-on to the disk if Lz_list is given
+	position_angle : double
+		Position angle of the images in degrees
 
 	Returns
 	-------
@@ -519,7 +511,8 @@ def observed_DZ_vs_param(params, param_lims, gas, header, center_list, r_max_lis
 			else:
 				Lz_hat = None; disk_height = None;
 
-			mean_DZ,std_DZ,param_vals = calc_obs_DZ_vs_param(x_param, x_lim, G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, depletion=depletion)
+			mean_DZ,std_DZ,param_vals = calc_obs_DZ_vs_param(x_param, x_lim, G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, depletion=depletion, \
+			                                                 smooth=smooth, nproc=nproc, inclination=inclination, position_angle=position_angle)
 			# Replace zeros with small values since we are taking the log of the values
 			if log:
 				std_DZ[std_DZ == 0] = EPSILON
@@ -550,7 +543,8 @@ def observed_DZ_vs_param(params, param_lims, gas, header, center_list, r_max_lis
 	plt.close()	
 
 
-def calc_obs_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_height=5, param_bins=50, pixel_res = 2, depletion=False):
+def calc_obs_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_height=5, param_bins=50, pixel_res = 2, depletion=False, \
+			smooth=False, nproc=1, inclination=0., position_angle=0.):
 	"""
 	Calculate the average dust-to-metals ratio vs radius, gas , H2 , metal, or dust surface density
 	given code values of center and viewing direction for multiple simulations/snapshots
@@ -575,6 +569,14 @@ def calc_obs_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_
 		Size resolution of each pixel bin in kpc
 	depletion : bool, optional
 		Was the simulation run with the DEPLETION option
+	smooth : bool, optional
+		Spread particles over pixels with their SPH kernels instead of binning them as points
+	nproc : int, optional
+		Number of processes used to make the smoothed maps
+	inclination : double, optional
+		Inclination of the line of sight in degrees, 0 is face-on to the disk if Lz_hat is given
+	position_angle : double, optional
+		Position angle of the image in degrees
 	Returns
 	-------
 	mean_surf_dens : array
@@ -585,36 +587,56 @@ def calc_obs_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_
 		Parameter values dust surface density values are taken over
 	"""	
 
-	param_min = param_lims[0]; param_max = param_lims[1]; 
+	galaxy = calc_obs_galaxy(G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, depletion=depletion, smooth=smooth)
+	return calc_obs_DZ_in_view(param, param_lims, galaxy, r_max, view_rotation(Lz_hat, inclination, position_angle), \
+	                           param_bins=param_bins, pixel_res=pixel_res, smooth=smooth, nproc=nproc)
+
+
+def calc_obs_galaxy(G, center, r_max, Lz_hat=None, disk_height=5, depletion=False, smooth=False):
+	"""
+	The parts of a mock observation that don't depend on the viewing angle: the gas in the galaxy, its positions
+	relative to the center, and its metal, dust, gas, H2, and HI masses. See calc_obs_DZ_vs_param for the parameters.
+
+	Returns
+	-------
+	galaxy : dict
+		'offsets' positions relative to center, 'h' smoothing lengths if smooth, and 'masses' list of the metal,
+		dust, gas, H2, and HI masses of each particle in the galaxy
+	"""
 
-	coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-	coords -= center
 	# Get only data of particles in sphere/disk since those are the ones we care about
 	# Also gives a nice speed-up
-	# Get paticles in disk
-	if Lz_hat != None:
-		zmag = np.dot(coords,Lz_hat)
-		r_z = np.zeros(np.shape(coords))
-		r_z[:,0] = zmag*Lz_hat[0]
-		r_z[:,1] = zmag*Lz_hat[1]
-		r_z[:,2] = zmag*Lz_hat[2]
-		r_s = np.subtract(coords,r_z)
-		smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-		in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-	# Get particles in sphere otherwise
-	else:
-		in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+	in_galaxy = select_galaxy(G['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 	NH1,NHion,NH2=calc_H_fracs(G)
 	NH1=NH1[in_galaxy];NHion=NHion[in_galaxy];NH2=NH2[in_galaxy];
 	M = G['m'][in_galaxy]*1E10
-	coords = coords[in_galaxy]
 	dust_mass = G['dz'][in_galaxy,0]*M
 	if depletion:
 		Z_mass = G['z'][in_galaxy,0] * M + dust_mass
 	else:
 		Z_mass = G['z'][in_galaxy,0] * M
 
+	MH1 = NH1*H_MASS*Grams_to_Msolar
+	MH2 = 2*NH2*H_MASS*Grams_to_Msolar
+
+	galaxy = {'offsets': G['p'][in_galaxy]-center, 'masses': [Z_mass,dust_mass,M,MH2,MH1]}
+	if smooth:
+		galaxy['h'] = G['h'][in_galaxy]
+	return galaxy
+
+
+def calc_obs_DZ_in_view(param, param_lims, galaxy, r_max, rotation, param_bins=50, pixel_res=2, smooth=False, nproc=1):
+	"""
+	Mock observation of the dust-to-metals ratio vs a parameter for one view of a galaxy from calc_obs_galaxy. See
+	calc_obs_DZ_vs_param for the parameters and returns, rotation is the matrix from view_rotation.
+	"""
+
+	param_min = param_lims[0]; param_max = param_lims[1]; 
+
+	# Coordinates in the frame of the observation, the image is the x-y plane
+	coords = view_coords(galaxy['offsets'], None, rotation)
+
 	x = coords[:,0];y=coords[:,1];
 	pixel_bins = int(np.ceil(2*r_max/pixel_res))
 	x_bins = np.linspace(-r_max,r_max,pixel_bins)
@@ -622,179 +644,157 @@ def calc_obs_DZ_vs_param(param, param_lims, G, center, r_max, Lz_hat=None, disk_
 	x_vals = (x_bins[1:] + x_bins[:-1]) / 2.
 	y_vals = (y_bins[1:] + y_bins[:-1]) / 2.
 	pixel_area = pixel_res**2 * 1E6 # area of pixel in pc^2
-	
-	mean_DZ = np.zeros(param_bins - 1)
-	std_DZ = np.zeros([param_bins - 1,2])
 
+	# Make the metal, dust, gas, H2, and HI mass maps all at once
+	if smooth:
+		ret = project_maps(coords, galaxy['h'], galaxy['masses'], x_bins, y_bins, nproc=nproc)
+	else:
+		ret = binned_statistic_2d(x, y, galaxy['masses'], statistic='sum', bins=[x_bins,y_bins]).statistic
+	DZ_pixel = ret[1].flatten()/ret[0].flatten()
 
 	if param == 'sigma_dust':
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass], statistic=np.sum, bins=[x_bins,y_bins]).statistic
-		DZ_pixel = ret[1].flatten()/ret[0].flatten()
 		dust_pixel = ret[1].flatten()/pixel_area
 
 		# Now bin the data 
 		dust_bins = np.logspace(np.log10(param_min),np.log10(param_max),param_bins)
 		param_vals = (dust_bins[1:] + dust_bins[:-1]) / 2.
-		digitized = np.digitize(dust_pixel,dust_bins)
-
-		for j in range(1,len(dust_bins)):
-			if len(dust_pixel[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				values = DZ_pixel[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=None)
+		DZ_percentiles = binned_percentiles(DZ_pixel, dust_pixel, dust_bins)
 
 	elif param=='sigma_gas':
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass,M], statistic=np.sum, bins=[x_bins,y_bins]).statistic
-		DZ_pixel = ret[1].flatten()/ret[0].flatten()
 		M_pixel = ret[2].flatten()/pixel_area
 
 		# Now bin the data 
 		gas_bins = np.logspace(np.log10(param_min),np.log10(param_max),param_bins)
 		param_vals = (gas_bins[1:] + gas_bins[:-1]) / 2.
-		digitized = np.digitize(M_pixel,gas_bins)
-
-		for j in range(1,len(gas_bins)):
-			if len(M_pixel[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				values = DZ_pixel[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=None)
+		DZ_percentiles = binned_percentiles(DZ_pixel, M_pixel, gas_bins)
 
 	elif param=='sigma_H2':
-		MH2=2*NH2*H_MASS*Grams_to_Msolar
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass,MH2], statistic=np.sum, bins=[x_bins,y_bins]).statistic
-		DZ_pixel = ret[1].flatten()/ret[0].flatten()
-		MH2_pixel = ret[2].flatten()/pixel_area
+		MH2_pixel = ret[3].flatten()/pixel_area
 
 		# Now bin the data 
 		gas_bins = np.logspace(np.log10(param_min),np.log10(param_max),param_bins)
 		param_vals = (gas_bins[1:] + gas_bins[:-1]) / 2.
-		digitized = np.digitize(MH2_pixel,gas_bins)
-
-		for j in range(1,len(gas_bins)):
-			if len(MH2_pixel[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				values = DZ_pixel[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=None)
+		DZ_percentiles = binned_percentiles(DZ_pixel, MH2_pixel, gas_bins)
 
 	elif param == 'r':
-		mean_DZ = np.zeros(pixel_bins/2 - 1)
-		std_DZ = np.zeros([pixel_bins/2 - 1,2])
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass], statistic=np.sum, bins=[x_bins,y_bins],expand_binnumbers=True)
-		DZ_pixel = ret.statistic[1].flatten()/ret.statistic[0].flatten()
 		# Get the average r coordinate for each pixel in kpc
 		pixel_r_vals = np.array([np.sqrt(np.power(np.abs(y_vals),2) + np.power(np.abs(x_vals[k]),2)) for k in range(len(x_vals))]).flatten()
 
 		r_bins = np.linspace(0, r_max, num=pixel_bins/2)
 		param_vals = (r_bins[1:] + r_bins[:-1]) / 2.
-
-		for j in range(pixel_bins/2-1):
-			# find all coordinates within shell
-			r_min = r_bins[j]; r_max = r_bins[j+1];
-			in_shell = np.where((pixel_r_vals <= r_max) & (pixel_r_vals > r_min))
-			values = DZ_pixel[in_shell]
-			if len(values) > 0:
-				mean_DZ[j],std_DZ[j,0],std_DZ[j,1] = weighted_percentile(values, weights=None)
-			else:
-				mean_DZ[j] = np.nan
-				std_DZ[j,0] = np.nan; std_DZ[j,1] = np.nan;
+		# Pixels in each shell r_min < r <= r_max
+		DZ_percentiles = binned_percentiles(DZ_pixel, pixel_r_vals, r_bins, right=True)
 
 	elif param == 'fH2':
-		MH1=NH1*H_MASS*Grams_to_Msolar
-		MH2=2*NH2*H_MASS*Grams_to_Msolar
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass,MH2,MH1], statistic=np.sum, bins=[x_bins,y_bins]).statistic
-		DZ_pixel = ret[1].flatten()/ret[0].flatten()
-		fH2_pixel = ret[2].flatten()/(ret[2].flatten()+ret[3].flatten())
+		fH2_pixel = ret[3].flatten()/(ret[3].flatten()+ret[4].flatten())
 
 		# Now bin the data 
 		fH2_bins = np.linspace(param_min,param_max,param_bins)
 		param_vals = (fH2_bins[1:] + fH2_bins[:-1]) / 2.
-		digitized = np.digitize(fH2_pixel,fH2_bins)
-
-		for j in range(1,len(fH2_bins)):
-			if len(fH2_pixel[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				values = DZ_pixel[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=None)
+		DZ_percentiles = binned_percentiles(DZ_pixel, fH2_pixel, fH2_bins)
 
 	elif param == 'sigma_Z':
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass], statistic=np.sum, bins=[x_bins,y_bins]).statistic
-		DZ_pixel = ret[1].flatten()/ret[0].flatten()
 		Z_pixel = ret[0].flatten()/pixel_area
 
 		# Now bin the data 
 		Z_bins = np.logspace(np.log10(param_min),np.log10(param_max),param_bins)
 		param_vals = (Z_bins[1:] + Z_bins[:-1]) / 2.
-		digitized = np.digitize(Z_pixel,Z_bins)
-
-		for j in range(1,len(Z_bins)):
-			if len(Z_pixel[digitized==j])==0:
-				mean_DZ[j-1] = np.nan
-				std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-				continue
-			else:
-				values = DZ_pixel[digitized == j]
-				mean_DZ[j-1],std_DZ[j-1,0],std_DZ[j-1,1] = weighted_percentile(values, weights=None)
+		DZ_percentiles = binned_percentiles(DZ_pixel, Z_pixel, Z_bins)
 	else:
 		print("Parameter given to calc_dust_dens_vs_param is not supported:",param)
 		return None,None,None
 
+	mean_DZ = DZ_percentiles[:,0]
+	# 16th and 84th percentiles
+	std_DZ = DZ_percentiles[:,1:]
+
 	return mean_DZ, std_DZ, param_vals
 
 
 
+def calc_obs_DZ_vs_views(param, param_lims, G, center, r_max, inclinations, position_angles=None, Lz_hat=None, disk_height=5, \
+			param_bins=50, pixel_res=2, depletion=False, smooth=False, nproc=1):
+	"""
+	Calculate mock observations of the dust-to-metals ratio vs a parameter (see calc_obs_DZ_vs_param) for many
+	viewing angles of the same snapshot, e.g. for studying the effect of inclination. The galaxy is selected and
+	its masses calculated once, and each view only costs a rotation of the galaxy's particles and a projection.
+
+	Parameters
+	----------
+	inclinations : array
+		Inclinations of each view in degrees
+	position_angles : array, optional
+		Position angles of each view in degrees, 0 for all views if not given
+
+	Returns
+	-------
+	views : list
+		mean_DZ, std_DZ, and param_vals for each view
+	"""
+
+	if position_angles is None:
+		position_angles = np.zeros(len(inclinations))
+
+	galaxy = calc_obs_galaxy(G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, depletion=depletion, smooth=smooth)
+	views = []
+	for inclination, position_angle in zip(inclinations, position_angles):
+		views += [calc_obs_DZ_in_view(param, param_lims, galaxy, r_max, view_rotation(Lz_hat, inclination, position_angle), \
+		                              param_bins=param_bins, pixel_res=pixel_res, smooth=smooth, nproc=nproc)]
+	return views
+
+
+
 def calc_H_fracs(G):
-	# Analytic calculation of molecular hydrogen from Krumholz et al. (2018)
+	# Number of H1, H2, and ionized H atoms using the analytic molecular hydrogen fraction
+	# from Krumholz et al. (2018). Only calculated once for each snapshot.
+	def calc():
+		fH2 = calc_fH2(G)
+		fHe = G['z'][:,1]
+		fMetals = G['z'][:,0]
+		# Number of atoms overflow single precision so make sure masses are double
+		M = G['m'].astype(np.float64)
 
+		# Gives number of H1, H2, and Hion atoms
+		NH1   =  M * UnitMass_in_g * (1. - fHe - fMetals) * (1. - fH2) / H_MASS
+		NH2   =  M * UnitMass_in_g * (1. - fHe - fMetals) * fH2 / (2*H_MASS)
+		NHion =  M * UnitMass_in_g * (1. - fHe - fMetals) * (1.-G['nh']) / H_MASS
 
-	Z = G['z'][:,0] #metal mass (everything not H, He)
-	# dust mean mass per H nucleus
-	mu_H = 2.3E-24# grams
-	# standard effective number of particle kernel neighbors defined in parameters file
-	N_ngb = 32.
-	# Gas softening length
-	hsml = G['h']*UnitLength_in_cm
-	density = G['rho']*UnitDensity_in_cgs
+		return NH1,NHion,NH2
 
-	sobColDens = np.multiply(hsml,density) / np.power(N_ngb,1./3.) # Cheesy approximation of column density
+	return derived_field(G, 'H_fracs', ['m','z','h','rho','nh'], calc)
 
-	#  dust optical depth 
-	tau = np.multiply(sobColDens,Z*1E-21/SOLAR_Z)/mu_H
-	tau[tau==0]=EPSILON #avoid divide by 0
 
-	chi = 3.1 * (1+3.1*np.power(Z/SOLAR_Z,0.365)) / 4.1 # Approximation
 
-	s = np.divide( np.log(1+0.6*chi+0.01*np.power(chi,2)) , (0.6 *tau) )
-	s[s==-4.] = -4.+EPSILON # Avoid divide by zero
-	fH2 = np.divide((1 - 0.5*s) , (1+0.25*s)) # Fraction of Molecular Hydrogen from Krumholz & Knedin
-	fH2[fH2<0] = 0 #Nonphysical negative molecular fractions set to 0
+def spiral_pixel_order(N):
+	"""
+	Indices of the pixels of an N x N image, starting at the center pixel and spiraling outward
 
-	fHe = G['z'][:,1]
-	fMetals = G['z'][:,0]
+	Parameters
+	----------
+	N : int
+		Number of pixels on a side of the image
 
-	# Gives number of H1, H2, and Hion atoms
-	NH1   =  G['m'] * UnitMass_in_g * (1. - fHe - fMetals) * (1. - fH2) / H_MASS
-	NH2   =  G['m'] * UnitMass_in_g * (1. - fHe - fMetals) * fH2 / (2*H_MASS)
-	NHion =  G['m'] * UnitMass_in_g * (1. - fHe - fMetals) * (1.-G['nh']) / H_MASS
-	
-	return NH1,NHion,NH2
+	Returns
+	-------
+	indices : array
+		Flattened indices (y*N+x) of the pixels in spiral order
+	"""
 
+	dirs = np.array([(0, -1), (-1, 0), (0, 1), (1, 0)])
+	# The spiral turns after legs of 1,1,2,2,3,3,... steps, take enough legs to cover the whole image
+	num_legs = 2*(int(2*N)+2)
+	leg_dirs = np.repeat(np.arange(num_legs) % 4, np.arange(num_legs)//2 + 1)
+	steps = dirs[leg_dirs]
+	x = N/2. + np.concatenate(([0], np.cumsum(steps[:-1,0])))
+	y = N/2. + np.concatenate(([0], np.cumsum(steps[:-1,1])))
+	# Each pixel is passed through once, so the pixels in the image are already in spiral order
+	in_image = np.logical_and(np.logical_and(0 <= x, x < N), np.logical_and(0 <= y, y < N))
+	return (y*N+x)[in_image].astype(int)
 
 
 def DZ_var_in_pixel(gas, header, center_list, r_max_list, Lz_list=None, \
 			height_list=None, pixel_res=2, time=False, depletion=False, cosmological=True, labels=None, \
-			foutname='DZ_variation_per_pixel.png', style='color', log=True):
+			foutname='DZ_variation_per_pixel.png', style='color', log=True, inclination=0., position_angle=0.):
 	"""
 	Plots variation of dust-to-metals in each observed pixels for multiple simulations 
 
@@ -826,6 +826,10 @@ def DZ_var_in_pixel(gas, header, center_list, r_max_list, Lz_list=None, \
 		'size' - make all lines solid black but with varying line thickness
 	log : boolean
 		Plot log of D/Z
+	inclination : double
+		Inclination of the line of sight in degrees, 0 is face-on to the disk if Lz_list is given
+	position_angle : double
+		Position angle of the image in degrees
 
 	Returns
 	-------
@@ -854,26 +858,12 @@ def DZ_var_in_pixel(gas, header, center_list, r_max_list, Lz_list=None, \
 		else:
 			Lz_hat = None; disk_height = None;
 
-		coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-		coords -= center
 		# Get only data of particles in sphere/disk since those are the ones we care about
 		# Also gives a nice speed-up
-		# Get paticles in disk
-		if Lz_hat != None:
-			zmag = np.dot(coords,Lz_hat)
-			r_z = np.zeros(np.shape(coords))
-			r_z[:,0] = zmag*Lz_hat[0]
-			r_z[:,1] = zmag*Lz_hat[1]
-			r_z[:,2] = zmag*Lz_hat[2]
-			r_s = np.subtract(coords,r_z)
-			smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-			in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-		# Get particles in sphere otherwise
-		else:
-			in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+		in_galaxy = select_galaxy(G['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 		M = G['m'][in_galaxy]
-		coords = coords[in_galaxy]
+		coords = view_coords(G['p'][in_galaxy], center, view_rotation(Lz_hat, inclination, position_angle))
 		dust_mass = G['dz'][in_galaxy,0]*M
 		if depletion:
 			Z_mass = G['z'][in_galaxy,0] * M + dust_mass
@@ -888,36 +878,22 @@ def DZ_var_in_pixel(gas, header, center_list, r_max_list, Lz_list=None, \
 		y_vals = (y_bins[1:] + y_bins[:-1]) / 2.
 		pixel_area = pixel_res**2 * 1E6 # area of pixel in pc^2
 
-		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass], statistic=np.sum, bins=[x_bins,y_bins], expand_binnumbers=True)
+		ret = binned_statistic_2d(x, y, [Z_mass,dust_mass], statistic='sum', bins=[x_bins,y_bins], expand_binnumbers=True)
 		data = ret.statistic
 		DZ_pixel = data[1].flatten()/data[0].flatten()
-		binning = ret.binnumber
+		binx = ret.binnumber[0]; biny = ret.binnumber[1]
 		pixel_num = np.arange(len(DZ_pixel.flatten()))
-		mean_DZ = np.zeros(len(pixel_num))
-		std_DZ = np.zeros([len(pixel_num),2])
-		for y in range(len(y_vals)):
-			for x in range(len(x_vals)):
-				binx = binning[0]; biny = binning[1]
-				in_pixel = np.logical_and(binx == x+1, biny == y+1)
-				values = dust_mass[in_pixel]/Z_mass[in_pixel]
-				weights = M[in_pixel]
-				mean_DZ[y*len(x_vals)+x],std_DZ[y*len(x_vals)+x,0],std_DZ[y*len(x_vals)+x,1] = weighted_percentile(values, weights=weights)
+
+		# Flattened pixel id of each particle, particles outside of the image are left out
+		in_image = np.logical_and(np.logical_and(binx >= 1, binx <= len(x_vals)), np.logical_and(biny >= 1, biny <= len(y_vals)))
+		pixel_id = np.where(in_image, (biny-1)*len(x_vals) + (binx-1), -1)
+		# D/Z percentiles of the particles in every pixel from one sort
+		DZ_percentiles = grouped_weighted_percentile(dust_mass/Z_mass, pixel_id, len(pixel_num), weights=M)
+		mean_DZ = DZ_percentiles[:,0]
+		std_DZ = DZ_percentiles[:,1:]
 
 		# Now set pixel indices so we start at the center pixel and spiral outward
-		N = np.sqrt(np.shape(pixel_num)[0])
-		startx = N/2; starty = startx
-		dirs = [(0, -1), (-1, 0), (0, 1), (1, 0)]
-		x, y = startx, starty
-		size = N * N
-		k, indices = 0, []
-		while len(indices) < size:
-			for l in xrange((k % 2) * 2, (k % 2) * 2 + 2):
-				dx, dy = dirs[l]
-				for _ in xrange(k + 1):
-					if 0 <= x < N and 0 <= y < N:
-						indices += [int(y*N+x)]
-					x, y = x + dx, y + dy
-			k+=1
+		indices = spiral_pixel_order(len(x_vals))
 
 		axis.errorbar(pixel_num, mean_DZ[indices], yerr = np.abs(mean_DZ[indices]-np.transpose(std_DZ[indices])), c=colors[j], fmt=MARKER_STYLE[0], elinewidth=1, markersize=2)
 		axis.plot(pixel_num, DZ_pixel[indices], label=labels[j], linestyle=linestyles[j], color=colors[j], linewidth=linewidths[j])
@@ -987,77 +963,27 @@ def elem_depletion_vs_param(elems, param, param_lim, gas, header, center_list, r
 	# Set up subplots based on number of parameters given
 	fig,axes = plt_set.setup_figure(len(elems))
 
+	# Get the depletions of all the elements for each snapshot at once
+	profiles = []
+	for j in range(len(gas)):
+		G = gas[j]; center = center_list[j]; r_max = r_max_list[j];
+		if Lz_list != None:
+			Lz_hat = Lz_list[j]; disk_height = height_list[j];
+		else:
+			Lz_hat = None; disk_height = None;
+		profiles += [calc_binned_profiles([param], [param_lim], elems, G, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height, \
+		                                  bin_nums=bin_nums, depletion=depletion, linear_bins=['fH2'])]
+
 	for i,elem in enumerate(elems):
 		axis = axes[i]
-		elem_indx = ELEMENTS.index(elem)
 		plt_set.setup_axis(axis, param, 'depletion', x_lim=param_lim)
 
 		if include_obs and param == 'nH':
 			plot_observational_data(axis, param='depletion', elem=elem, log=log)
 
 		for j in range(len(gas)):
-			G = gas[j]; H = header[j]; center = center_list[j]; r_max = r_max_list[j];
-			if Lz_list != None:
-				Lz_hat = Lz_list[j]; disk_height = height_list[j];
-			else:
-				Lz_hat = None; disk_height = None;
+			mean_DZ,std_DZ,param_vals = profiles[j][(param,elem)]
 
-			coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-			coords -= center
-			# Get only data of particles in sphere/disk since those are the ones we care about
-			# Also gives a nice speed-up
-			# Get paticles in disk
-			if Lz_hat != None:
-				zmag = np.dot(coords,Lz_hat)
-				r_z = np.zeros(np.shape(coords))
-				r_z[:,0] = zmag*Lz_hat[0]
-				r_z[:,1] = zmag*Lz_hat[1]
-				r_z[:,2] = zmag*Lz_hat[2]
-				r_s = np.subtract(coords,r_z)
-				smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-				in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-			# Get particles in sphere otherwise
-			else:
-				in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
-
-			coords = coords[in_galaxy]
-			M = G['m'][in_galaxy]
-
-			if param == 'nH':
-				param_data = G['rho'][in_galaxy]*UnitDensity_in_cgs * ( 1. - (G['z'][:,0][in_galaxy]+G['z'][:,1][in_galaxy])) / H_MASS
-				param_bins = np.logspace(np.log10(param_lim[0]),np.log10(param_lim[1]),bin_nums)
-				param_vals = (param_bins[1:] + param_bins[:-1]) / 2.
-
-			elif param == 'fH2':
-				NH1,NHion,NH2 = calc_H_fracs(G)
-				param_data = 2*NH2[in_galaxy]/(NH1[in_galaxy]+2*NH2[in_galaxy])
-				param_bins = np.linspace(param_lim[0],param_lim[1],bin_nums)
-				param_vals = (param_bins[1:] + param_bins[:-1]) / 2.
-
-
-			mean_DZ = np.zeros(bin_nums-1)
-			std_DZ = np.zeros([bin_nums-1,2])
-		
-			if depletion:
-				DZ = (G['dz'][:,elem_indx]/(G['z'][:,elem_indx]+G['dz'][:,elem_indx]))[in_galaxy]
-			else:
-				DZ = (G['dz'][:,elem_indx]/G['z'][:,elem_indx])[in_galaxy]
-
-			# Deal with DZ>1 values
-			DZ[DZ>1] = 1.
-
-			digitized = np.digitize(param_data,param_bins)
-
-
-			for k in range(1,len(param_bins)):
-				if len(param_data[digitized==k])==0:
-					mean_DZ[k-1] = np.nan
-					std_DZ[k-1,0] = np.nan; std_DZ[k-1,1] = np.nan;
-					continue
-				else:
-					weights = M[digitized == k]
-					values = DZ[digitized == k]
-					mean_DZ[k-1],std_DZ[k-1,0],std_DZ[k-1,1] = weighted_percentile(values, weights=weights)
 			axis.plot(param_vals, 1.-mean_DZ, label=labels[j], linestyle=linestyles[j], color=colors[j], linewidth=linewidths[j], zorder=3)
 			if std_bars:
 				axis.fill_between(param_vals, 1.-std_DZ[:,0], 1.-std_DZ[:,1], alpha = 0.3, color=colors[j], zorder=1)
@@ -1125,26 +1051,12 @@ def inst_dust_prod(gas, header, center_list, r_max_list,  Lz_list=None, height_l
 		else:
 			Lz_hat = None; disk_height = None;
 
-		coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-		coords -= center
 		# Get only data of particles in sphere/disk since those are the ones we care about
 		# Also gives a nice speed-up
-		# Get paticles in disk
-		if Lz_hat != None:
-			zmag = np.dot(coords,Lz_hat)
-			r_z = np.zeros(np.shape(coords))
-			r_z[:,0] = zmag*Lz_hat[0]
-			r_z[:,1] = zmag*Lz_hat[1]
-			r_z[:,2] = zmag*Lz_hat[2]
-			r_s = np.subtract(coords,r_z)
-			smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-			in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-		# Get particles in sphere otherwise
-		else:
-			in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+		in_galaxy = select_galaxy(G['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 
-		T = gas_temp.gas_temperature(G)
+		T = calc_temperature(G)
 		T = T[in_galaxy]
 		M = G['m'][in_galaxy]
 
@@ -1318,33 +1230,16 @@ def dust_acc_diag(params, gas, header, center_list, r_max_list,  Lz_list=None, h
 			else:
 				Lz_hat = None; disk_height = None;
 
-			coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-			coords -= center
 			# Get only data of particles in sphere/disk since those are the ones we care about
 			# Also gives a nice speed-up
-			# Get paticles in disk
-			if Lz_hat != None:
-				zmag = np.dot(coords,Lz_hat)
-				r_z = np.zeros(np.shape(coords))
-				r_z[:,0] = zmag*Lz_hat[0]
-				r_z[:,1] = zmag*Lz_hat[1]
-				r_z[:,2] = zmag*Lz_hat[2]
-				r_s = np.subtract(coords,r_z)
-				smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-				in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-			# Get particles in sphere otherwise
-			else:
-				in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+			in_galaxy = select_galaxy(G['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 
-			T = gas_temp.gas_temperature(G)
+			T = calc_temperature(G)
 			T = T[in_galaxy]
 			M = G['m'][in_galaxy]
 
-			if depletion:
-				nH = G['rho']*UnitDensity_in_cgs * ( 1. - (G['z'][:,0]+G['z'][:,1]+G['dz'][:,0])) / H_MASS
-			else:
-				nH = G['rho']*UnitDensity_in_cgs * ( 1. - (G['z'][:,0]+G['z'][:,1])) / H_MASS
+			nH = calc_nH(G, depletion=depletion)
 
 			if param == 'inst_dust_prod':
 				weight_vals = calc_dust_acc(G,implementation=imp, CNM_thresh=1.0, CO_frac=0.2, nano_iron=False, depletion=False)
@@ -1420,23 +1315,9 @@ def binned_phase_plot(param, gas, header, center_list, r_max_list, Lz_list=None,
 		else:
 			Lz_hat = None; disk_height = None;
 
-		coords = np.copy(G['p']) # Since we edit coords need to make a deep copy
-		coords -= center
 		# Get only data of particles in sphere/disk since those are the ones we care about
 		# Also gives a nice speed-up
-		# Get paticles in disk
-		if Lz_hat != None:
-			zmag = np.dot(coords,Lz_hat)
-			r_z = np.zeros(np.shape(coords))
-			r_z[:,0] = zmag*Lz_hat[0]
-			r_z[:,1] = zmag*Lz_hat[1]
-			r_z[:,2] = zmag*Lz_hat[2]
-			r_s = np.subtract(coords,r_z)
-			smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-			in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-		# Get particles in sphere otherwise
-		else:
-			in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+		in_galaxy = select_galaxy(G['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 		if param == 'DZ':
 			if depletion:
@@ -1448,11 +1329,8 @@ def binned_phase_plot(param, gas, header, center_list, r_max_list, Lz_list=None,
 			print("Parameter given to binned_phase_plot is not supported:",param)
 			return
 
-		if depletion:
-			nH = np.log10(G['rho']*UnitDensity_in_cgs * ( 1. - (G['z'][:,0]+G['z'][:,1]+G['dz'][:,0])) / H_MASS)[in_galaxy]
-		else:
-			nH = np.log10(G['rho']*UnitDensity_in_cgs * ( 1. - (G['z'][:,0]+G['z'][:,1])) / H_MASS)[in_galaxy]
-		T = np.log10(gas_temp.gas_temperature(G))
+		nH = np.log10(calc_nH(G, depletion=depletion)[in_galaxy])
+		T = np.log10(calc_temperature(G))
 		T = T[in_galaxy]
 		M = G['m'][in_galaxy]
 
@@ -1514,44 +1392,24 @@ def calc_stellar_Rd(S, center, r_max, Lz_hat=None, disk_height=5, bin_nums=50):
 		Galactic stellar scale radius
 	"""	
 
-	coords = np.copy(S['p']) # Since we edit coords need to make a deep copy
-	coords -= center
 	# Get only data of particles in sphere/disk since those are the ones we care about
 	# Also gives a nice speed-up
-	# Get paticles in disk
-	if Lz_hat != None:
-		zmag = np.dot(coords,Lz_hat)
-		r_z = np.zeros(np.shape(coords))
-		r_z[:,0] = zmag*Lz_hat[0]
-		r_z[:,1] = zmag*Lz_hat[1]
-		r_z[:,2] = zmag*Lz_hat[2]
-		r_s = np.subtract(coords,r_z)
-		smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-		in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-	# Get particles in sphere otherwise
-	else:
-		in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+	in_galaxy = select_galaxy(S['p'], center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
 
 	M = S['m'][in_galaxy]*1E10
-	coords = coords[in_galaxy]
 
 	r_bins = np.linspace(0, r_max, num=bin_nums)
 	r_vals = (r_bins[1:] + r_bins[:-1]) / 2.
 	surf_dens = np.zeros(bin_nums-1)
+	# Particles in each annulus, from one sort of their radii
+	annuli = radial_shells(S['p'], center, r_bins, Lz_hat=Lz_hat, disk_height=disk_height, subset=in_galaxy)
 
 	for j in range(bin_nums-1):
 		# find all coordinates within shell
 		r_min = r_bins[j]; r_max = r_bins[j+1];
 		annulus_area = np.pi * np.power((r_max-r_min)*1000,2) # pc^2
 
-		zmag = np.dot(coords,Lz_hat)
-		r_z = np.zeros(np.shape(coords))
-		r_z[:,0] = zmag*Lz_hat[0]
-		r_z[:,1] = zmag*Lz_hat[1]
-		r_z[:,2] = zmag*Lz_hat[2]
-		r_s = np.subtract(coords,r_z)
-		smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-		in_annulus = np.where((np.abs(zmag) <= disk_height) & (smag <= r_max) & (smag > r_min))
+		in_annulus = annuli[j]
 
 		surf_dens[j] = np.sum(M[in_annulus]) / annulus_area
 
@@ -1569,7 +1427,7 @@ def dens_profile_func(radius, Rd, cent_surf):
 	return cent_surf * np.exp(-radius/Rd)
 
 
-def dust_data_vs_time(params, param_lims, implementation='species', datanames=['data.pickle'], data_dir='data/', foutname='dust_data_vs_time.png', \
+def dust_data_vs_time(params, param_lims, implementation='species', datanames=['data.hdf5'], data_dir='data/', foutname='dust_data_vs_time.png', \
 	                     labels=None, time=False, cosmological=True, log=True, std_bars=True, style='color'):
 	"""
 	Plots all time averaged data vs time from precompiled data for a set of simulation runs
@@ -1597,6 +1455,14 @@ def dust_data_vs_time(params, param_lims, implementation='species', datanames=['
 	# Set up subplots based on number of parameters given
 	fig,axes = plt_set.setup_figure(len(params))
 
+	param_ids = {'DZ':'DZ_ratio', 'source_frac':'source_frac', 'spec_frac':'spec_frac', 'Si/C':'sil_to_C_ratio'}
+	# Only read the quantities being plotted from each data set, and only once for all of the plots
+	keys = ['time']
+	if cosmological:
+		keys += ['a_scale']
+	keys += [param_ids[y_param] for y_param in params if y_param in param_ids]
+	all_data = [read_time_series(data_dir+dataname, keys=keys) for dataname in datanames]
+
 	for i, y_param in enumerate(params):
 		# Set up for each plot
 		axis = axes[i]
@@ -1625,10 +1491,7 @@ def dust_data_vs_time(params, param_lims, implementation='species', datanames=['
 			print("%s is not a valid parameter for dust_data_vs_time()\n"%y_param)
 			return()
 
-		for j,dataname in enumerate(datanames):
-			with open(data_dir+dataname, 'rb') as handle:
-				data = pickle.load(handle)
-
+		for j,data in enumerate(all_data):
 			if cosmological:
 				if time:
 					time_data = data['time']
@@ -1665,17 +1528,323 @@ def dust_data_vs_time(params, param_lims, implementation='species', datanames=['
 	plt.close()
 
 
-def compile_dust_data(snap_dir, foutname='data.pickle', data_dir='data/', mask=False, halo_dir='', Rvir_frac = 1., \
+# Time evolution quantities compile_dust_data can calculate for each snapshot, by name. Each one lists the
+# particle fields it needs by particle type, so a snapshot only has to be loaded with the fields of the
+# quantities being calculated.
+DUST_METRICS = {}
+
+
+def dust_metric(name, fields, cosmological_only=False):
+	"""
+	Decorator adding a time evolution quantity to DUST_METRICS. The function is given the header, gas, and
+	star particles of a (masked) snapshot as H, G, and S along with the compile settings (implementation,
+	depletion, cosmological) as keywords, and returns the value of the quantity for that snapshot.
+
+	Parameters
+	----------
+	name : string
+		Name of the quantity in the compiled data
+	fields : dict
+		Particle fields needed by particle type, e.g. {0:['m','z','dz']}
+	cosmological_only : boolean
+		Only calculate the quantity for cosmological simulations
+
+	Returns
+	-------
+	decorator : function
+	"""
+
+	def register(calc):
+		DUST_METRICS[name] = {'fields':fields, 'calc':calc, 'cosmological_only':cosmological_only}
+		return calc
+	return register
+
+
+def dust_metric_names(cosmological=True):
+	"""
+	Names of all of the time evolution quantities for a simulation
+	"""
+
+	return sorted([name for name in DUST_METRICS if cosmological or not DUST_METRICS[name]['cosmological_only']])
+
+
+def dust_metric_fields(metrics, mask=False):
+	"""
+	Particle fields to load by particle type to calculate the given time evolution quantities, plus the
+	positions and masses needed to mask the galaxy if mask is True
+	"""
+
+	fields = {0:['p','m'] if mask else ['m']}
+	for name in metrics:
+		for ptype in DUST_METRICS[name]['fields']:
+			if ptype not in fields:
+				fields[ptype] = ['p','m'] if mask else ['m']
+			fields[ptype] += [key for key in DUST_METRICS[name]['fields'][ptype] if key not in fields[ptype]]
+	return fields
+
+
+def dust_snapshot_time(H, cosmological=True):
+	"""
+	Time of a snapshot in Gyr if cosmological, otherwise in code units
+	"""
+
+	if cosmological:
+		return tfora(H['time'], H['omega0'], H['hubble'])
+	return H['time']
+
+
+@dust_metric('time', {})
+def time_metric(H, G, S, cosmological=True, **kwargs):
+	return dust_snapshot_time(H, cosmological=cosmological)
+
+
+@dust_metric('a_scale', {}, cosmological_only=True)
+def a_scale_metric(H, G, S, **kwargs):
+	return H['time']
+
+
+@dust_metric('metallicity', {0:['m','z','dz']})
+def metallicity_metric(H, G, S, depletion=False, **kwargs):
+	if depletion:
+		return weighted_percentile(G['z'][:,0]+G['dz'][:,0], weights=G['m'])
+	return weighted_percentile(G['z'][:,0], weights=G['m'])
+
+
+@dust_metric('source_frac', {0:['m','dzs']})
+def source_frac_metric(H, G, S, **kwargs):
+	source_frac = np.zeros((4,3))
+	for j in range(4):
+		source_frac[j] = weighted_percentile(G['dzs'][:,j], weights=G['m'])
+		source_frac[j][source_frac[j]==0] = EPSILON
+	return source_frac
+
+
+def dust_species_vals(G, implementation='species'):
+	"""
+	Mass of each dust species (silicates and carbon for the elemental implementation) for each gas particle
+	"""
+
+	if implementation == 'species':
+		return G['spec']
+	return np.stack([G['dz'][:,4]+G['dz'][:,6]+G['dz'][:,7]+G['dz'][:,10], G['dz'][:,2]], axis=1)
+
+
+@dust_metric('spec_frac', {0:['m','dz','spec']})
+def spec_frac_metric(H, G, S, implementation='species', **kwargs):
+	spec_vals = dust_species_vals(G, implementation=implementation)
+	spec_frac = np.zeros((np.shape(spec_vals)[1],3))
+	# Need to mask all rows with nan and inf values for average to work
+	for j in range(np.shape(spec_vals)[1]):
+		spec_frac_vals = spec_vals[:,j]/G['dz'][:,0]
+		is_num = np.logical_and(~np.isnan(spec_frac_vals), ~np.isinf(spec_frac_vals))
+		spec_frac[j] = weighted_percentile(spec_frac_vals[is_num], weights =G['m'][is_num])
+		spec_frac[j][spec_frac[j]==0] = EPSILON
+	return spec_frac
+
+
+@dust_metric('sil_to_C_ratio', {0:['m','dz','spec']})
+def sil_to_C_metric(H, G, S, implementation='species', **kwargs):
+	spec_vals = dust_species_vals(G, implementation=implementation)
+	# Need to mask nan and inf values for average to work
+	sil_to_C_vals = spec_vals[:,0]/spec_vals[:,1]
+	is_num = np.logical_and(~np.isnan(sil_to_C_vals), ~np.isinf(sil_to_C_vals))
+	sil_to_C_ratio = weighted_percentile(sil_to_C_vals[is_num], weights =G['m'][is_num])
+	sil_to_C_ratio[sil_to_C_ratio==0] = EPSILON
+	return sil_to_C_ratio
+
+
+@dust_metric('DZ_ratio', {0:['m','z','dz']})
+def DZ_ratio_metric(H, G, S, depletion=False, **kwargs):
+	if depletion:
+		DZ_vals = G['dz'][:,0]/(G['z'][:,0]+G['dz'][:,0])
+	else:
+		DZ_vals = G['dz'][:,0]/G['z'][:,0]
+	DZ_ratio = weighted_percentile(DZ_vals, weights=G['m'])
+	DZ_ratio[DZ_ratio==0] = EPSILON
+	return DZ_ratio
+
+
+@dust_metric('sfr', {4:['m','age']})
+def sfr_metric(H, G, S, cosmological=True, **kwargs):
+	# Calculate SFR as all stars born within the last 100 Myrs
+	if S['k']==-1:
+		return 0.
+	if cosmological:
+		formation_time = tfora(S['age'], H['omega0'], H['hubble'])
+		current_time = dust_snapshot_time(H, cosmological=cosmological)
+	else:
+		formation_time = S['age']*UnitTime_in_Gyr
+		current_time = dust_snapshot_time(H, cosmological=cosmological)*UnitTime_in_Gyr
+
+	time_interval = 100E-3 # 100 Myr
+	new_stars = (current_time - formation_time) < time_interval
+	return np.sum(S['m'][new_stars]) * UnitMass_in_Msolar / (time_interval*1E9)   # Msun/yr
+
+
+def snapshot_dust_data(snap, metrics=None, cosmological=True, mask=False, r_max=None, Lz_hat=None, disk_height=None, \
+                       implementation='species', depletion=False):
+	"""
+	Calculates the time evolution data of a single snapshot, one row of what compile_dust_data saves.
+
+	Parameters
+	----------
+	snap : dict
+		Snapshot from load_snapshot with the header, gas (0), and star (4) particles
+	metrics : list
+		Names of the time evolution quantities in DUST_METRICS to calculate, all of them if None
+	cosmological : boolean
+		Snapshot is from a cosmological simulation
+	mask : boolean
+		Only use particles in the galaxy. For non-cosmological snapshots the galaxy is found here,
+		cosmological snapshots should already be loaded with only the halo particles.
+
+	Returns
+	-------
+	data : dict
+		Values of each time evolution quantity for this snapshot
+
+	"""
+
+	H = snap['header']; G = snap[0]; S = snap.get(4, {'k':-1})
+
+	if mask and not cosmological:
+		coords = G['p']
+		# Recenter coords at center of periodic box
+		boxsize = H['boxsize']
+		mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
+		coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2;
+		array_changed(coords)
+		center = np.average(coords, weights = G['m'], axis = 0)
+		# Check if mask should be sphere or disk if Lz_hat is given it's a disk
+		in_galaxy = select_galaxy(coords, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
+
+		for key in G.keys():
+			if key != 'k':
+				G[key] = G[key][in_galaxy]
+		# Check if there are any star particles
+		if S['k']!=-1:
+			coords = S['p']
+			mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
+			coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2;
+			array_changed(coords)
+
+			# Check if mask should be sphere or disk if Lz_hat is given it's a disk
+			in_galaxy = select_galaxy(coords, center, r_max, Lz_hat=Lz_hat, disk_height=disk_height)
+
+			for key in S.keys():
+				if key != 'k':
+					S[key] = S[key][in_galaxy]
+
+	if metrics is None:
+		metrics = dust_metric_names(cosmological=cosmological)
+	data = {}
+	for name in metrics:
+		data[name] = DUST_METRICS[name]['calc'](H, G, S, implementation=implementation, depletion=depletion, \
+		                                        cosmological=cosmological)
+	return data
+
+
+def snapshot_dust_data_part(args):
+	"""
+	Loads a snapshot and calculates its time evolution data, run in each of the compile_dust_data
+	worker processes. Returns None if the snapshot can't be found.
+	"""
+
+	snap_dir, num, load_args, data_args = args
+	snap = load_snapshot(snap_dir, num, **load_args)
+	if snap['k']==-1 or snap[0]['k']==-1:
+		return None
+	return snapshot_dust_data(snap, **data_args)
+
+
+def snapshots_dust_data(snap_dir, snap_nums, load_args, data_args, snapshot_args=None, workers=1, prefetch=2, pool=None):
+	"""
+	Iterates over the time evolution data of snapshots, giving (num, data) for each in snapshot order. data
+	is None if the snapshot can't be found. See compile_dust_data for the arguments.
+	"""
+
+	if workers > 1 or pool is not None:
+		# Every snapshot is independent, so hand them out to a pool of processes which each send back
+		# just the small row of data for their snapshot. imap returns these in snapshot order.
+		tasks = []
+		for num in snap_nums:
+			args = dict(load_args)
+			if snapshot_args is not None: args.update(snapshot_args(num))
+			tasks += [(snap_dir, num, args, data_args)]
+		own_pool = pool is None
+		if own_pool:
+			pool = multiprocessing.Pool(workers)
+		try:
+			for num, row in zip(snap_nums, pool.imap(snapshot_dust_data_part, tasks)):
+				yield num, row
+		finally:
+			# A pool shared with other compiles is left for them to use
+			if own_pool:
+				pool.terminate(); pool.join()
+	else:
+		# Go through each of the snapshots and get the data. Gas, stars, and header all come from a single 
+		# pass over the snapshot files, and the next snapshots are read while this one is worked on
+		snaps = prefetch_snapshots(snap_dir, snap_nums, prefetch=prefetch, snapshot_args=snapshot_args, **load_args)
+		for num, snap in snaps:
+			if snap['k']==-1 or snap[0]['k']==-1:
+				yield num, None
+			else:
+				yield num, snapshot_dust_data(snap, **data_args)
+
+
+def halo_mask_radius(snap_dir, halo_dir, startnum, Rvir_frac=1.):
+	"""
+	Radius of the spherical mask of a cosmological run, Rvir_frac times the virial radius of the halo
+	at snapshot startnum in physical kpc. None if that snapshot or its halo can't be found.
+	"""
+
+	headers = build_header_catalog(snap_dir)
+	halo_track = load_halo_track(halo_dir, snap_dir=snap_dir)
+	halo = halo_properties(halo_track, startnum, catalog_header(headers, startnum, cosmological=True))
+	if halo['k']==-1:
+		print("No snapshot or halo found for snapshot ", startnum)
+		print("Snap directory:", snap_dir)
+		return None
+	return halo['Rvir']*Rvir_frac
+
+
+def compile_dust_data(snap_dir, foutname='data.hdf5', data_dir='data/', mask=False, halo_dir='', Rvir_frac = 1., \
                       r_max = None, Lz_hat = None, disk_height = None, overwrite=False, cosmological=True, startnum=0, \
-                      endnum=600, implementation='species', depletion=False):
+                      endnum=600, implementation='species', depletion=False, prefetch=2, cache_dir=None, workers=1, \
+                      resume=False, incremental=False, metrics=None, pool=None):
 	"""
 	Compiles all the dust data needed for time evolution plots from all of the snapshots 
-	into a small file.
+	into a small time series file (see time_series.py), with one dataset for each quantity.
 
 	Parameters
 	----------
 	snap_dir : string
 		Name of directory with snapshots to be used 
+	prefetch : int
+		Number of snapshots to read ahead while the current one is processed. Lower this if 
+		the snapshots don't fit in memory.
+	cache_dir : string
+		Directory to keep reduced snapshots (only the masked particles and fields used here) in, so 
+		recompiling reads those instead of the full snapshots. None turns this off.
+	workers : int
+		Number of processes the snapshots are split between. Each worker loads and reduces its own
+		snapshots, so up to this many snapshots are held in memory at once and prefetch is not used.
+	resume : boolean
+		The data of each snapshot is appended to a working file (foutname + '.partial') as soon as it is
+		calculated, which only replaces foutname once the compile finishes. If True, snapshots already in the
+		working file (or in foutname) from an earlier compile with the same settings, such as one that was
+		killed part way through, are not calculated again.
+	incremental : boolean
+		Only calculate snapshots after the last one in the file, for updating the data of a simulation
+		that is still running. The compile stops at the first snapshot that hasn't been written yet and
+		saves the data up to it.
+	metrics : list
+		Names of the time evolution quantities in DUST_METRICS to compile, all of them if None. time (and a_scale
+		if cosmological) are always compiled. When resuming, quantities not in the file yet are added for the
+		snapshots already in it without recalculating the rest.
+	pool : multiprocessing.Pool
+		Pool of processes to hand the snapshots out to instead of starting one with workers processes, so
+		several compiles can share one pool (see compile_dust_batch)
 
 	Returns
 	-------
@@ -1683,7 +1852,7 @@ def compile_dust_data(snap_dir, foutname='data.pickle', data_dir='data/', mask=F
 
 	"""
 
-	if os.path.isfile(data_dir + foutname) and not overwrite:
+	if os.path.isfile(data_dir + foutname) and not (overwrite or resume or incremental):
 		"Data exists already. \n If you want to overwrite it use the overwrite param."
 	else:
 		# First create ouput directory if needed
@@ -1696,193 +1865,271 @@ def compile_dust_data(snap_dir, foutname='data.pickle', data_dir='data/', mask=F
 
 
 		print("Fetching data now...")
-		length = endnum-startnum+1
-		# Need to load in the first snapshot to see how many dust species there are
-		if implementation=='species':
-			G = readsnap(snap_dir, startnum, 0, cosmological=cosmological)
-			if G['k']==-1:
-				print("No snapshot found in directory")
-				print("Snap directory:", snap_dir)
+
+		if mask and not cosmological and r_max == None:
+			print("Must give maximum radius r_max for non-cosmological simulations!")
+			return
+
+		halo_region = None
+		if mask and cosmological:
+			# Headers of every snapshot in the run, so the halo center can be found before reading any particles
+			headers = build_header_catalog(snap_dir)
+			halo_track = load_halo_track(halo_dir, snap_dir=snap_dir)
+			if r_max == None:
+				print("Using AHF halo as spherical mask with radius of ",str(Rvir_frac)," * Rvir.")
+				r_max = halo_mask_radius(snap_dir, halo_dir, startnum, Rvir_frac=Rvir_frac)
+				if r_max is None:
+					return
+			else:
+				print("Using AHF halo as spherical mask with radius of ",str(r_max)," kpc.")
+			if disk_height is not None:
+				print("Only using the disk of height ",str(disk_height)," kpc along the halo angular momentum.")
+
+			# Since the halo center is known beforehand only read in the particles inside the mask. None for
+			# snapshots without a header or halo, which can't be masked and so are never read in at all.
+			def halo_region(num):
+				halo = halo_properties(halo_track, num, catalog_header(headers, num, cosmological=cosmological))
+				if halo['k']==-1:
+					return None
+				if disk_height is not None:
+					return {'center':halo['center'], 'r_max':r_max, 'Lz_hat':halo['Lz_hat'], 'disk_height':disk_height}
+				return {'center':halo['center'], 'r_max':r_max}
+
+		data_args = {'cosmological':cosmological, 'mask':mask, 'r_max':r_max, 'Lz_hat':Lz_hat, 'disk_height':disk_height, \
+		             'implementation':implementation, 'depletion':depletion}
+		if metrics is None:
+			metrics = dust_metric_names(cosmological=cosmological)
+		# Every time series needs its time axis to be plotted
+		metrics = sorted(set(metrics) | set([name for name in ['time','a_scale'] if name in dust_metric_names(cosmological=cosmological)]))
+
+		# Rows are written to a working file, so foutname only exists once it holds every snapshot asked for
+		# and a compile that stops early never leaves truncated data behind that looks complete
+		fname = data_dir + foutname + '.partial'
+		settings = repr(sorted(data_args.items()) + [('snap_dir',os.path.abspath(snap_dir)), ('halo_dir',halo_dir)])
+		# Rows of snapshots already done are only kept if they were calculated the same way. An unfinished
+		# compile is picked up where it stopped, otherwise the finished file is added to.
+		if (resume or incremental) and time_series_settings(fname) != settings and \
+		   time_series_settings(data_dir + foutname) == settings:
+			shutil.copyfile(data_dir + foutname, fname)
+		done = []
+		if (resume or incremental) and time_series_settings(fname) == settings:
+			done = list(read_time_series(fname, keys=[])['snap_num'])
+			stored = time_series_keys(fname)
+			# Every new row needs the quantities already in the file as well
+			metrics = sorted(set(metrics) | set([name for name in stored if name in DUST_METRICS]))
+			missing = [name for name in metrics if name not in stored]
+			if len(done) > 0 and len(missing) > 0 and halo_region is not None and \
+			   any([halo_region(num) is None for num in done]):
+				print("Snapshots already compiled are no longer in the halo file or snapshot directory, recompile with overwrite")
 				return
-			species_num = np.shape(G['spec'])[1]
-			print("There are %i dust species"%species_num)
+			if len(done) > 0 and len(missing) > 0:
+				# Quantities added since the file was compiled only need a pass over the snapshots already in
+				# it, loading just the fields they use
+				print("Adding ", missing, " to the %i snapshots already compiled"%len(done))
+				load_args = {'ptypes':[], 'cosmological':cosmological, 'cache_dir':cache_dir, \
+				             'fields':dust_metric_fields(missing, mask=mask)}
+				load_args['ptypes'] = sorted(load_args['fields'].keys())
+				nums = []; rows = []
+				for num, row in snapshots_dust_data(snap_dir, done, load_args, dict(data_args, metrics=missing), \
+				                                    snapshot_args=halo_region, workers=workers, prefetch=prefetch, pool=pool):
+					print(num)
+					if row is None:
+						print("No snapshot found in directory")
+						print("Snap directory:", snap_dir)
+						return
+					nums += [num]; rows += [row]
+				add_time_series_columns(fname, nums, rows)
+		else:
+			metadata = dict(data_args)
+			metadata['snap_dir'] = os.path.abspath(snap_dir)
+			metadata['halo_dir'] = halo_dir
+			new_time_series(fname, settings, metadata)
+		if incremental and len(done) > 0:
+			snap_nums = range(max(startnum, max(done)+1), endnum+1)
 		else:
-			species_num = 2
-		# Most data comes with mean of values and 16th and 84th percentile
-		DZ_ratio = np.zeros([length,3])
-		sil_to_C_ratio = np.zeros([length,3])
-		sfr = np.zeros(length)
-		metallicity = np.zeros([length,3])
-		time = np.zeros(length)
-		a_scale = np.zeros(length)
-		source_frac = np.zeros((length,4,3))
-		spec_frac = np.zeros((length,species_num,3))
-
-
-		# Go through each of the snapshots and get the data
-		for i, num in enumerate(range(startnum, endnum+1)):
+			snap_nums = [num for num in range(startnum, endnum+1) if num not in done]
+		if halo_region is not None:
+			# Snapshots without the halo in the halo file (or without a header) can't be masked
+			no_halo = [num for num in snap_nums if halo_region(num) is None]
+			if len(no_halo) > 0:
+				print("Skipping snapshots not in the halo file: ", no_halo)
+				snap_nums = [num for num in snap_nums if num not in no_halo]
+		print("%i snapshots already compiled, %i to go"%(len([num for num in done if startnum<=num<=endnum]), len(snap_nums)))
+
+		# Only load the fields needed for the time evolution data
+		load_args = {'ptypes':[], 'cosmological':cosmological, 'cache_dir':cache_dir, 'fields':dust_metric_fields(metrics, mask=mask)}
+		load_args['ptypes'] = sorted(load_args['fields'].keys())
+		for num, row in snapshots_dust_data(snap_dir, snap_nums, load_args, dict(data_args, metrics=metrics), \
+		                                    snapshot_args=halo_region, workers=workers, prefetch=prefetch, pool=pool):
 			print(num)
-			G = readsnap(snap_dir, num, 0, cosmological=cosmological)
-			H = readsnap(snap_dir, num, 0, header_only=True, cosmological=cosmological)
-			S = readsnap(snap_dir, num, 4, cosmological=cosmological)
-
-			if G['k']==-1:
+			if row is None:
 				print("No snapshot found in directory")
 				print("Snap directory:", snap_dir)
-				return
+				if not incremental:
+					return
+				# The simulation hasn't got this far yet
+				break
+			# Most data comes with mean of values and 16th and 84th percentile
+			append_time_series(fname, num, row)
+		os.rename(fname, data_dir + foutname)
 
-			if mask:
-				coords = G['p']
-				center = np.zeros(3)
-				if cosmological:
-					halo_data = Table.read(halo_dir,format='ascii')
-					# Convert to physical units
-					xpos =  halo_data['col7'][num-1]*H['time']/H['hubble']
-					ypos =  halo_data['col8'][num-1]*H['time']/H['hubble']
-					zpos =  halo_data['col9'][num-1]*H['time']/H['hubble']
-					rvir = halo_data['col13'][num-1]*H['time']/H['hubble']
-					
-					#TODO : Add ability to only look at particles in disk using angular momentum vector from
-					# halo file
-					
-					center = np.array([xpos,ypos,zpos])
-					coords -= center
-					if r_max == None:
-						print("Using AHF halo as spherical mask with radius of ",str(Rvir_frac)," * Rvir.")
-						r_max = rvir*Rvir_frac
-					else:
-						print("Using AHF halo as spherical mask with radius of ",str(r_max)," kpc.")
-
-					in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
-				else:
-					if r_max == None:
-						print("Must give maximum radius r_max for non-cosmological simulations!")
-						return
-					# Recenter coords at center of periodic box
-					boxsize = H['boxsize']
-					mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
-					coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2;
-					center = np.average(coords, weights = G['m'], axis = 0)
-					coords -= center
-					# Check if mask should be sphere or disk if Lz_hat is given it's a disk
-					if Lz_hat != None:
-						zmag = np.dot(coords,Lz_hat)
-						r_z = np.zeros(np.shape(coords))
-						r_z[:,0] = zmag*Lz_hat[0]
-						r_z[:,1] = zmag*Lz_hat[1]
-						r_z[:,2] = zmag*Lz_hat[2]
-						r_s = np.subtract(coords,r_z)
-						smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-						in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-					# Get particles in sphere otherwise
-					else:
-						in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
-
-				for key in G.keys():
-					if key != 'k':
-						G[key] = G[key][in_galaxy]
-				# Check if there are any star particles
-				if S['k']!=-1:
-					coords = S['p']
-					if not cosmological:
-						boxsize = H['boxsize']
-						mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
-						coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2;
-
-					coords -= center
-
-					# Check if mask should be sphere or disk if Lz_hat is given it's a disk
-					if Lz_hat != None:
-						zmag = np.dot(coords,Lz_hat)
-						r_z = np.zeros(np.shape(coords))
-						r_z[:,0] = zmag*Lz_hat[0]
-						r_z[:,1] = zmag*Lz_hat[1]
-						r_z[:,2] = zmag*Lz_hat[2]
-						r_s = np.subtract(coords,r_z)
-						smag = np.sqrt(np.sum(np.power(r_s,2),axis=1))
-						in_galaxy = np.logical_and(np.abs(zmag) <= disk_height, smag <= r_max)
-					# Get particles in sphere otherwise
-					else:
-						in_galaxy = np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
-
-					S['age'] = S['age'][in_galaxy]
-					S['m'] = S['m'][in_galaxy]
-
-			M = G['m']
-			omeganot = H['omega0']
-			h = H['hubble']
-			if cosmological:
-				a_scale[i] = H['time']
-				time[i] = tfora(H['time'], omeganot, h)
-			else:
-				time[i] = H['time']
-
-			if depletion:
-				metallicity[i] = weighted_percentile(G['z'][:,0]+G['dz'][:,0], weights=M)
-			else:
-				metallicity[i] = weighted_percentile(G['z'][:,0], weights=M)
 
-			for j in range(4):
-				source_frac[i,j] = weighted_percentile(G['dzs'][:,j], weights=M)
-				source_frac[i,j][source_frac[i,j]==0] = EPSILON
+# compile_dust_data arguments that only change how the data is compiled and not the data itself
+BATCH_EXEC_ARGS = ['startnum', 'endnum', 'metrics', 'overwrite', 'resume', 'incremental', 'prefetch', 'cache_dir', 'workers', 'pool']
 
 
-			if implementation == 'species':
-				# Need to mask all rows with nan and inf values for average to work
-				for j in range(species_num):
-					spec_frac_vals = G['spec'][:,j]/G['dz'][:,0]
-					is_num = np.logical_and(~np.isnan(spec_frac_vals), ~np.isinf(spec_frac_vals))
-					spec_frac[i,j] = weighted_percentile(spec_frac_vals[is_num], weights =M[is_num])
-					spec_frac[i,j][spec_frac[i,j]==0] = EPSILON
-
-				sil_to_C_vals = G['spec'][:,0]/G['spec'][:,1]
-				is_num = np.logical_and(~np.isnan(sil_to_C_vals), ~np.isinf(sil_to_C_vals))
-				sil_to_C_ratio[i] = weighted_percentile(sil_to_C_vals[is_num], weights =M[is_num])
-				sil_to_C_ratio[i][sil_to_C_ratio[i]==0] = EPSILON
-
-			elif implementation == 'elemental':
-				# Need to mask nan and inf values for average to work
-				spec_frac_vals = (G['dz'][:,4]+G['dz'][:,6]+G['dz'][:,7]+G['dz'][:,10])/G['dz'][:,0]
-				is_num = np.logical_and(~np.isnan(spec_frac_vals), ~np.isinf(spec_frac_vals))
-				spec_frac[i,0] = weighted_percentile(spec_frac_vals[is_num], weights =M[is_num])
-				spec_frac[i,0][spec_frac[i,0]==0] = EPSILON
-
-				spec_frac_vals = G['dz'][:,2]/G['dz'][:,0]
-				is_num = np.logical_and(~np.isnan(spec_frac_vals), ~np.isinf(spec_frac_vals))
-				spec_frac[i,1] = weighted_percentile(spec_frac_vals[is_num], weights =M[is_num])
-				spec_frac[i,1][spec_frac[i,1]==0] = EPSILON
-
-				sil_to_C_vals = (G['dz'][:,4]+G['dz'][:,6]+G['dz'][:,7]+G['dz'][:,10])/G['dz'][:,2]
-				is_num = np.logical_and(~np.isnan(sil_to_C_vals), ~np.isinf(sil_to_C_vals))
-				sil_to_C_ratio[i] = weighted_percentile(sil_to_C_vals[is_num], weights =M[is_num])
-				sil_to_C_ratio[i][sil_to_C_ratio[i]==0] = EPSILON
+def dust_batch_runs(runs, **kwargs):
+	"""
+	Merges the runs of a compile_dust_batch spec which are saved to the same file, e.g. a fiducial run
+	that is part of several comparison groups, so each run is only compiled once.
 
-			if depletion:
-				DZ_vals = G['dz'][:,0]/(G['z'][:,0]+G['dz'][:,0])
-			else:
-				DZ_vals = G['dz'][:,0]/G['z'][:,0]
-			DZ_ratio[i] = weighted_percentile(DZ_vals, weights=M)
-			DZ_ratio[i][DZ_ratio[i]==0] = EPSILON
-
-			# Calculate SFR as all stars born within the last 100 Myrs
-			if S['k']!=-1:
-				if cosmological:
-					formation_time = tfora(S['age'], omeganot, h)
-					current_time = time[i]
-				else:
-					formation_time = S['age']*UnitTime_in_Gyr
-					current_time = time[i]*UnitTime_in_Gyr
+	Parameters
+	----------
+	runs : list
+		compile_dust_data arguments for each run, as dicts which must include snap_dir and foutname
+	kwargs : dict
+		compile_dust_data arguments shared by all of the runs, overridden by those in runs
 
-				time_interval = 100E-3 # 100 Myr
-				new_stars = (current_time - formation_time) < time_interval
-				sfr[i] = np.sum(S['m'][new_stars]) * UnitMass_in_Msolar / (time_interval*1E9)   # Msun/yr
+	Returns
+	-------
+	batch : list
+		compile_dust_data arguments for each distinct run, with the snapshot ranges of the merged runs
+		combined and all of their metrics, and the r_max of masked cosmological runs set from the Rvir at
+		their startnum. None if two runs saved to the same file differ in anything else, or a mask radius
+		can't be found.
+	"""
 
-		if cosmological:
-			data = {'time':time,'a_scale':a_scale,'DZ_ratio':DZ_ratio,'sil_to_C_ratio':sil_to_C_ratio,'metallicity':metallicity,'source_frac':source_frac,'spec_frac':spec_frac,'sfr':sfr}
+	batch = {}; order = []
+	for run in runs:
+		args = dict(kwargs)
+		args.update(run)
+		key = os.path.abspath(args.get('data_dir','data/') + args['foutname'])
+		if key not in batch:
+			batch[key] = args; order += [key]
+			continue
+		merged = batch[key]
+		for arg in set(args.keys()) | set(merged.keys()):
+			if arg not in BATCH_EXEC_ARGS and args.get(arg) != merged.get(arg):
+				print("Runs saved to %s have different values of %s"%(key, arg))
+				return None
+		merged['startnum'] = min(merged.get('startnum',0), args.get('startnum',0))
+		merged['endnum'] = max(merged.get('endnum',600), args.get('endnum',600))
+		if merged.get('metrics') is None or args.get('metrics') is None:
+			merged['metrics'] = None
 		else:
-			data = {'time':time,'DZ_ratio':DZ_ratio,'sil_to_C_ratio':sil_to_C_ratio,'metallicity':metallicity,'source_frac':source_frac,'spec_frac':spec_frac,'sfr':sfr}
-		with open(data_dir+foutname, 'wb') as handle:
-			pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+			merged['metrics'] = sorted(set(merged['metrics']) | set(args['metrics']))
+	for key in order:
+		args = batch[key]
+		# The mask radius is part of the data settings, so it comes from the first snapshot of the whole run
+		# and not of each shard, otherwise the shards couldn't be merged
+		if args.get('mask',False) and args.get('cosmological',True) and args.get('r_max') is None:
+			args['r_max'] = halo_mask_radius(args['snap_dir'], args.get('halo_dir',''), args.get('startnum',0), \
+			                                 Rvir_frac=args.get('Rvir_frac',1.))
+			if args['r_max'] is None:
+				return None
+	return [batch[key] for key in order]
+
+
+def compile_dust_batch(runs, workers=1, shard=None, **kwargs):
+	"""
+	Compiles the time evolution data of a batch of runs, such as every run in a set of comparison groups.
+	Runs saved to the same file are only compiled once (see dust_batch_runs), and the snapshots of every
+	run are handed out to a single pool of workers processes.
+
+	The batch can also be split between the jobs of a scheduler array. Each job compiles one shard, a
+	contiguous block of the snapshots of every run, into its own files (see shards.py), and once they have
+	all finished merge_dust_batch stitches the shards together.
+
+	Parameters
+	----------
+	runs : list
+		compile_dust_data arguments for each run, as dicts which must include snap_dir and foutname
+	workers : int
+		Number of processes the snapshots are split between
+	shard : tuple
+		(i, n) to only compile shard i of n
+	kwargs : dict
+		compile_dust_data arguments shared by all of the runs, overridden by those in runs
+
+	Returns
+	-------
+	foutnames : list
+		Names of the data files compiled for each run, in the same order as runs
+	"""
+
+	batch = dust_batch_runs(runs, **kwargs)
+	if batch is None:
+		return None
+	print("Compiling %i runs for %i requested"%(len(batch), len(runs)))
+
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+	try:
+		for args in batch:
+			print(args['snap_dir'])
+			if shard is not None:
+				args = dict(args)
+				args['startnum'], args['endnum'] = shard_range(args.get('startnum',0), args.get('endnum',600), shard)
+				args['foutname'] = shard_foutname(args['foutname'], shard)
+				if args['endnum'] < args['startnum']:
+					continue
+			compile_dust_data(pool=pool, **args)
+	finally:
+		if pool is not None:
+			pool.terminate(); pool.join()
+
+	if shard is not None:
+		return [shard_foutname(run['foutname'], shard) for run in runs]
+	return [run['foutname'] for run in runs]
+
+
+def merge_dust_batch(runs, num_shards, **kwargs):
+	"""
+	Stitches together the data files of each shard of a batch compiled with compile_dust_batch(shard=(i,n))
+	into the data file of each run, as if the batch had been compiled in one go. Takes the same runs and
+	arguments as the compile.
+
+	Returns
+	-------
+	foutnames : list
+		Names of the merged data files for each run, in the same order as runs. None if any of the shards
+		are missing, or don't hold exactly the snapshots of their part of the run (e.g. left over from a
+		batch with a different snapshot range).
+	"""
+
+	batch = dust_batch_runs(runs, **kwargs)
+	if batch is None:
+		return None
+	for args in batch:
+		data_dir = args.get('data_dir','data/')
+		# Snapshots the halo file or header catalog don't have are skipped by the compile, so they aren't gaps
+		halo_snums = None
+		if args.get('mask',False) and args.get('cosmological',True):
+			headers = build_header_catalog(args['snap_dir'])
+			halo_snums = np.intersect1d(load_halo_track(args.get('halo_dir',''), snap_dir=args['snap_dir'])['snum'], \
+			                            headers['snum'])
+		# Shards without any snapshots of this run don't have a file
+		shards = []
+		for i in range(num_shards):
+			first, last = shard_range(args.get('startnum',0), args.get('endnum',600), (i, num_shards))
+			if last < first:
+				continue
+			fname = data_dir+shard_foutname(args['foutname'], (i, num_shards))
+			if time_series_settings(fname) is None:
+				print("Missing shard ", fname)
+				return None
+			expected = [num for num in range(first, last+1) if halo_snums is None or num in halo_snums]
+			snap_num = [int(num) for num in read_time_series(fname, keys=[])['snap_num']]
+			if snap_num != expected:
+				print("Shard %s should have snapshots %i to %i, missing "%(fname, first, last), \
+				      sorted(set(expected)-set(snap_num)), " extra ", sorted(set(snap_num)-set(expected)))
+				return None
+			shards += [fname]
+		print("Merging %i shards of "%len(shards), args['snap_dir'])
+		if not merge_time_series(shards, data_dir+args['foutname']):
+			return None
+	return [run['foutname'] for run in runs]
 
 
 def compare_dust_creation(Z_list, dust_species, data_dirc, FIRE_ver=2, transition_age = 0.03753, style='color'):
@@ -0,0 +1,215 @@
+import numpy as np
+import weakref
+
+# Galaxy-frame coordinates already computed, by (position array, center, disk axis). Entries
+# hold a weak reference to and fingerprint of the position array so they are never reused for a
+# different snapshot or after the positions are changed (see array_changed).
+COORD_CACHE = {}
+# Number of times each array, by id, has been marked as edited in place with array_changed
+ARRAY_VERSIONS = {}
+# Number of center/axis combinations to keep before the oldest are dropped
+COORD_CACHE_SIZE = 16
+
+
+def array_fingerprint(arr):
+	"""
+	Cheap fingerprint of an array (its shape, memory address, and how many times it has been marked as
+	changed) used to recognize when an array with cached results is no longer the one they came from. The
+	values aren't looked at, so code that edits an array in place must call array_changed on it.
+	"""
+
+	return (arr.shape, arr.__array_interface__['data'][0], ARRAY_VERSIONS.get(id(arr), 0))
+
+
+def array_changed(arr):
+	"""
+	Marks an array as edited in place, e.g. coordinates recentered in the periodic box, so nothing cached
+	from its old values is used again
+	"""
+
+	ARRAY_VERSIONS[id(arr)] = ARRAY_VERSIONS.get(id(arr), 0) + 1
+
+
+def galaxy_coords(pos, center, Lz_hat=None):
+	"""
+	Spherical radius and, if a disk axis is given, cylindrical radius, height, and azimuthal angle
+	of particles about a center. These are computed once for each set of positions, center, and
+	axis and cached, so any number of selections and profiles share a single pass over the positions.
+
+	Parameters
+	----------
+	pos : array
+		Particle coordinates, e.g. G['p']
+	center : array
+		3-D coordinate of galaxy center
+	Lz_hat: array
+		Unit vector of the disk axis
+
+	Returns
+	-------
+	coords : dict
+		'r' spherical radius, and if Lz_hat is given 'R' cylindrical radius, 'z' height above the
+		disk plane, and 'phi' azimuthal angle in the disk plane
+	"""
+
+	key = (id(pos), tuple(np.ravel(center).tolist()), None if Lz_hat is None else tuple(np.ravel(Lz_hat).tolist()))
+	if key in COORD_CACHE:
+		ref, fingerprint, coords = COORD_CACHE[key]
+		if ref() is pos and fingerprint == array_fingerprint(pos):
+			return coords
+	# Drop entries whose positions no longer exist before adding more
+	for old_key in list(COORD_CACHE.keys()):
+		if COORD_CACHE[old_key][0]() is None:
+			del COORD_CACHE[old_key]
+	while len(COORD_CACHE) >= COORD_CACHE_SIZE:
+		del COORD_CACHE[next(iter(COORD_CACHE))]
+
+	# Only one N x 3 temporary, and the positions themselves are never copied or changed
+	dx = pos - center
+	coords = {'r': np.sqrt(np.einsum('ij,ij->i', dx, dx))}
+	if Lz_hat is not None:
+		Lz_hat = np.asarray(Lz_hat, dtype=np.float64)
+		coords['z'] = np.dot(dx, Lz_hat)
+		coords['R'] = np.sqrt(np.maximum(coords['r']**2 - coords['z']**2, 0.))
+		# Azimuth measured from an arbitrary direction in the disk plane
+		x_hat = np.cross(Lz_hat, [1.,0.,0.] if np.abs(Lz_hat[0]) < 0.9 else [0.,1.,0.])
+		x_hat /= np.linalg.norm(x_hat)
+		y_hat = np.cross(Lz_hat, x_hat)
+		coords['phi'] = np.arctan2(np.dot(dx, y_hat), np.dot(dx, x_hat))
+	del dx
+
+	COORD_CACHE[key] = (weakref.ref(pos), array_fingerprint(pos), coords)
+	return coords
+
+
+def select_sphere(pos, center, r_max, r_min=None):
+	"""
+	Indices of particles within r_max of center, or in the shell r_min < r <= r_max if r_min is given
+	"""
+
+	r = galaxy_coords(pos, center)['r']
+	if r_min is None:
+		return np.where(r <= r_max)[0]
+	return np.where((r <= r_max) & (r > r_min))[0]
+
+
+def select_disk(pos, center, Lz_hat, r_max, disk_height, r_min=None):
+	"""
+	Indices of particles within the disk of radius r_max and half-height disk_height about center
+	with axis Lz_hat, or in the annulus r_min < R <= r_max of the disk if r_min is given
+	"""
+
+	coords = galaxy_coords(pos, center, Lz_hat=Lz_hat)
+	in_disk = (np.abs(coords['z']) <= disk_height) & (coords['R'] <= r_max)
+	if r_min is not None:
+		in_disk &= coords['R'] > r_min
+	return np.where(in_disk)[0]
+
+
+def select_galaxy(pos, center, r_max, Lz_hat=None, disk_height=None, r_min=None):
+	"""
+	Indices of particles in the galaxy, a disk if Lz_hat is given and a sphere otherwise
+
+	Parameters
+	----------
+	pos : array
+		Particle coordinates, e.g. G['p']
+	center : array
+		3-D coordinate of galaxy center
+	r_max : double
+		Maximum radius of the sphere or disk
+	Lz_hat: array
+		Unit vector of the disk axis, if None a sphere is selected
+	disk_height: double
+		Half-height of the disk
+	r_min : double
+		If given only select the shell/annulus outside this radius
+
+	Returns
+	-------
+	indices : array
+		Indices of the selected particles
+	"""
+
+	if Lz_hat is not None:
+		return select_disk(pos, center, Lz_hat, r_max, disk_height, r_min=r_min)
+	return select_sphere(pos, center, r_max, r_min=r_min)
+
+
+def galaxy_radius(pos, center, Lz_hat=None):
+	"""
+	Radius used for galaxy profiles, the cylindrical radius for a disk and the spherical radius otherwise
+	"""
+
+	coords = galaxy_coords(pos, center, Lz_hat=Lz_hat)
+	if Lz_hat is not None:
+		return coords['R']
+	return coords['r']
+
+
+def radial_order(pos, center, r_max, Lz_hat=None, disk_height=None):
+	"""
+	Particles within r_max sorted by the radius used for galaxy profiles (cylindrical for a disk, only
+	including particles within disk_height of the plane, spherical otherwise). Only the galaxy is sorted,
+	not the whole snapshot, and the result is kept with the cached galaxy coordinates for each r_max and
+	disk_height so every radial profile of a snapshot reuses it.
+
+	Returns
+	-------
+	order : array
+		Indices of the particles in order of increasing radius
+	radius : array
+		Their sorted radii
+	"""
+
+	coords = galaxy_coords(pos, center, Lz_hat=Lz_hat)
+	key = ('order', r_max, disk_height)
+	if key not in coords:
+		radius = galaxy_radius(pos, center, Lz_hat=Lz_hat)
+		in_galaxy = radius <= r_max
+		if Lz_hat is not None and disk_height is not None:
+			in_galaxy &= np.abs(coords['z']) <= disk_height
+		in_galaxy = np.where(in_galaxy)[0]
+		order = in_galaxy[np.argsort(radius[in_galaxy], kind='mergesort')]
+		coords[key] = (order, radius[order])
+	return coords[key]
+
+
+def radial_shells(pos, center, r_bins, Lz_hat=None, disk_height=None, subset=None):
+	"""
+	Indices of the particles in each of the shells (or disk annuli) r_bins[j] < r <= r_bins[j+1], found
+	by binary search in the sorted radii instead of a pass over every particle for every bin
+
+	Parameters
+	----------
+	pos : array
+		Particle coordinates, e.g. G['p']
+	center : array
+		3-D coordinate of galaxy center
+	r_bins : array
+		Increasing radial bin edges
+	Lz_hat: array
+		Unit vector of the disk axis, if None spherical shells are used
+	disk_height: double
+		Half-height of the disk
+	subset : array
+		Sorted indices of an already selected set of particles containing every shell (e.g. from
+		select_galaxy). If given the returned indices are positions within this subset instead, for
+		indexing arrays that were already masked with it.
+
+	Returns
+	-------
+	shells : list
+		Index arrays of the particles in each shell, in their original order
+	"""
+
+	# Particles past the last edge aren't in any shell, so they aren't sorted
+	order, radius = radial_order(pos, center, r_bins[-1], Lz_hat=Lz_hat, disk_height=disk_height)
+	edges = np.searchsorted(radius, r_bins, side='right')
+	shells = []
+	for j in range(len(r_bins)-1):
+		shell = np.sort(order[edges[j]:edges[j+1]])
+		if subset is not None:
+			shell = np.searchsorted(subset, shell)
+		shells += [shell]
+	return shells
@@ -0,0 +1,125 @@
+import numpy as np
+import h5py
+import os
+from readsnap import build_header_catalog, temp_file_name
+
+# Columns of an AHF halo history file (e.g. halo_0000000.dat), counting from 0. These are the usual AHF
+# halo columns after the redshift of each snapshot the halo was found in.
+HALO_COLUMNS = {'redshift':0, 'ID':1, 'Mvir':4, 'Xc':6, 'Yc':7, 'Zc':8, 'Rvir':12, 'Lx':22, 'Ly':23, 'Lz':24}
+# Halo histories already loaded, by file
+HALO_TRACKS = {}
+
+
+def read_halo_file(halo_file, cache_file=None):
+	"""
+	Reads the table of an AHF halo history file. The ASCII file is only parsed the first time, after that
+	the table is read from a binary copy (by default halo_file + '.hdf5') until the halo file changes.
+
+	Parameters
+	----------
+	halo_file : string
+		Name of the AHF halo history file
+	cache_file : string
+		Name of the binary copy of the table. If it can't be written the table is only kept in memory.
+
+	Returns
+	-------
+	table : array
+		Rows of the halo file
+	"""
+
+	if cache_file is None:
+		cache_file = halo_file + '.hdf5'
+	source = [os.path.getmtime(halo_file), os.path.getsize(halo_file)]
+	if os.path.isfile(cache_file):
+		try:
+			with h5py.File(cache_file, 'r') as f:
+				if list(f.attrs.get('source',[])) == source:
+					return f['table'][...]
+		except (IOError, OSError, KeyError):
+			# A damaged copy is written over below
+			print("Could not read halo cache %s, reading the halo file"%cache_file)
+
+	table = np.loadtxt(halo_file, ndmin=2)
+	tmp = None
+	try:
+		# Written under a unique temporary name first so an interrupted write never looks complete, and
+		# jobs caching the same halo file at once don't write over each other
+		tmp = temp_file_name(cache_file)
+		with h5py.File(tmp, 'w') as f:
+			f.attrs['source'] = source
+			f.create_dataset('table', data=table)
+		os.rename(tmp, cache_file)
+	except (IOError, OSError):
+		if tmp is not None and os.path.exists(tmp):
+			os.remove(tmp)
+		print("Could not write halo cache %s, keeping it in memory only"%cache_file)
+	return table
+
+
+def load_halo_track(halo_file, snap_dir=None, cache_file=None):
+	"""
+	The history of a halo over a run from its AHF halo file, indexed by snapshot number. The snapshot
+	each row belongs to is found by matching its redshift to the snapshot headers, so runs with missing
+	or skipped snapshots line up. Each file is only loaded once per session (until it changes).
+
+	Parameters
+	----------
+	halo_file : string
+		Name of the AHF halo history file
+	snap_dir : string
+		Snapshot directory of the run. If None the rows are assumed to be snapshots 1, 2, 3, ...
+	cache_file : string
+		Name of the binary copy of the halo file, see read_halo_file
+
+	Returns
+	-------
+	track : dict
+		'snum' snapshot numbers, 'redshift', 'center' halo center in comoving code units, 'Rvir' virial
+		radius in comoving code units, and 'Lz_hat' unit vector of the halo angular momentum, for each row
+	"""
+
+	key = (os.path.abspath(halo_file), None if snap_dir is None else os.path.abspath(snap_dir))
+	mtime = os.path.getmtime(halo_file)
+	if key in HALO_TRACKS and HALO_TRACKS[key]['mtime'] == mtime:
+		return HALO_TRACKS[key]
+
+	table = read_halo_file(halo_file, cache_file=cache_file)
+	track = {'mtime':mtime, 'redshift':table[:,HALO_COLUMNS['redshift']], 'Rvir':table[:,HALO_COLUMNS['Rvir']], \
+	         'center':table[:,[HALO_COLUMNS['Xc'],HALO_COLUMNS['Yc'],HALO_COLUMNS['Zc']]]}
+	L = table[:,[HALO_COLUMNS['Lx'],HALO_COLUMNS['Ly'],HALO_COLUMNS['Lz']]]
+	track['Lz_hat'] = L/np.maximum(np.linalg.norm(L, axis=1), 1E-30)[:,np.newaxis]
+
+	snum = np.arange(1, len(table)+1)
+	if snap_dir is not None:
+		# Match each row to the snapshot with the closest scale factor
+		headers = build_header_catalog(snap_dir)
+		matched = np.zeros(len(table), dtype=bool)
+		if len(headers['snum']) > 0:
+			a_halo = 1./(1.+track['redshift'])
+			diff = np.abs(a_halo[:,np.newaxis] - 1./(1.+headers['Redshift'][np.newaxis,:]))
+			nearest = np.argmin(diff, axis=1)
+			matched = diff[np.arange(len(table)),nearest] < 1E-3*a_halo
+		if np.any(matched):
+			snum = np.where(matched, headers['snum'][nearest], -1)
+		else:
+			print("No halo file redshifts match the snapshots in %s, assuming rows are snapshots 1, 2, 3, ..."%snap_dir)
+	track['snum'] = snum
+
+	HALO_TRACKS[key] = track
+	return track
+
+
+def halo_properties(track, snum, H):
+	"""
+	Center, virial radius, and angular momentum direction of a halo in snapshot snum, in physical units
+	given the snapshot header H (e.g. from catalog_header). {'k':-1} if the halo isn't in that snapshot.
+	"""
+
+	j = np.where(track['snum']==snum)[0]
+	if len(j)==0 or H['k']==-1:
+		return {'k':-1}
+	j = j[0]
+	# Convert to physical units
+	units = H['time']/H['hubble']
+	return {'k':0, 'center':track['center'][j]*units, 'Rvir':track['Rvir'][j]*units, 'Lz_hat':track['Lz_hat'][j]}
@@ -1,4 +1,4 @@
-from readsnap import readsnap
+from readsnap import readsnap, build_header_catalog, catalog_header
 from dust_plots import *
 from astropy.table import Table
 import os
@@ -43,10 +43,13 @@ for i,snap_dir in enumerate(snap_dirs):
 	name = names[i]
 	print(name)
 
+	# Headers for the whole run are read once and looked up for each snapshot
+	headers = build_header_catalog(snap_dir)
+
 	for num in range(startnum,endnum+1):
 		print(num)
 
-		H = readsnap(snap_dir, num, 0, header_only=1, cosmological=cosmological)
+		H = catalog_header(headers, num, cosmological=cosmological)
 		G = readsnap(snap_dir, num, 0, cosmological=cosmological)
 
 		coords = G['p']
@@ -54,6 +57,7 @@ for i,snap_dir in enumerate(snap_dirs):
 		boxsize = H['boxsize']
 		mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
 		coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2; 
+		array_changed(coords)
 		center = np.average(coords, weights = G['m'], axis = 0)
 		DZ_vs_r([G], [H], [center], [r_max_phys], bin_nums=50, time=True, foutname=image_dir+sub_dir+implementation+'_'+name+'_DZ_vs_r_%03d.png' % num,cosmological=cosmological)
 
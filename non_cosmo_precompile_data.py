@@ -47,28 +47,45 @@ r_max = 20 # kpc
 disk_height = 2 # kpc
 Lz_hat = [0.,0.,1.] # direction of disk
 
-# Now preload the time evolution data
-for k in range(len(extra_names)):
-	extra_name = extra_names[k]
-	names = names_list[k]
-	labels = labels_list[k]
-	snap_dirs = [main_dir + i + '/output/' for i in names] 
-
-	data_names = []
-	for i,snap_dir in enumerate(snap_dirs):
-		name = names[i]
-		print(name)
-		dataname = implementation+'_'+name+'_data_'+str(r_max)+'_kpc_2_height.pickle'
-		data_names += [dataname]
-		compile_dust_data(snap_dir, foutname=dataname, mask=True, overwrite=True, cosmological=cosmological, r_max=r_max, Lz_hat=Lz_hat, disk_height=disk_height, startnum=startnum, endnum=endnum, implementation=implementation)
-
-		# Plot precompiled data
-		DZ_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_DZ_vs_time.png', log=False)
-
-		all_data_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_all_data_vs_time.png', log=False)
-
-	# Now plot a comparison of each of the runs
-	compare_runs_vs_time(datanames=data_names, data_dir='data/', foutname=image_dir+implementation+'_'+extra_name+'_compare_runs_vs_time.png', labels=labels, cosmological=cosmological, log=False)
+# Number of processes the snapshots are compiled over, should match the cores requested in precompile.pbs
+workers = 16
+
+# Array jobs each compile a shard of the snapshots (--shard i/n, or --shards n with the index from PBS/SLURM),
+# and a final job with --merge n stitches the shards together and makes the plots
+shard, merge_shards = parse_shard_args()
+
+# Now preload the time evolution data. Runs in more than one comparison group (e.g. the fiducial model)
+# are only compiled once for all of them
+runs = []
+for names in names_list:
+	for name in names:
+		runs += [{'snap_dir':main_dir + name + '/output/', 'foutname':implementation+'_'+name+'_data_'+str(r_max)+'_kpc_2_height.hdf5'}]
+compile_args = {'mask':True, 'overwrite':True, 'cosmological':cosmological, 'r_max':r_max, 'Lz_hat':Lz_hat, 'disk_height':disk_height, 'startnum':startnum, 'endnum':endnum, 'implementation':implementation, 'resume':True}
+if merge_shards is not None:
+	merge_dust_batch(runs, merge_shards, **compile_args)
+else:
+	compile_dust_batch(runs, workers=workers, shard=shard, **compile_args)
+
+# The plots need every snapshot, so they wait for the shards to be merged
+if shard is None:
+	for k in range(len(extra_names)):
+		extra_name = extra_names[k]
+		names = names_list[k]
+		labels = labels_list[k]
+
+		data_names = []
+		for i,name in enumerate(names):
+			print(name)
+			dataname = implementation+'_'+name+'_data_'+str(r_max)+'_kpc_2_height.hdf5'
+			data_names += [dataname]
+
+			# Plot precompiled data
+			DZ_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_DZ_vs_time.png', log=False)
+
+			all_data_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_all_data_vs_time.png', log=False)
+
+		# Now plot a comparison of each of the runs
+		compare_runs_vs_time(datanames=data_names, data_dir='data/', foutname=image_dir+implementation+'_'+extra_name+'_compare_runs_vs_time.png', labels=labels, cosmological=cosmological, log=False)
 
 
 main_dir = '/oasis/tscc/scratch/cchoban/non_cosmological_runs/Elemental/'
@@ -84,25 +101,35 @@ extra_names = ['largest_change','creation','misc']
 implementation = 'elemental'
 
 
-# Now preload the time evolution data
-for k in range(len(extra_names)):
-	extra_name = extra_names[k]
-	names = names_list[k]
-	labels = labels_list[k]
-	snap_dirs = [main_dir + i + '/output/' for i in names] 
-
-	data_names = []
-	for i,snap_dir in enumerate(snap_dirs):
-		name = names[i]
-		print(name)
-		dataname = implementation+'_'+name+'_data_'+str(r_max)+'_kpc_2_height.pickle'
-		data_names += [dataname]
-		compile_dust_data(snap_dir, foutname=dataname, mask=True, overwrite=True, cosmological=cosmological, r_max=r_max, Lz_hat=Lz_hat, disk_height=disk_height, startnum=startnum, endnum=endnum, implementation=implementation)
-
-		# Plot precompiled data
-		DZ_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_DZ_vs_time.png', log=False)
-
-		all_data_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_all_data_vs_time.png', log=False)
-
-	# Now plot a comparison of each of the runs
-	compare_runs_vs_time(datanames=data_names, data_dir='data/', foutname=image_dir+implementation+'_'+extra_name+'_compare_runs_vs_time.png', labels=labels, cosmological=cosmological, log=False)
\ No newline at end of file
+# Now preload the time evolution data. Runs in more than one comparison group (e.g. the fiducial model)
+# are only compiled once for all of them
+runs = []
+for names in names_list:
+	for name in names:
+		runs += [{'snap_dir':main_dir + name + '/output/', 'foutname':implementation+'_'+name+'_data_'+str(r_max)+'_kpc_2_height.hdf5'}]
+compile_args = {'mask':True, 'overwrite':True, 'cosmological':cosmological, 'r_max':r_max, 'Lz_hat':Lz_hat, 'disk_height':disk_height, 'startnum':startnum, 'endnum':endnum, 'implementation':implementation, 'resume':True}
+if merge_shards is not None:
+	merge_dust_batch(runs, merge_shards, **compile_args)
+else:
+	compile_dust_batch(runs, workers=workers, shard=shard, **compile_args)
+
+# The plots need every snapshot, so they wait for the shards to be merged
+if shard is None:
+	for k in range(len(extra_names)):
+		extra_name = extra_names[k]
+		names = names_list[k]
+		labels = labels_list[k]
+
+		data_names = []
+		for i,name in enumerate(names):
+			print(name)
+			dataname = implementation+'_'+name+'_data_'+str(r_max)+'_kpc_2_height.hdf5'
+			data_names += [dataname]
+
+			# Plot precompiled data
+			DZ_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_DZ_vs_time.png', log=False)
+
+			all_data_vs_time(dataname=dataname, data_dir='data/', time=True, cosmological=cosmological, foutname=image_dir+implementation+'_'+name+'_all_data_vs_time.png', log=False)
+
+		# Now plot a comparison of each of the runs
+		compare_runs_vs_time(datanames=data_names, data_dir='data/', foutname=image_dir+implementation+'_'+extra_name+'_compare_runs_vs_time.png', labels=labels, cosmological=cosmological, log=False)
\ No newline at end of file
@@ -1,4 +1,4 @@
-from readsnap import readsnap
+from readsnap import readsnap, load_snapshot, REDUCED_SNAPSHOT_FIELDS
 from dust_plots import *
 from astropy.table import Table
 import os
@@ -83,23 +83,21 @@ r_max_phys = 40 # kpc
 disk_height = 4 # kpc
 Lz_hat = [0.,0.,1.] # direction of disk
 
+# Reduced copies of the snapshots (only the fields the plots use) are kept here so replotting doesn't reread them
+cache_dir = './snapshot_cache/'
+
 for i, num in enumerate(snaps):
 	print(num)
 	Gas_snaps = []; Star_snaps = []; Headers = []; masks = []; centers = []; r_maxes = []; Lz_hats = []; disk_heights = []; Rds = [];
 	for j,snap_dir in enumerate(snap_dirs):
 		print snap_dir
 
-		H = readsnap(snap_dir, num, 0, header_only=1, cosmological=cosmological)
+		# Need to remember the stars in the inital conditions (types 2 and 3), these are merged into S
+		snap = load_snapshot(snap_dir, num, ptypes=[0,2,3,4], merge_stars=True, cosmological=cosmological, \
+					fields={0:REDUCED_SNAPSHOT_FIELDS,2:['p','m'],3:['p','m'],4:['p','m']}, cache_dir=cache_dir)
+		H = snap['header']; G = snap[0]; S = snap[4]
 		Headers += [H]
-		G = readsnap(snap_dir, num, 0, cosmological=cosmological)
 		Gas_snaps += [G]
-		S = readsnap(snap_dir, num, 4, cosmological=cosmological)
-		# Need to remember the stars in the inital conditions
-		S1 = readsnap(snap_dir, num, 2, cosmological=cosmological)
-		S2 = readsnap(snap_dir, num, 3, cosmological=cosmological)
-		for key in ['m','p']:
-			S[key] = np.append(S[key],S1[key],axis=0)
-			S[key] = np.append(S[key],S2[key],axis=0)
 		Star_snaps += [S]
 
 
@@ -110,6 +108,7 @@ for i, num in enumerate(snaps):
 		mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
 		# This also changes G['p'] as well
 		coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2; 
+		array_changed(coords)
 		center = np.average(coords, weights = G['m'], axis = 0)
 		centers += [center]
 
@@ -118,6 +117,7 @@ for i, num in enumerate(snaps):
 		mask1 = coords > boxsize/2; mask2 = coords <= boxsize/2
 		# This also changes G['p'] as well
 		coords[mask1] -= boxsize/2; coords[mask2] += boxsize/2; 
+		array_changed(coords)
 
 		Rds += [calc_stellar_Rd(S, center, r_max_phys, Lz_hat=Lz_hat, disk_height=disk_height, bin_nums=30)]
 
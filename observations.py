@@ -1,5 +1,6 @@
 import numpy as np
 import utils
+from binned_stats import binned_percentiles
 
 SOLAR_Z= 0.02
 
@@ -233,24 +234,18 @@ def Chiang_20_DZ_vs_param(param, bin_data=True, CO_opt='B13', phys_r=True, bin_n
 			gal_vals *= gal_distance[gal_name]
 		DZ_vals = DZ[gal==gal_name]
 		if bin_data:
-			mean_DZ = np.zeros(bin_nums - 1)
-			# 16th and 84th percentiles
-			std_DZ = np.zeros([bin_nums - 1,2])
 			if log:
 				val_bins = np.logspace(np.log10(np.min(gal_vals)), np.log10(np.max(gal_vals)), num=bin_nums)
 			else:
 				val_bins = np.linspace(np.min(gal_vals), np.max(gal_vals), num=bin_nums)
 			param_vals = (val_bins[1:] + val_bins[:-1]) / 2.
 			digitized = np.digitize(gal_vals,val_bins)
-			for j in range(1,len(val_bins)):
-				if len(gal_vals[digitized==j])==0:
-					mean_DZ[j-1] = np.nan
-					std_DZ[j-1,0] = np.nan; std_DZ[j-1,1] = np.nan;
-					continue
-				else:
-					values = DZ_vals[digitized == j]
-					mean_DZ[j-1] = np.mean(values)
-					std_DZ[j-1] = np.percentile(values, [16,84])
+			in_bins = np.logical_and(digitized > 0, digitized < len(val_bins))
+			bin_counts = np.bincount(digitized[in_bins]-1, minlength=bin_nums-1)
+			mean_DZ = np.bincount(digitized[in_bins]-1, weights=DZ_vals[in_bins], minlength=bin_nums-1) / np.maximum(bin_counts,1)
+			mean_DZ[bin_counts==0] = np.nan
+			# 16th and 84th percentiles
+			std_DZ = binned_percentiles(DZ_vals, gal_vals, val_bins, percentiles=np.array([16,84]), interpolation='linear')
 			mask = np.logical_not(np.isnan(mean_DZ))
 			data[gal_name] = [param_vals[mask], mean_DZ[mask], std_DZ[mask]]
 
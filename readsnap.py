@@ -1,6 +1,15 @@
 import numpy as np
 import h5py as h5py
 import os.path
+import pickle
+import hashlib
+import multiprocessing
+import threading
+import tempfile
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 ## This file was written by Phil Hopkins (phopkins@caltech.edu) for GIZMO ##
 
 
@@ -9,7 +18,8 @@ def readsnap(sdir,snum,ptype,
     snapshot_name='snapshot',
     extension='.hdf5',
     h0=0,cosmological=0,skip_bh=0,four_char=0,
-    header_only=0,loud=0):
+    header_only=0,loud=0,fields=None,
+    center=None,r_max=None,Lz_hat=None,disk_height=None,nproc=1,dtype=np.float64,cache_dir=None):
     '''
     This is a sub-routine designed to copy a GIZMO snapshot portion - specifically
     all the data corresponding to particles of a given type - into active memory in 
@@ -97,6 +107,34 @@ def readsnap(sdir,snum,ptype,
 
       loud: print additional checks as it reads, useful for debugging, 
         set to 1 or True if desired (default 0/False)
+
+      fields: default None: list of the shorthand field names (e.g. ['m','z','dz']) 
+        to read. only these are allocated and read from the snapshot, which saves 
+        a lot of time and memory when you don't need e.g. the velocities or IDs. 
+        fields not available for the particle type are ignored. None reads everything.
+
+      center, r_max: default None: only read the particles inside a sphere of radius 
+        r_max about center (both in the same physical/code units as the returned 
+        coordinates, i.e. after any cosmological/h0 conversion). the coordinates are 
+        read first and then only the selected rows of every other field, so for a 
+        zoom-in this avoids loading the whole box to keep just the galaxy.
+
+      Lz_hat, disk_height: default None: if Lz_hat (unit vector) is given with center 
+        and r_max, select a disk of radius r_max and half-height disk_height instead 
+        of a sphere.
+
+      nproc: default 1: for multi-part snapshots, read the parts concurrently over this 
+        many processes. each process opens and reads its own part (h5py serializes 
+        calls within a process, so threads would not overlap the reads) straight into 
+        its rows of the output arrays, which are shared memory while they are read.
+
+      dtype: default np.float64: floating point type of the returned fields (IDs are 
+        always integers). set to 'native' to keep the precision the fields have on 
+        disk (float32 for most GIZMO outputs), which halves the memory needed for 
+        the metallicity and dust arrays.
+
+      cache_dir: default None: directory of reduced snapshot files to read from/write 
+        to, see load_snapshot.
     
 
 
@@ -106,20 +144,91 @@ def readsnap(sdir,snum,ptype,
     if (ptype<0): return {'k':-1};
     if (ptype>5): return {'k':-1};
 
+    ptypes = [ptype]
+    if (header_only==1): ptypes = []
+    snap = load_snapshot(sdir,snum,ptypes=ptypes,header=True,
+        snapshot_name=snapshot_name,extension=extension,h0=h0,cosmological=cosmological,
+        skip_bh=skip_bh,four_char=four_char,loud=loud,fields=fields,center=center,
+        r_max=r_max,Lz_hat=Lz_hat,disk_height=disk_height,nproc=nproc,dtype=dtype,
+        cache_dir=cache_dir)
+    if (snap['k']==-1): return {'k':-1};
+    if (snap['header']['npartTotal'][ptype]<=0): return {'k':-1};
+    if (header_only==1): return snap['header'];
+    return snap[ptype]
+
+
+
+def load_snapshot(sdir,snum,ptypes=[0,2,3,4],header=True,merge_stars=False,
+    snapshot_name='snapshot',extension='.hdf5',
+    h0=0,cosmological=0,skip_bh=0,four_char=0,loud=0,fields=None,
+    center=None,r_max=None,Lz_hat=None,disk_height=None,nproc=1,dtype=np.float64,cache_dir=None):
+    '''
+    Loads several particle types (and the header) of a snapshot together. Each file 
+    (or file part) is opened only once and every requested type read from it, rather 
+    than re-resolving the filename and reopening everything per type as separate 
+    readsnap calls do.
+
+    Syntax:
+      snap = load_snapshot(sdir,snum,ptypes=[0,4],....)
+
+      Here "snap" is a dictionary holding the readsnap-style structure of each 
+      particle type under its number (e.g. snap[0] for gas, {'k':-1} if there are 
+      none), and the readsnap header_only structure under snap['header'].
+      snap['k'] is -1 if the snapshot could not be found.
+
+    Arguments:
+      sdir, snum: as for readsnap.
+
+    Optional:
+      ptypes: default [0,2,3,4]: list of particle types to load. an empty list only 
+        reads the header.
+
+      header: default True: include the header structure as snap['header'].
+
+      merge_stars: default False: append the disk (2) and bulge (3) star particles 
+        onto the new star particles (4), so snap[4] holds every star. only the fields 
+        all of the loaded star types have are kept, and types 2 and 3 are removed.
+
+      fields: as for readsnap. can also be a dictionary of field lists by particle 
+        type, e.g. {0:['p','m','z'],4:['p','m','age']}.
+
+      cache_dir: default None: directory to keep reduced snapshots in. the first load 
+        of a snapshot with a given set of particle types, fields, region and units 
+        writes the result there as a compressed hdf5 file, and later loads with the 
+        same arguments read that instead of the snapshot (until the snapshot file 
+        changes). combined with a region and REDUCED_SNAPSHOT_FIELDS this keeps only 
+        the galaxy and the fields the dust analysis uses.
+
+      all others: as for readsnap, applied to every particle type.
+    '''
+
     fname,fname_base,fname_ext = check_if_filename_exists(sdir,snum,\
         snapshot_name=snapshot_name,extension=extension,four_char=four_char)
     if(fname=='NULL'): return {'k':-1}
+
+    if (cache_dir is not None) and (len(ptypes)>0):
+        if isinstance(fields,dict): fields_key = sorted(fields.items())
+        else: fields_key = fields
+        if center is not None: center = np.asarray(center,dtype=np.float64).tolist()
+        if Lz_hat is not None: Lz_hat = np.asarray(Lz_hat,dtype=np.float64).tolist()
+        cache_file = reduced_snapshot_file(cache_dir,sdir,snum,ptypes=sorted(ptypes),header=header,
+            merge_stars=merge_stars,h0=h0,cosmological=cosmological,skip_bh=skip_bh,fields=fields_key,
+            center=center,r_max=r_max,Lz_hat=Lz_hat,disk_height=disk_height,dtype=str(dtype))
+        source = [os.path.getsize(fname),os.path.getmtime(fname)]
+        snap = read_reduced_snapshot(cache_file,source=source)
+        if snap is not None: 
+            if(loud==1): print('loaded reduced snapshot : '+cache_file)
+            return snap
+        snap = load_snapshot(sdir,snum,ptypes=ptypes,header=header,merge_stars=merge_stars,
+            snapshot_name=snapshot_name,extension=extension,h0=h0,cosmological=cosmological,
+            skip_bh=skip_bh,four_char=four_char,loud=loud,fields=fields,center=center,
+            r_max=r_max,Lz_hat=Lz_hat,disk_height=disk_height,nproc=nproc,dtype=dtype)
+        write_reduced_snapshot(cache_file,snap,source=source)
+        return snap
     if(loud==1): print('loading file : '+fname)
 
     ## open file and parse its header information
-    nL = 0 # initial particle point to start at 
-    if(fname_ext=='.hdf5'):
-        file = h5py.File(fname,'r') # Open hdf5 snapshot file
-        header_master = file["Header"] # Load header dictionary (to parse below)
-        header_toparse = header_master.attrs
-    else:
-        file = open(fname) # Open binary snapshot file
-        header_toparse = load_gadget_format_binary_header(file)
+    file,header_toparse = open_snapshot_part(fname,fname_ext)
 
     npart = header_toparse["NumPart_ThisFile"]
     massarr = header_toparse["MassTable"]
@@ -138,6 +247,7 @@ def readsnap(sdir,snum,ptype,
     flag_metals = header_toparse["Flag_Metals"]
     flag_dust = header_toparse["Flag_Dust"]
     flag_species = header_toparse["Flag_Species"]
+    file.close()
     print("npart_file: ",npart)
     print("npart_total:",npartTotal)
 
@@ -152,144 +262,562 @@ def readsnap(sdir,snum,ptype,
         time*=hinv
     
     boxsize*=hinv*ascale
-    if (npartTotal[ptype]<=0): file.close(); return {'k':-1};
-    if (header_only==1): file.close(); return {'k':0,'time':time,'redshift':redshift,
+    snap = {'k':1}
+    if header: snap['header'] = {'k':0,'time':time,'redshift':redshift,
         'boxsize':boxsize,'hubble':hubble,'omega0':omega_matter,'npart':npart,'npartTotal':npartTotal};
 
-    # initialize variables to be read
-    pos=np.zeros([npartTotal[ptype],3],dtype=np.float64)
-    vel=np.copy(pos)
-    ids=np.zeros([npartTotal[ptype]],dtype=int)
-    mass=np.zeros([npartTotal[ptype]],dtype=np.float64)
-    if (ptype==0):
-        ugas=np.copy(mass)
-        rho=np.copy(mass)
-        hsml=np.copy(mass) 
-        #if (flag_cooling>0): 
-        nume=np.copy(mass)
-        numh=np.copy(mass)
-        #if (flag_sfr>0): 
-        sfr=np.copy(mass)
-        metal=np.copy(mass)
-        dust_metal=np.copy(mass)
-        dust_source=np.copy(mass)
-        dust_species=np.copy(mass)
-    if (ptype==0 or ptype==4) and (flag_metals > 0):
-        metal=np.zeros([npartTotal[ptype],flag_metals],dtype=np.float64)
-    if (ptype == 0) and (flag_dust > 0):
-        dust_metal=np.zeros([npartTotal[ptype],flag_dust-4],dtype=np.float64)
-        dust_source=np.zeros([npartTotal[ptype],4],dtype=np.float64)
-    if (ptype == 0) and (flag_species > 0):
-        dust_species=np.zeros([npartTotal[ptype],flag_species],dtype=np.float64)
-    if (ptype==4) and (flag_sfr>0) and (flag_stellarage>0):
-        stellage=np.copy(mass)
-    if (ptype==5) and (skip_bh==0):
-        bhmass=np.copy(mass)
-        bhmdot=np.copy(mass)
-
-    # loop over the snapshot parts to get the different data pieces
-    for i_file in range(numfiles):
-        if (numfiles>1):
-            file.close()
-            fname = fname_base+'.'+str(i_file)+fname_ext
-            if(fname_ext=='.hdf5'):
-                file = h5py.File(fname,'r') # Open hdf5 snapshot file
-            else:
-                file = open(fname) # Open binary snapshot file
-                header_toparse = load_gadget_format_binary_header(file)
-                
-        if (fname_ext=='.hdf5'):
-            input_struct = file
-            npart = file["Header"].attrs["NumPart_ThisFile"]
-            bname = "PartType"+str(ptype)+"/"
-        else:
-            npart = header_toparse['NumPart_ThisFile']
-            input_struct = load_gadget_format_binary_particledat(file, header_toparse, ptype, skip_bh=skip_bh)
-            bname = ''
-            
-        
-        # now do the actual reading
-        if(npart[ptype]>0):
-            nR=nL + npart[ptype]
-            pos[nL:nR,:]=input_struct[bname+"Coordinates"]
-            vel[nL:nR,:]=input_struct[bname+"Velocities"]
-            ids[nL:nR]=input_struct[bname+"ParticleIDs"]
-            mass[nL:nR]=massarr[ptype]
-            if (massarr[ptype] <= 0.):
-                mass[nL:nR]=input_struct[bname+"Masses"]
-            if (ptype==0):
-                ugas[nL:nR]=input_struct[bname+"InternalEnergy"]
-                rho[nL:nR]=input_struct[bname+"Density"]
-                hsml[nL:nR]=input_struct[bname+"SmoothingLength"]
-                if (flag_cooling > 0): 
-                    nume[nL:nR]=input_struct[bname+"ElectronAbundance"]
-                    numh[nL:nR]=input_struct[bname+"NeutralHydrogenAbundance"]
-                if (flag_sfr > 0):
-                    sfr[nL:nR]=input_struct[bname+"StarFormationRate"]
-            if (ptype==0 or ptype==4) and (flag_metals > 0):
-                metal_t=input_struct[bname+"Metallicity"]
-                if (flag_metals > 1):
-                    if (metal_t.shape[0] != npart[ptype]): 
-                        metal_t=np.transpose(metal_t)
-                else:
-                    metal_t=np.reshape(np.array(metal_t),(np.array(metal_t).size,1))
-                metal[nL:nR,:]=metal_t
-            if (ptype == 0) and (flag_dust > 0):
-                dust_t=input_struct[bname+"DustMetallicity"][nL:nR,:flag_dust-4]
-                source_t=input_struct[bname+"DustMetallicity"][nL:nR,flag_dust-4:]
-                if (flag_dust > 1):
-                    if (dust_t.shape[0] != npart[ptype]): 
-                        dust_t=np.transpose(dust_t)
-                        source_t=np.transpose(source_t)
-                else:
-                    dust_t=np.reshape(np.array(dust_t),(np.array(dust_t).size,1))
-                    source_t=np.reshape(np.array(source_t),(np.array(source_t).size,1))
-                dust_metal[nL:nR,:]=dust_t
-                dust_source[nL:nR,:]=source_t
-            if (ptype == 0)  and (flag_species > 0):
-                species_t=input_struct[bname+"DustSpecies"]
-                if (flag_species > 1):
-                    if (species_t.shape[0] != npart[ptype]): 
-                        species_t=np.transpose(species_t)
+    # only types that exist are read, the rest are marked missing like readsnap does
+    toread = []
+    for ptype in ptypes:
+        if (ptype<0) or (ptype>5) or (npartTotal[ptype]<=0): snap[ptype] = {'k':-1}
+        else: toread += [ptype]
+    if (len(toread)==0): return snap
+
+    # work out which fields to read, by default everything we know about for each type
+    ptype_fields = {}
+    for ptype in toread:
+        ptype_fields[ptype] = fields
+        if isinstance(fields,dict): ptype_fields[ptype] = fields.get(ptype,None)
+        ptype_fields[ptype] = check_fields(ptype,fields=ptype_fields[ptype],skip_bh=skip_bh,loud=loud)
+    flags = {'Flag_Sfr':flag_sfr,'Flag_Cooling':flag_cooling,'Flag_StellarAge':flag_stellarage,
+        'Flag_Metals':flag_metals,'Flag_Dust':flag_dust,'Flag_Species':flag_species}
+
+    # names of each of the snapshot parts
+    fnames = [fname]
+    if (numfiles>1): fnames = [fname_base+'.'+str(i_file)+fname_ext for i_file in range(numfiles)]
+
+    # if only a region is wanted each part reads its coordinates first and then only
+    # the selected rows of every other field
+    region = None
+    if (center is not None) and (r_max is not None):
+        region = {'center':center,'r_max':r_max,'Lz_hat':Lz_hat,'disk_height':disk_height,'units':hinv*ascale}
+
+    # the parts are read in two passes: the first finds how many particles of each type 
+    # every part adds (and which rows, if only a region is wanted) and the dtype of each 
+    # field, so the output arrays can be allocated whole. the second reads each part 
+    # straight into its rows of them. with nproc processes the output arrays are shared 
+    # memory the workers write into, so no particle data is sent back to this process
+    args = [(fname_part,fname_ext,ptype_fields,flags,massarr,skip_bh,region) for fname_part in fnames]
+    pool = None; shared = {}
+    if (nproc>1) and (numfiles>1): pool = multiprocessing.Pool(min(nproc,numfiles))
+    try:
+        if pool is not None: layouts = pool.map(snapshot_part_layout, args)
+        else: layouts = [snapshot_part_layout(arg) for arg in args]
+
+        nsel = {}; start = []
+        for ptype in toread:
+            counts = [layout[ptype]['n'] for layout in layouts]
+            nsel[ptype] = int(np.sum(counts))
+            if(loud==1) and (region is not None): print('type '+str(ptype)+' particles in region : '+str(nsel[ptype]))
+        for i_part in range(len(layouts)):
+            start += [dict([(ptype,int(np.sum([layout[ptype]['n'] for layout in layouts[:i_part]]))) for ptype in toread])]
+
+        # allocate every field written to the snapshot with the dtype it has in the first part 
+        # holding it. fields that aren't (given the header flags) are left as zeros below
+        for ptype in toread:
+            snap[ptype] = {'k':1}
+            for key in ptype_fields[ptype]:
+                disk_dtypes = [layout[ptype]['dtypes'][key] for layout in layouts if layout[ptype]['dtypes'].get(key) is not None]
+                if (len(disk_dtypes)==0): continue
+                shape = field_shape(key,nsel[ptype],flags); fdtype = np.dtype(field_dtype(key,dtype,disk_dtypes[0]))
+                if (pool is not None) and (nsel[ptype]>0):
+                    shared.setdefault(ptype,{})[key] = shared_output_array(shape,fdtype)
+                    snap[ptype][key] = shared[ptype][key][1]
                 else:
-                    species_t=np.reshape(np.array(species_t),(np.array(species_t).size,1))
-                dust_species[nL:nR,:]=species_t   
-            if (ptype==4) and (flag_sfr>0) and (flag_stellarage>0):
-                stellage[nL:nR]=input_struct[bname+"StellarFormationTime"]
-            if (ptype==5) and (skip_bh==0):
-                bhmass[nL:nR]=input_struct[bname+"BH_Mass"]
-                bhmdot[nL:nR]=input_struct[bname+"BH_Mdot"]
-            nL = nR # sets it for the next iteration	
-
-	## correct to same ID as original gas particle for new stars, if bit-flip applied
-    if ((np.min(ids)<0) | (np.max(ids)>1.e9)):
-        bad = (ids < 0) | (ids > 1.e9)
-        ids[bad] += (int(1) << 31)
+                    snap[ptype][key] = np.zeros(shape,dtype=fdtype)
+
+        # positions of a region were already read to select it
+        for i_part,layout in enumerate(layouts):
+            for ptype in toread:
+                if ('p' in layout[ptype]) and ('p' in snap[ptype]):
+                    snap[ptype]['p'][start[i_part][ptype]:start[i_part][ptype]+layout[ptype]['n']] = layout[ptype].pop('p')
+
+        outputs = dict([(ptype,dict([(key,shared[ptype][key][0]) for key in shared[ptype]])) for ptype in shared])
+        if pool is not None:
+            pool.map(read_snapshot_part_args, [arg+(layouts[i_part],start[i_part],outputs) for i_part,arg in enumerate(args)])
+        else:
+            for i_part,arg in enumerate(args):
+                read_snapshot_part(*(arg+(layouts[i_part],start[i_part],snap)))
+    finally:
+        if pool is not None:
+            pool.terminate(); pool.join()
+        # the shared arrays stay mapped in this process once their files are gone
+        for ptype in shared:
+            for key in shared[ptype]:
+                if os.path.exists(shared[ptype][key][0][0]): os.remove(shared[ptype][key][0][0])
+
+    for ptype in toread:
+        P = snap[ptype]
+        # fields not written to the snapshot (given the header flags) are left as zeros
+        for key in ptype_fields[ptype]:
+            if key not in P:
+                P[key] = np.zeros(field_shape(key,nsel[ptype],flags),dtype=field_dtype(key,dtype))
+        convert_units(P,ptype,hinv,ascale,cosmological,flags)
+
+    if merge_stars: merge_star_types(snap)
+    return snap
+
+
+
+def prefetch_snapshots(sdir,snums,prefetch=2,snapshot_args=None,**kwargs):
+    '''
+    Iterates over snapshots of a run, loading the next ones with load_snapshot in a 
+    background thread while the current one is being worked on, so the file reads 
+    overlap with the analysis instead of alternating with it.
+
+    Syntax:
+      for snum,snap in prefetch_snapshots(sdir,range(10,599),ptypes=[0,4],....):
+
+      "snap" is what load_snapshot(sdir,snum,....) returns, and the snapshots come 
+      in the order given by snums.
+
+    Optional:
+      prefetch: default 2: number of snapshots read ahead of the one being worked on. 
+        at most prefetch+1 snapshots are held in memory at once, so lower this for 
+        big snapshots.
+
+      snapshot_args: default None: function of the snapshot number giving a dictionary 
+        of extra load_snapshot arguments for that snapshot (e.g. the center and r_max 
+        of a halo that moves between snapshots).
+
+      all others: passed on to load_snapshot.
+    '''
+    snums = list(snums)
+    loaded = queue.Queue()
+    slots = threading.Semaphore(prefetch+1)
+    stop = threading.Event()
+
+    def loader():
+        for snum in snums:
+            slots.acquire()
+            if stop.is_set(): return
+            try:
+                args = dict(kwargs)
+                if snapshot_args is not None: args.update(snapshot_args(snum))
+                loaded.put((snum,load_snapshot(sdir,snum,**args),None))
+            except Exception as error:
+                loaded.put((snum,None,error)); return
+
+    thread = threading.Thread(target=loader)
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in range(len(snums)):
+            snum,snap,error = loaded.get()
+            if error is not None: raise error
+            yield snum,snap
+            ## the snapshot is finished with once the next one is asked for
+            snap = None
+            slots.release()
+    finally:
+        stop.set(); slots.release()
+
+
+
+## fields used by the dust analysis, i.e. what is worth keeping in a reduced snapshot
+REDUCED_SNAPSHOT_FIELDS = ['p','m','rho','h','u','ne','nh','z','dz','dzs','spec','age']
+
+def reduced_snapshot_file(cache_dir,sdir,snum,**params):
+    ## name of the reduced snapshot file for a run, snapshot number, and set of load_snapshot
+    ##   parameters. the run is named after the end of its directory path for readability,
+    ##   and the full key hashed so every combination gets its own file
+    key = repr((os.path.abspath(sdir),snum,sorted(params.items())))
+    run = '_'.join([s0 for s0 in os.path.abspath(sdir).split('/') if len(s0)>0][-2:])
+    return cache_dir+'/'+run+'_'+'%03d'%snum+'_'+hashlib.md5(key.encode('utf-8')).hexdigest()[:12]+'.hdf5'
+
+
+
+def write_reduced_snapshot(fname,snap,source=None):
+    ## save a load_snapshot structure as a chunked, compressed hdf5 file. source is stored
+    ##   with it to recognize when the original snapshot has changed
+    cache_dir = os.path.dirname(fname)
+    if (len(cache_dir)>0) and not os.path.exists(cache_dir): 
+        try: os.makedirs(cache_dir)
+        except OSError: 
+            if not os.path.isdir(cache_dir): raise ## another writer may have just made it
+    ## written under a unique temporary name first so an interrupted write never looks 
+    ##   complete, and writers of the same snapshot (e.g. parallel jobs) don't clobber each other
+    tmp = temp_file_name(fname)
+    try:
+        with h5py.File(tmp,'w') as f:
+            f.attrs['k'] = snap['k']
+            if source is not None: f.attrs['source'] = source
+            for key in snap:
+                if (key=='k'): continue
+                group = f.create_group(str(key))
+                for name in snap[key]:
+                    if (name=='k') or (key=='header'): 
+                        group.attrs[name] = snap[key][name]; continue
+                    data = snap[key][name]
+                    if (len(data)>0): group.create_dataset(name,data=data,chunks=True,compression='gzip',compression_opts=4,shuffle=True)
+                    else: group.create_dataset(name,data=data)
+    except:
+        os.remove(tmp); raise
+    os.rename(tmp,fname)
+
+
+
+def read_reduced_snapshot(fname,source=None):
+    ## read a reduced snapshot back into a load_snapshot structure. returns None if there 
+    ##   is none, or it was made from a different version of the snapshot than source
+    if not os.path.exists(fname): return None
+    try:
+        with h5py.File(fname,'r') as f:
+            if (source is not None) and (list(f.attrs.get('source',[]))!=list(source)): return None
+            snap = {'k':int(f.attrs['k'])}
+            for key in f:
+                group = f[key]
+                if (key=='header'): 
+                    snap[key] = dict(group.attrs.items()); snap[key]['k'] = int(snap[key]['k']); continue
+                P = {'k':int(group.attrs['k'])}
+                for name in group: P[name] = group[name][...]
+                snap[int(key)] = P
+    except (IOError,OSError,KeyError):
+        ## a damaged file is treated as missing, and written over by the snapshot it's reloaded from
+        return None
+    return snap
+
+
+
+def merge_star_types(snap):
+    ## append the disk (2) and bulge (3) stars onto the new stars (4), keeping only the 
+    ##   fields all the loaded star types share
+    stars = [snap[ptype] for ptype in [4,2,3] if (ptype in snap) and (snap[ptype]['k']==1)]
+    for ptype in [2,3]: snap.pop(ptype,None)
+    if (len(stars)==0):
+        snap[4] = {'k':-1}; return snap
+    keys = [key for key in stars[0] if (key!='k') and all([key in S for S in stars])]
+    snap[4] = {'k':1}
+    for key in keys:
+        snap[4][key] = np.concatenate([S[key] for S in stars],axis=0)
+    return snap
+
+
+
+## shorthand names used in the returned structure, and the snapshot fields they hold
+FIELD_NAMES = {'p':'Coordinates','v':'Velocities','id':'ParticleIDs','m':'Masses',
+    'u':'InternalEnergy','rho':'Density','h':'SmoothingLength','ne':'ElectronAbundance',
+    'nh':'NeutralHydrogenAbundance','sfr':'StarFormationRate','z':'Metallicity',
+    'dz':'DustMetallicity','dzs':'DustMetallicity','spec':'DustSpecies',
+    'age':'StellarFormationTime','mbh':'BH_Mass','mdot':'BH_Mdot'}
+
+
+
+def snapshot_fields(ptype,skip_bh=0):
+    ## all the shorthand fields readsnap knows how to load for a given particle type
+    keys = ['p','v','id','m']
+    if (ptype==0): keys += ['u','rho','h','ne','nh','sfr','z','dz','dzs','spec']
+    if (ptype==4): keys += ['z','age']
+    if (ptype==5) and (skip_bh==0): keys += ['mbh','mdot']
+    return keys
+
+
+
+def check_fields(ptype,fields=None,skip_bh=0,loud=0):
+    ## returns the requested fields which exist for this particle type (all of them if None)
+    keys = snapshot_fields(ptype,skip_bh=skip_bh)
+    if fields is None: return keys
+    for key in fields:
+        if (key not in keys) and (loud==1): print('field '+str(key)+' not available for ptype '+str(ptype))
+    return [key for key in keys if key in fields]
+
+
+
+def field_shape(key,npart,flags):
+    ## shape of the output array for a field given the header flags
+    if (key=='p') or (key=='v'): return [npart,3]
+    if (key=='z') and (flags['Flag_Metals']>0): return [npart,flags['Flag_Metals']]
+    if (key=='dz') and (flags['Flag_Dust']>0): return [npart,flags['Flag_Dust']-4]
+    if (key=='dzs') and (flags['Flag_Dust']>0): return [npart,4]
+    if (key=='spec') and (flags['Flag_Species']>0): return [npart,flags['Flag_Species']]
+    return [npart]
+
+
+
+def field_dtype(key,dtype=np.float64,disk_dtype=None):
+    ## dtype of the output array for a field. dtype='native' keeps the on-disk precision
+    if (key=='id'): return int
+    if (dtype=='native'):
+        if disk_dtype is None: return np.float32
+        return disk_dtype
+    return dtype
+
+
+
+def field_written(key,flags):
+    ## whether a field is in the snapshot given the header flags
+    if (key=='ne' or key=='nh') and (flags['Flag_Cooling'] <= 0): return False
+    if (key=='sfr') and (flags['Flag_Sfr'] <= 0): return False
+    if (key=='age') and ((flags['Flag_Sfr'] <= 0) or (flags['Flag_StellarAge'] <= 0)): return False
+    if (key=='z') and (flags['Flag_Metals'] <= 0): return False
+    if (key=='dz' or key=='dzs') and (flags['Flag_Dust'] <= 0): return False
+    if (key=='spec') and (flags['Flag_Species'] <= 0): return False
+    return True
+
+
+
+def field_disk_dtype(input_struct,bname,key,mass,flags):
+    ## the dtype read_field returns a field in, without reading it. None if the field 
+    ##   was not written given the header flags
+    if (key=='m') and (mass > 0.): return np.dtype(np.float64)
+    if not field_written(key,flags): return None
+    return input_struct[bname+FIELD_NAMES[key]].dtype
+
+
+
+def read_field(input_struct,bname,key,npart,mass,flags,rows=None):
+    ## read a single field for the npart particles in this file piece (or only the 
+    ##   given rows of it). returns None if the field was not written given the 
+    ##   header flags (it is then left as zeros)
+    if (key=='m') and (mass > 0.): return mass
+    if not field_written(key,flags): return None
+    if (key=='z'): ncol = flags['Flag_Metals']
+    elif (key=='dz' or key=='dzs'): ncol = flags['Flag_Dust']
+    elif (key=='spec'): ncol = flags['Flag_Species']
+    else: return read_rows(input_struct[bname+FIELD_NAMES[key]],rows=rows)
+    if (ncol <= 0): return None
+
+    # dust metallicity holds the element dust abundances followed by the 4 dust sources
+    cols = None
+    if (key=='dz'): cols = slice(0,ncol-4)
+    if (key=='dzs'): cols = slice(ncol-4,ncol)
+
+    data=input_struct[bname+FIELD_NAMES[key]]
+    if (ncol > 1):
+        if (data.shape[0] != npart): 
+            data=np.transpose(data)
+    else:
+        data=np.reshape(np.array(data),(np.array(data).size,1))
+    return read_rows(data,rows=rows,cols=cols)
+
+
+
+## selected rows closer together than this are read as one contiguous block
+ROW_BLOCK_GAP = 4096
+
+def read_rows(data,rows=None,cols=None):
+    ## read the given sorted rows (and optionally a slice of columns) of a dataset. 
+    ##   hdf5 point selection is very slow for long index lists, so nearby rows are 
+    ##   coalesced into contiguous hyperslab reads and the extra rows dropped in memory
+    if rows is None:
+        if cols is None: return data
+        return data[:,cols]
+    if (len(rows)==0):
+        if cols is None: return data[0:0]
+        return data[0:0,cols]
+    blocks = []
+    for run in np.split(rows, np.where(np.diff(rows) > ROW_BLOCK_GAP)[0]+1):
+        if cols is None: block = data[run[0]:run[-1]+1]
+        else: block = data[run[0]:run[-1]+1,cols]
+        blocks.append(np.asarray(block)[run-run[0]])
+    return np.concatenate(blocks)
+
+
+
+def select_region(pos,center,r_max,Lz_hat=None,disk_height=None):
+    ## returns a mask of the positions inside a sphere of radius r_max about center, 
+    ##   or inside a disk of radius r_max and half-height disk_height if Lz_hat is given
+    coords = pos - center
+    if Lz_hat is None:
+        return np.sum(np.power(coords,2),axis=1) <= np.power(r_max,2.)
+    zmag = np.dot(coords,Lz_hat)
+    smag2 = np.sum(np.power(coords,2),axis=1) - np.power(zmag,2)
+    return np.logical_and(np.abs(zmag) <= disk_height, smag2 <= np.power(r_max,2.))
+
+
+
+def snapshot_part_layout(args):
+    ## first pass over one piece of a snapshot. for each particle type returns 'n', the 
+    ##   number of particles it adds to the output, 'rows', the rows of it inside the 
+    ##   region (None without a region, with 'p' their positions), and 'dtypes', the 
+    ##   on-disk dtype of each requested field (None if it wasn't written)
+    fname,fname_ext,fields,flags,massarr,skip_bh,region = args
+    file,header = open_snapshot_part(fname,fname_ext)
+    npart = np.array(header["NumPart_ThisFile"])
+    layouts = {}
+    for ptype in fields:
+        layout = {'n':int(npart[ptype]),'rows':None,'dtypes':{}}
+        layouts[ptype] = layout
+        if(npart[ptype]<=0): continue
+        input_struct,bname = snapshot_part_fields(file,fname_ext,header,ptype,skip_bh=skip_bh)
+
+        if region is not None:
+            pos = np.array(input_struct[bname+"Coordinates"])
+            in_region = select_region(pos*region['units'],region['center'],region['r_max'],
+                Lz_hat=region['Lz_hat'],disk_height=region['disk_height'])
+            layout['rows'] = np.where(in_region)[0]
+            layout['n'] = len(layout['rows'])
+            if ('p' in fields[ptype]): layout['p'] = pos[layout['rows']]
+            del pos
+
+        for key in fields[ptype]:
+            layout['dtypes'][key] = field_disk_dtype(input_struct,bname,key,massarr[ptype],flags)
+    file.close()
+    return layouts
+
+
+
+def read_snapshot_part(fname,fname_ext,fields,flags,massarr,skip_bh,region,layout,start,out):
+    ## second pass over one piece of a snapshot: read the requested fields of the particles 
+    ##   it adds (given its layout from snapshot_part_layout), in raw code units, straight 
+    ##   into rows start[ptype] onwards of the output arrays out[ptype][key]
+    file,header = open_snapshot_part(fname,fname_ext)
+    npart = np.array(header["NumPart_ThisFile"])
+    for ptype in fields:
+        n = layout[ptype]['n']
+        if(n<=0): continue
+        input_struct,bname = snapshot_part_fields(file,fname_ext,header,ptype,skip_bh=skip_bh)
+        P = out.get(ptype,{})
+        for key in fields[ptype]:
+            ## positions in a region were already read by the first pass
+            if (key not in P) or ((key=='p') and (region is not None)): continue
+            data = read_field(input_struct,bname,key,npart[ptype],massarr[ptype],flags,rows=layout[ptype]['rows'])
+            if data is not None: P[key][start[ptype]:start[ptype]+n] = data
+            del data
+    file.close()
+
+
+
+def read_snapshot_part_args(args):
+    ## read_snapshot_part in a worker process, since pool.map only passes one argument. 
+    ##   the last one holds the (file, dtype, shape) of each shared output array
+    outputs = args[-1]
+    out = {}
+    for ptype in outputs:
+        out[ptype] = {}
+        for key in outputs[ptype]:
+            tmp,fdtype,shape = outputs[ptype][key]
+            out[ptype][key] = np.memmap(tmp,dtype=fdtype,mode='r+',shape=shape)
+    read_snapshot_part(*(tuple(args[:-1])+(out,)))
+
+
+
+## directory for the shared output arrays of parallel reads, in memory where possible
+SHARED_ARRAY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def shared_output_array(shape,dtype):
+    ## a zeroed output array backed by a file in SHARED_ARRAY_DIR that worker processes 
+    ##   can open and write into. returns the (file, dtype, shape) they open it with and 
+    ##   the array, which stays valid after the file is removed
+    tmp = temp_file_name(SHARED_ARRAY_DIR+'/readsnap_output')
+    arr = np.memmap(tmp,dtype=dtype,mode='w+',shape=tuple(shape))
+    return (tmp,dtype,tuple(shape)),arr.view(np.ndarray)
+
+
+
+def open_snapshot_part(fname,fname_ext):
+    ## open one piece of a snapshot, returning the open file and its header
+    if (fname_ext=='.hdf5'):
+        file = h5py.File(fname,'r') # Open hdf5 snapshot file
+        return file,file["Header"].attrs
+    file = open(fname,'rb') # Open binary snapshot file
+    return file,load_gadget_format_binary_header(file)
+
+
+
+def snapshot_part_fields(file,fname_ext,header,ptype,skip_bh=0):
+    ## returns the structure to read a particle type's fields from in an open snapshot 
+    ##   piece, and the prefix of the field names in it
+    if (fname_ext=='.hdf5'):
+        return file,"PartType"+str(ptype)+"/"
+    return load_gadget_format_binary_particledat(file, header, ptype, skip_bh=skip_bh),''
+
+
+
+def convert_units(P,ptype,hinv,ascale,cosmological,flags):
+    ## correct to same ID as original gas particle for new stars, if bit-flip applied
+    if ('id' in P) and (len(P['id'])>0):
+        ids = P['id']
+        if ((np.min(ids)<0) | (np.max(ids)>1.e9)):
+            bad = (ids < 0) | (ids > 1.e9)
+            ids[bad] += (int(1) << 31)
 
     # do the cosmological conversions on final vectors as needed
-    pos *= hinv*ascale # snapshot units are comoving
-    mass *= hinv
-    vel *= np.sqrt(ascale) # remember gizmo's (and gadget's) weird velocity units!
-    if (ptype==0):
-        rho *= (hinv/((ascale*hinv)**3))
-        hsml *= hinv*ascale
-    if (ptype==4) and (flag_sfr>0) and (flag_stellarage>0) and (cosmological==0):
-        stellage *= hinv
-    if (ptype==5) and (skip_bh==0):
-        bhmass *= hinv
-
-    file.close();
-    if (ptype==0):
-        return {'k':1,'p':pos,'v':vel,'m':mass,'id':ids,'u':ugas,'rho':rho,'h':hsml,'ne':nume,'nh':numh,'sfr':sfr,'z':metal,'dz':dust_metal,'dzs':dust_source, 'spec':dust_species};
-    if (ptype==4):
-        return {'k':1,'p':pos,'v':vel,'m':mass,'id':ids,'z':metal,'age':stellage}
-    if (ptype==5) and (skip_bh==0):
-        return {'k':1,'p':pos,'v':vel,'m':mass,'id':ids,'mbh':bhmass,'mdot':bhmdot}
-    return {'k':1,'p':pos,'v':vel,'m':mass,'id':ids}
+    if ('p' in P): P['p'] *= hinv*ascale # snapshot units are comoving
+    if ('m' in P): P['m'] *= hinv
+    if ('v' in P): P['v'] *= np.sqrt(ascale) # remember gizmo's (and gadget's) weird velocity units!
+    if ('rho' in P): P['rho'] *= (hinv/((ascale*hinv)**3))
+    if ('h' in P): P['h'] *= hinv*ascale
+    if ('age' in P) and (flags['Flag_Sfr']>0) and (flags['Flag_StellarAge']>0) and (cosmological==0):
+        P['age'] *= hinv
+    if ('mbh' in P): P['mbh'] *= hinv
+
+
+
+## in-memory snapshot directory listings, by directory
+SNAPSHOT_DIR_INDEX = {}
+
+def snapshot_dir_index(sdir,index_file=None,refresh=0):
+    ## one listing of a snapshot directory and its snapdir_* sub-directories, kept in memory 
+    ##   so that resolving a snapshot name checks the candidate patterns against it instead 
+    ##   of the file system metadata. if index_file is given the listing is also saved there, 
+    ##   and reused (e.g. by later sessions) as long as the directory hasn't changed since
+    key = os.path.abspath(sdir)
+    index = SNAPSHOT_DIR_INDEX.get(key)
+    if (index is not None) and (refresh==0) and (index_file in [None,index['index_file']]): return index
+    if (index_file is None) and (index is not None): index_file = index['index_file']
+    try:
+        mtime = os.path.getmtime(sdir)
+    except OSError:
+        mtime = None
+
+    ## reuse the listing we have (or the saved one) unless the directory changed
+    if (index is not None) and (index['mtime']!=mtime): index = None
+    saved = None
+    if (index_file is not None) and os.path.exists(index_file):
+        with open(index_file,'rb') as f:
+            saved = pickle.load(f)
+        if (saved['mtime']!=mtime): saved = None
+    if (index is None): index = saved
+    if index is None:
+        index = {'mtime':mtime,'files':set(),'subdirs':{}}
+        if mtime is not None:
+            index['files'] = set(os.listdir(sdir))
+            for name in index['files']:
+                if not name.startswith('snapdir_'): continue
+                try:
+                    index['subdirs'][name] = set(os.listdir(sdir+'/'+name))
+                except OSError:
+                    pass
+    index['index_file'] = index_file
+    if (index_file is not None) and (saved is None):
+        with open(index_file,'wb') as f:
+            pickle.dump(index, f, protocol=2)
+        ## creating the index file inside the directory itself changes its mtime
+        if (mtime is not None) and (os.path.getmtime(sdir)!=mtime):
+            index['mtime'] = os.path.getmtime(sdir)
+            with open(index_file,'wb') as f:
+                pickle.dump(index, f, protocol=2)
+    SNAPSHOT_DIR_INDEX[key] = index
+    return index
+
+
+
+def snapshot_file_exists(index,sdir,fname):
+    ## check a path inside sdir against the directory index
+    name = fname[len(sdir)+1:].lstrip('/')
+    if '/' not in name: return name in index['files']
+    subdir,name = name.split('/',1)
+    return name in index['subdirs'].get(subdir,())
 
 
 
 def check_if_filename_exists(sdir,snum,snapshot_name='snapshot',extension='.hdf5',four_char=0):
+    ## the name patterns are checked against a listing of the directory, which is only 
+    ##   re-read if the snapshot isn't found and the directory has changed since
+    index = snapshot_dir_index(sdir)
+    fname_found, fname_base_found, fname_ext = find_snapshot_file(index,sdir,snum,
+        snapshot_name=snapshot_name,extension=extension,four_char=four_char)
+    if (fname_found=='NULL'):
+        refreshed = snapshot_dir_index(sdir,refresh=1)
+        if refreshed is not index:
+            fname_found, fname_base_found, fname_ext = find_snapshot_file(refreshed,sdir,snum,
+                snapshot_name=snapshot_name,extension=extension,four_char=four_char)
+    return fname_found, fname_base_found, fname_ext;
+
+
+
+def find_snapshot_file(index,sdir,snum,snapshot_name='snapshot',extension='.hdf5',four_char=0):
     for extension_touse in [extension,'.bin','']:
         fname=sdir+'/'+snapshot_name+'_'
         ext='00'+str(snum);
@@ -305,32 +833,32 @@ def check_if_filename_exists(sdir,snum,snapshot_name='snapshot',extension='.hdf5
 
         ## try several common notations for the directory/filename structure
         fname=fname_base+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is it a multi-part file?
             fname=fname_base+'.0'+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is the filename 'snap' instead of 'snapshot'?
             fname_base=sdir+'/snap_'+ext; 
             fname=fname_base+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is the filename 'snap' instead of 'snapshot', AND its a multi-part file?
             fname=fname_base+'.0'+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is the filename 'snap(snapdir)' instead of 'snapshot'?
             fname_base=sdir+'/snap_'+snapdir_specific+'_'+ext; 
             fname=fname_base+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is the filename 'snap' instead of 'snapshot', AND its a multi-part file?
             fname=fname_base+'.0'+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is it in a snapshot sub-directory? (we assume this means multi-part files)
             fname_base=sdir+'/snapdir_'+ext+'/'+snapshot_name+'_'+ext; 
             fname=fname_base+'.0'+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## is it in a snapshot sub-directory AND named 'snap' instead of 'snapshot'?
             fname_base=sdir+'/snapdir_'+ext+'/'+'snap_'+ext; 
             fname=fname_base+'.0'+extension_touse;
-        if not os.path.exists(fname): 
+        if not snapshot_file_exists(index,sdir,fname): 
             ## wow, still couldn't find it... ok, i'm going to give up!
             fname_found = 'NULL'
             fname_base_found = 'NULL'
@@ -344,6 +872,148 @@ def check_if_filename_exists(sdir,snum,snapshot_name='snapshot',extension='.hdf5
 
 
 
+## header values kept for every snapshot in a header catalog
+HEADER_CATALOG_FIELDS = ['Time','Redshift','HubbleParam','Omega0','OmegaLambda','BoxSize',
+    'NumFilesPerSnapshot','Flag_Sfr','Flag_Cooling','Flag_StellarAge','Flag_Metals','Flag_Dust',
+    'Flag_Species','NumPart_ThisFile','NumPart_Total','MassTable']
+
+## header catalogs already loaded, by catalog file
+HEADER_CATALOGS = {}
+
+## the process umask (read once, since it can only be read by setting it)
+UMASK = os.umask(0); os.umask(UMASK)
+
+def temp_file_name(fname):
+    ## a new empty file in the same directory as fname to write it under before renaming 
+    ##   it into place. the name is unique, so writers of the same file never share one.
+    ##   it gets the permissions a newly created file would (mkstemp makes it private)
+    fd,tmp = tempfile.mkstemp(prefix=os.path.basename(fname)+'.',suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(fname)))
+    os.close(fd)
+    os.chmod(tmp,0o666 & ~UMASK)
+    return tmp
+
+def build_header_catalog(sdir,catalog_file=None,snapshot_name='snapshot',extension='.hdf5',
+    four_char=0,refresh=0):
+    '''
+    Scans a snapshot directory once and collects the header of every snapshot in it 
+    into a small table (saved as hdf5, by default 'snapshot_headers.hdf5' in sdir), so 
+    the times, redshifts, particle numbers, etc. of a whole run can be looked up without 
+    opening the snapshots again. Snapshots already in the catalog file are not re-read 
+    unless their size on disk changed, so calling this again on a running simulation 
+    only reads the new ones.
+
+    Syntax:
+      catalog = build_header_catalog(sdir,....)
+
+      "catalog" is a dictionary of arrays, one entry per snapshot sorted by 'snum' 
+      (the snapshot number), holding the raw header values named as in the snapshot 
+      (e.g. catalog['Time']) and 'FileSize', the total size in bytes of its file(s). 
+      use catalog_header(catalog,snum) to get the readsnap header_only structure.
+
+    Optional:
+      catalog_file: where to save the catalog. if it can't be written the catalog is 
+        only kept in memory.
+
+      refresh: re-read the header of every snapshot.
+
+      snapshot_name, extension, four_char: as for readsnap.
+    '''
+    if catalog_file is None: catalog_file = sdir+'/snapshot_headers.hdf5'
+    key = os.path.abspath(catalog_file)
+
+    old = HEADER_CATALOGS.get(key)
+    if (old is None) and (refresh==0) and os.path.exists(catalog_file):
+        try:
+            old = {}
+            with h5py.File(catalog_file,'r') as f:
+                for name in f: old[name] = np.array(f[name])
+            if ('snum' not in old) or ((len(old['snum'])>0) and ('FileSize' not in old)): raise KeyError('snum')
+        except (IOError,OSError,KeyError):
+            print('could not read header catalog '+catalog_file+', rebuilding it')
+            old = None
+    if (old is None) or (refresh==1): old = {'snum':np.zeros(0,dtype=int)}
+
+    ## every number that looks like a snapshot in the directory listing, then resolved 
+    ##   the same way readsnap would to find its file(s)
+    index = snapshot_dir_index(sdir,refresh=1)
+    snums = set()
+    for name in list(index['files'])+list(index['subdirs']):
+        base = name.split('.')[0]
+        if '_' not in base: continue
+        ext = base.split('_')[-1]
+        if ext.isdigit(): snums.add(int(ext))
+
+    rows = []; changed = (refresh==1) or (not os.path.exists(catalog_file))
+    for snum in sorted(snums):
+        fname,fname_base,fname_ext = check_if_filename_exists(sdir,snum,
+            snapshot_name=snapshot_name,extension=extension,four_char=four_char)
+        if(fname=='NULL'): continue
+        fnames = [fname]
+        if (fname!=fname_base+fname_ext):
+            fnames = []; i_file = 0;
+            while snapshot_file_exists(index,sdir,fname_base+'.'+str(i_file)+fname_ext):
+                fnames += [fname_base+'.'+str(i_file)+fname_ext]; i_file += 1;
+        size = np.sum([os.path.getsize(fname_part) for fname_part in fnames])
+
+        ## reuse the catalog entry if the snapshot hasn't changed
+        j = np.where(old['snum']==snum)[0]
+        if (len(j)>0) and (old['FileSize'][j[0]]==size):
+            rows += [dict([(name,old[name][j[0]]) for name in old])]
+            continue
+        file,header = open_snapshot_part(fname,fname_ext)
+        row = {'snum':snum,'FileSize':size}
+        for name in HEADER_CATALOG_FIELDS:
+            row[name] = header[name] if (name in header) else 0
+        file.close()
+        rows += [row]; changed = True
+    ## snapshots that were removed since the catalog was written
+    if (len(rows)!=len(old['snum'])): changed = True
+
+    catalog = {'snum':np.zeros(0,dtype=int)}
+    if (len(rows)>0):
+        catalog = {}
+        for name in rows[0]: catalog[name] = np.array([row[name] for row in rows])
+    ## only written when something changed, under a temporary name first so readers 
+    ##   never see a half-written catalog
+    if changed:
+        tmp = None
+        try:
+            tmp = temp_file_name(catalog_file)
+            with h5py.File(tmp,'w') as f:
+                for name in catalog: f.create_dataset(name,data=catalog[name])
+            os.rename(tmp,catalog_file)
+        except (IOError,OSError):
+            if (tmp is not None) and os.path.exists(tmp): os.remove(tmp)
+            print('could not write header catalog '+catalog_file+', keeping it in memory only')
+    HEADER_CATALOGS[key] = catalog
+    return catalog
+
+
+
+def catalog_header(catalog,snum,h0=0,cosmological=0):
+    ## the header of snapshot snum from a header catalog, in the same form (and units) as 
+    ##   readsnap(...,header_only=1) returns it. {'k':-1} if it isn't in the catalog
+    j = np.where(catalog['snum']==snum)[0]
+    if (len(j)==0): return {'k':-1};
+    j = j[0]
+    time = catalog['Time'][j]
+    hubble = catalog['HubbleParam'][j]
+    hinv=1.
+    if (h0==1):
+        hinv=1./hubble
+    ascale=1.
+    if (cosmological==1):
+        ascale=time
+        hinv=1./hubble
+    if (cosmological==0): 
+        time*=hinv
+    boxsize = catalog['BoxSize'][j]*hinv*ascale
+    return {'k':0,'time':time,'redshift':catalog['Redshift'][j],'boxsize':boxsize,'hubble':hubble,
+        'omega0':catalog['Omega0'][j],'npart':catalog['NumPart_ThisFile'][j],'npartTotal':catalog['NumPart_Total'][j]};
+
+
+
 def load_gadget_format_binary_header(f):
     ### Read header.
     import array
@@ -418,116 +1088,49 @@ def load_gadget_format_binary_header(f):
     'Flag_Cooling':FlagCooling[0], 'NumFilesPerSnapshot':NumFiles[0], 'BoxSize':BoxSize[0], \
     'Omega0':Omega0[0], 'OmegaLambda':OmegaLambda[0], 'HubbleParam':h, \
     'Flag_StellarAge':FlagAge[0], 'Flag_Metals':FlagMetals[0], 'Nall_HW':NallHW, \
-    'Flag_EntrICs':flag_entr_ics[0]}
+    'Flag_EntrICs':flag_entr_ics[0], 'Flag_Dust':0, 'Flag_Species':0}
 
 
 def load_gadget_format_binary_particledat(f, header, ptype, skip_bh=0):
-    ## load old format=1 style gadget-format binary snapshot files (unformatted fortran binary)
-    import array
-    gas_u=0.; gas_rho=0.; gas_ne=0.; gas_nhi=0.; gas_hsml=0.; gas_SFR=0.; star_age=0.; 
-    zmet=0.; bh_mass=0.; bh_mdot=0.; mm=0.;
-    Npart = header['NumPart_ThisFile']
-    Massarr = header['MassTable']
-    NpartTot = np.sum(Npart)
-    NpartCum = np.cumsum(Npart)
-    n0 = NpartCum[ptype] - Npart[ptype]
-    n1 = NpartCum[ptype]
-    
-    ### particles positions. 3*Npart*float.
-    pos = array.array('f')
-    pos.fromfile(f, 3*NpartTot)
-    pos = np.reshape(pos, (NpartTot,3))
-    f.read(4+4) # Read block size fields.
-
-    ### particles velocities. 3*Npart*float.
-    vel = array.array('f')
-    vel.fromfile(f, 3*NpartTot)
-    vel = np.reshape(vel, (NpartTot,3))
-    f.read(4+4) # Read block size fields.
-
-    ### Particle IDs. # (Npart[0]+...+Npart[5])*int
-    id = array.array('i')
-    id.fromfile(f, NpartTot)
-    id = np.array(id)
-    f.read(4+4) # Read block size fields.
-        
-    ### Variable particle masses. 
-    Npart_MassCode = np.copy(np.array(Npart))
-    Npart=np.array(Npart)
-    Npart_MassCode[(Npart <= 0) | (np.array(Massarr,dtype='d') > 0.0)] = int(0)
-    NwithMass = np.sum(Npart_MassCode)
-    mass = array.array('f')
-    mass.fromfile(f, NwithMass)
-    f.read(4+4) # Read block size fields.
-    if (Massarr[ptype]==0.0):
-        Npart_MassCode_Tot = np.cumsum(Npart_MassCode)
-        mm = mass[Npart_MassCode_Tot[ptype]-Npart_MassCode[ptype]:Npart_MassCode_Tot[ptype]]
-
-    if ((ptype==0) | (ptype==4) | (ptype==5)):
-        if (Npart[0]>0):
-            ### Internal energy of gas particles ((km/s)^2).
-            gas_u = array.array('f')
-            gas_u.fromfile(f, Npart[0])
-            f.read(4+4) # Read block size fields.
-            ### Density for the gas paraticles (units?).
-            gas_rho = array.array('f')
-            gas_rho.fromfile(f, Npart[0])
-            f.read(4+4) # Read block size fields.
-
-            if (header['Flag_Cooling'] > 0):
-                ### Electron number density for gas particles (fraction of n_H; can be >1).
-                gas_ne = array.array('f')
-                gas_ne.fromfile(f, Npart[0])
-                f.read(4+4) # Read block size fields.
-                ### Neutral hydrogen number density for gas particles (fraction of n_H).
-                gas_nhi = array.array('f')
-                gas_nhi.fromfile(f, Npart[0])
-                f.read(4+4) # Read block size fields.
-
-            ### Smoothing length (kpc/h). ###
-            gas_hsml = array.array('f')
-            gas_hsml.fromfile(f, Npart[0])
-            f.read(4+4) # Read block size fields.
-
-            if (header['Flag_Sfr'] > 0):
-                ### Star formation rate (Msun/yr). ###
-                gas_SFR = array.array('f')
-                gas_SFR.fromfile(f, Npart[0])
-                f.read(4+4) # Read block size fields.
-
-        if (Npart[4]>0):
-            if (header['Flag_Sfr'] > 0):
-                if (header['Flag_StellarAge'] > 0):
-                    ### Star formation time (in code units) or scale factor ###
-                    star_age = array.array('f')
-                    star_age.fromfile(f, Npart[4])
-                    f.read(4+4) # Read block size fields.
-        
-        if (Npart[0]+Npart[4]>0):
-            if (header['Flag_Metals'] > 0):
-                ## Metallicity block (species tracked = Flag_Metals)
-                if (Npart[0]>0):
-                    gas_z = array.array('f')
-                    gas_z.fromfile(f, header['Flag_Metals']*Npart[0])
-                if (Npart[4]>0):
-                    star_z = array.array('f')
-                    star_z.fromfile(f, header['Flag_Metals']*Npart[4])
-                f.read(4+4) # Read block size fields.
-                if (ptype==0): zmet=np.reshape(gas_z,(-1,header['Flag_Metals']))
-                if (ptype==4): zmet=np.reshape(star_z,(-1,header['Flag_Metals']))
-        
-        if (Npart[5]>0):
-            if (skip_bh > 0):
-                ## BH mass (same as code units, but this is the separately-tracked BH mass from particle mass)
-                bh_mass = array.array('f')
-                bh_mass.fromfile(f, Npart[5])
-                f.read(4+4) # Read block size fields.
-                ## BH accretion rate in snapshot
-                bh_mdot = array.array('f')
-                bh_mdot.fromfile(f, Npart[5])
-                f.read(4+4) # Read block size fields.
-    
-    return {'Coordinates':pos[n0:n1,:], 'Velocities':vel[n0:n1,:], 'ParticleIDs':id[n0:n1], \
-        'Masses':mm, 'Metallicity':zmet, 'StellarFormationTime':star_age, 'BH_Mass':bh_mass, \
-        'BH_Mdot':bh_mdot, 'InternalEnergy':gas_u, 'Density':gas_rho, 'SmoothingLength':gas_hsml, \
-        'ElectronAbundance':gas_ne, 'NeutralHydrogenAbundance':gas_nhi, 'StarFormationRate':gas_SFR}
+    ## map old format=1 style gadget-format binary snapshot files (unformatted fortran binary).
+    ##   the block offsets are worked out from the header, and each block is returned as a 
+    ##   read-only np.memmap view of just the requested particle type's byte range, so 
+    ##   nothing is read until it is used (and then only the rows used)
+    Npart = np.array(header['NumPart_ThisFile'],dtype=np.int64)
+    Massarr = np.array(header['MassTable'],dtype='d')
+    N = Npart[ptype]
+
+    ## list of (name, particle types in block, values per particle, dtype) in file order
+    blocks = [('Coordinates',[0,1,2,3,4,5],3,np.float32), ('Velocities',[0,1,2,3,4,5],3,np.float32), 
+        ('ParticleIDs',[0,1,2,3,4,5],1,np.int32)]
+    ### Variable particle masses, only written for types with no entry in the mass table
+    with_mass = [i for i in range(6) if (Npart[i] > 0) and (Massarr[i] <= 0.)]
+    blocks += [('Masses',with_mass,1,np.float32)]
+    if (Npart[0]>0):
+        blocks += [('InternalEnergy',[0],1,np.float32), ('Density',[0],1,np.float32)]
+        if (header['Flag_Cooling'] > 0):
+            blocks += [('ElectronAbundance',[0],1,np.float32), ('NeutralHydrogenAbundance',[0],1,np.float32)]
+        blocks += [('SmoothingLength',[0],1,np.float32)]
+        if (header['Flag_Sfr'] > 0):
+            blocks += [('StarFormationRate',[0],1,np.float32)]
+    if (Npart[4]>0) and (header['Flag_Sfr'] > 0) and (header['Flag_StellarAge'] > 0):
+        blocks += [('StellarFormationTime',[4],1,np.float32)]
+    if (Npart[0]+Npart[4]>0) and (header['Flag_Metals'] > 0):
+        ## Metallicity block (species tracked = Flag_Metals), gas then stars
+        blocks += [('Metallicity',[0,4],header['Flag_Metals'],np.float32)]
+    if (Npart[5]>0) and (skip_bh == 0):
+        blocks += [('BH_Mass',[5],1,np.float32), ('BH_Mdot',[5],1,np.float32)]
+
+    # walk the blocks from the end of the header. each block is wrapped in 4-byte size markers
+    data = {}
+    offset = 4+256+4
+    for name, types, ncol, dtype in blocks:
+        ntypes = np.array([Npart[i] if i in types else 0 for i in range(6)])
+        nbytes = int(np.sum(ntypes)) * ncol * np.dtype(dtype).itemsize
+        if (nbytes <= 0): continue
+        if (ptype in types) and (N > 0):
+            start = offset + 4 + (np.sum(ntypes[:ptype]) * ncol * np.dtype(dtype).itemsize)
+            shape = (N,ncol) if (ncol > 1) else (N,)
+            data[name] = np.memmap(f, dtype=dtype, mode='r', offset=int(start), shape=shape)
+        offset += 4 + nbytes + 4
+    return data
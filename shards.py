@@ -0,0 +1,102 @@
+import numpy as np
+import os
+import subprocess
+import sys
+
+# Environment variables holding the array index of a job for each batch scheduler
+ARRAY_INDEX_VARS = ['SLURM_ARRAY_TASK_ID', 'PBS_ARRAYID', 'PBS_ARRAY_INDEX']
+# Environment variables holding the number of jobs in an array, if the scheduler sets one
+ARRAY_COUNT_VARS = ['SLURM_ARRAY_TASK_COUNT']
+
+
+def parse_shard_args(argv=None):
+	"""
+	Works out which shard of the work a precompile script should do from its command line, or from the
+	array index of a scheduler array job. Shards are numbered from 0, so array jobs should be submitted
+	with indices 0 to n-1 (e.g. qsub -t 0-19 or sbatch --array=0-19).
+
+	  --shard i/n   only compile shard i of n
+	  --shards n    compile the shard given by the array index, out of n (exits with an error if there
+	                is no array index)
+	  --merge n     stitch together the data of n shards once they have all finished
+
+	Parameters
+	----------
+	argv : list
+		Command line arguments, sys.argv if None
+
+	Returns
+	-------
+	shard : tuple
+		(i, n) for the shard to compile, None if the work isn't sharded
+	merge : int
+		Number of shards to merge, None if not merging
+	"""
+
+	if argv is None:
+		argv = sys.argv
+	shard = None; merge = None; num_shards = None
+	for i, arg in enumerate(argv):
+		if arg == '--shard':
+			index, num_shards = argv[i+1].split('/')
+			shard = (int(index), int(num_shards))
+		elif arg == '--shards':
+			num_shards = int(argv[i+1])
+		elif arg == '--merge':
+			merge = int(argv[i+1])
+
+	if shard is None and merge is None:
+		index = [os.environ[var] for var in ARRAY_INDEX_VARS if var in os.environ]
+		count = [os.environ[var] for var in ARRAY_COUNT_VARS if var in os.environ]
+		if num_shards is None and len(count) > 0:
+			num_shards = int(count[0])
+		if len(index) > 0 and num_shards is not None:
+			shard = (int(index[0]), num_shards)
+		elif '--shards' in argv:
+			# Every job would otherwise compile all of the snapshots
+			print("--shards was given but none of %s is set, submit this as an array job or use --shard i/n"%ARRAY_INDEX_VARS)
+			sys.exit(1)
+
+	if shard is not None and not 0 <= shard[0] < shard[1]:
+		print("Shard %i of %i doesn't exist, shards are numbered from 0"%shard)
+		return None, merge
+	return shard, merge
+
+
+def shard_range(startnum, endnum, shard):
+	"""
+	First and last snapshot of shard (i, n) when the snapshots startnum to endnum are split into n
+	contiguous blocks. The last snapshot is less than the first if the shard has no snapshots.
+	"""
+
+	index, num_shards = shard
+	bounds = startnum + np.round(np.linspace(0, endnum-startnum+1, num_shards+1)).astype(int)
+	return int(bounds[index]), int(bounds[index+1]-1)
+
+
+def shard_foutname(foutname, shard):
+	"""
+	Name of the file the data of shard (i, n) of a run is saved to before the shards are merged
+	"""
+
+	name, ext = os.path.splitext(foutname)
+	return name + '.shard_%i_of_%i'%shard + ext
+
+
+def launch_local_shards(script, num_shards, args=[]):
+	"""
+	Runs a precompile script as num_shards processes on this machine, each with --shard i/n, and then
+	once with --merge n. Useful for checking a sharded setup before submitting it as an array job.
+
+	Returns
+	-------
+	success : boolean
+		True if every shard and the merge finished without an error
+	"""
+
+	procs = [subprocess.Popen([sys.executable, script, '--shard', '%i/%i'%(i,num_shards)] + args) for i in range(num_shards)]
+	codes = [proc.wait() for proc in procs]
+	if any([code != 0 for code in codes]):
+		print("Shards failed: ", [i for i in range(num_shards) if codes[i] != 0])
+		return False
+	return subprocess.call([sys.executable, script, '--merge', str(num_shards)] + args) == 0
@@ -0,0 +1,245 @@
+import numpy as np
+import h5py
+import os
+import pickle
+from readsnap import temp_file_name
+
+# Number of snapshots stored together in each chunk of a time series dataset
+CHUNK_ROWS = 64
+
+
+def new_time_series(fname, settings, metadata=None):
+	"""
+	Creates an empty time series store, an HDF5 file with one dataset for each quantity (e.g. DZ_ratio)
+	holding a row per snapshot. Rows are appended one snapshot at a time with append_time_series.
+
+	Parameters
+	----------
+	fname : string
+		Name of the file
+	settings : string
+		Description of how the data was compiled, only rows compiled the same way should be added
+	metadata : dict, optional
+		Extra attributes saved with the data, e.g. the run directory and implementation. None values
+		are left out.
+
+	Returns
+	-------
+	None
+	"""
+
+	# Written under a unique temporary name first so an interrupted write never looks like a store, and
+	# jobs creating the same store at once don't write over each other
+	tmp = temp_file_name(fname)
+	try:
+		with h5py.File(tmp, 'w') as f:
+			f.attrs['settings'] = settings
+			if metadata is not None:
+				for key in metadata:
+					if metadata[key] is not None:
+						f.attrs[key] = metadata[key]
+			f.create_dataset('snap_num', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(CHUNK_ROWS,))
+	except:
+		os.remove(tmp)
+		raise
+	os.rename(tmp, fname)
+
+
+def append_time_series(fname, num, row):
+	"""
+	Adds the data of snapshot num to the end of a time series store. The snapshot number is written
+	last, so a row that was cut off part way through (e.g. by the job being killed) is never read and is
+	written over by the next append. Every row must have the same quantities, new ones can only be added
+	to a store that already has rows with add_time_series_columns.
+
+	Parameters
+	----------
+	fname : string
+		Name of the file
+	num : int
+		Snapshot number
+	row : dict
+		Value of each quantity for this snapshot
+
+	Returns
+	-------
+	None
+	"""
+
+	with h5py.File(fname, 'r+') as f:
+		length = len(f['snap_num'])
+		if length > 0:
+			# Earlier rows have no value for a new quantity, and this row needs one for each old quantity
+			new_keys = [key for key in row if key not in f]
+			if len(new_keys) > 0:
+				raise ValueError("%s not in time series %s, add them with add_time_series_columns"%(new_keys, fname))
+			missing = [key for key in f if key != 'snap_num' and key not in row]
+			if len(missing) > 0:
+				raise ValueError("Row of snapshot %i is missing %s of time series %s"%(num, missing, fname))
+		for key in row:
+			value = np.asarray(row[key])
+			if key not in f:
+				f.create_dataset(key, shape=(0,)+value.shape, maxshape=(None,)+value.shape, dtype=value.dtype, \
+				                 chunks=(CHUNK_ROWS,)+value.shape)
+			f[key].resize(length+1, axis=0)
+			f[key][length] = value
+		f['snap_num'].resize(length+1, axis=0)
+		f['snap_num'][length] = num
+		f.flush()
+
+
+def time_series_settings(fname):
+	"""
+	Settings a time series store was compiled with, or None if there is no store
+	"""
+
+	if not os.path.isfile(fname) or not h5py.is_hdf5(fname):
+		return None
+	with h5py.File(fname, 'r') as f:
+		settings = f.attrs.get('settings', None)
+	if isinstance(settings, bytes):
+		settings = settings.decode('utf-8')
+	return settings
+
+
+def add_time_series_columns(fname, nums, rows):
+	"""
+	Adds quantities to the snapshots already in a time series store, e.g. ones calculated after the rest
+	of the data was compiled.
+
+	Parameters
+	----------
+	fname : string
+		Name of the file
+	nums : list
+		Snapshot number of each row, every snapshot in the file must be given once
+	rows : list
+		Value of each of the new quantities for each snapshot
+
+	Returns
+	-------
+	None
+	"""
+
+	with h5py.File(fname, 'r+') as f:
+		snap_num = list(f['snap_num'][...])
+		if sorted(nums) != sorted(snap_num):
+			raise ValueError("New columns of time series %s must have a row for each of its snapshots"%fname)
+		index = [snap_num.index(num) for num in nums]
+		for key in rows[0]:
+			values = np.array([row[key] for row in rows])
+			column = np.zeros((len(snap_num),)+values.shape[1:], dtype=values.dtype)
+			column[index] = values
+			if key in f:
+				del f[key]
+			f.create_dataset(key, data=column, maxshape=(None,)+values.shape[1:], chunks=(CHUNK_ROWS,)+values.shape[1:])
+		f.flush()
+
+
+def time_series_keys(fname):
+	"""
+	Names of the quantities in a time series store
+	"""
+
+	with h5py.File(fname, 'r') as f:
+		return [key for key in f.keys() if key != 'snap_num']
+
+
+def read_time_series(fname, keys=None, startnum=None, endnum=None):
+	"""
+	Reads quantities from a time series store. Only the datasets asked for are read from the file, so
+	loading one quantity of many runs only reads a small part of each file. Time series saved as pickles
+	by older versions of compile_dust_data are read as well.
+
+	Parameters
+	----------
+	fname : string
+		Name of the file
+	keys : list, optional
+		Quantities to read, e.g. ['time','DZ_ratio']. All of them if None.
+	startnum, endnum : int, optional
+		Only read snapshots in this range
+
+	Returns
+	-------
+	data : dict
+		Values of each quantity for each snapshot, in snapshot order
+	"""
+
+	if not h5py.is_hdf5(fname):
+		with open(fname, 'rb') as handle:
+			data = pickle.load(handle)
+		if keys is None:
+			return data
+		return dict([(key, data[key]) for key in keys])
+
+	with h5py.File(fname, 'r') as f:
+		snap_num = f['snap_num'][...]
+		if keys is None:
+			keys = [key for key in f.keys() if key != 'snap_num']
+		rows = np.ones(len(snap_num), dtype=bool)
+		if startnum is not None: rows &= snap_num >= startnum
+		if endnum is not None: rows &= snap_num <= endnum
+		order = np.where(rows)[0][np.argsort(snap_num[rows], kind='mergesort')]
+		data = {'snap_num': snap_num[order]}
+		for key in keys:
+			# Rows past the end of snap_num are from an unfinished append
+			data[key] = f[key][:len(snap_num)][order]
+	return data
+
+
+def merge_time_series(fnames, fname):
+	"""
+	Stitches together time series stores of different snapshots of the same run (e.g. the shards of an
+	array job) into a single store, in snapshot order. Snapshots in more than one store are only kept once.
+
+	Parameters
+	----------
+	fnames : list
+		Names of the files to merge, which must all have been compiled with the same settings
+	fname : string
+		Name of the merged file
+
+	Returns
+	-------
+	success : boolean
+		False if a file is missing or was compiled differently from the others
+	"""
+
+	settings = [time_series_settings(name) for name in fnames]
+	if any([setting is None for setting in settings]):
+		print("Missing time series: ", [name for name,setting in zip(fnames,settings) if setting is None])
+		return False
+	if any([setting != settings[0] for setting in settings]):
+		print("Time series were compiled with different settings and can't be merged")
+		return False
+
+	with h5py.File(fnames[0], 'r') as f:
+		metadata = dict(f.attrs.items())
+	del metadata['settings']
+	new_time_series(fname, settings[0], metadata)
+	# Files without any snapshots have nothing to add
+	parts = [read_time_series(name) for name in fnames]
+	parts = [part for part in parts if len(part['snap_num']) > 0]
+	if len(parts) == 0:
+		return True
+	snap_num = np.concatenate([part['snap_num'] for part in parts])
+	# The first copy of each snapshot in snapshot order
+	snap_num, first = np.unique(snap_num, return_index=True)
+
+	keys = set(parts[0].keys())
+	for part in parts[1:]:
+		keys &= set(part.keys())
+	# Quantities only some of the files have can't fill every row
+	dropped = set().union(*[set(part.keys()) for part in parts]) - keys
+	if len(dropped) > 0:
+		print("Not in all of the time series, leaving out: ", sorted(dropped))
+	with h5py.File(fname, 'r+') as f:
+		for key in keys:
+			if key == 'snap_num':
+				continue
+			column = np.concatenate([part[key] for part in parts])[first]
+			f.create_dataset(key, data=column, maxshape=(None,)+column.shape[1:], chunks=(CHUNK_ROWS,)+column.shape[1:])
+		f['snap_num'].resize(len(snap_num), axis=0)
+		f['snap_num'][:] = snap_num
+	return True